@@ -1,76 +1,213 @@
 # -*- coding: utf-8 -*-
-import pandas as pd
-from pdf2image import convert_from_path
-import requests
-import subprocess
 from pathlib import Path
 import json
-import configparser
+import os
+import time
 import warnings
-from document_parser import DocumentProcessorFactory
-from form_type_extraction import determine_form_type
-from utils import send_request_to_companies_house_api
+from contextlib import closing, nullcontext
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait, as_completed
+from document_downloader import DocumentDownloader, is_download_complete, DOCUMENT_API_URL
+from job_manifest import JobManifest
+from metrics import get_metrics, log_event, setup_metrics
+from page_search import flush_page_hit_stats
+from results_store import get_results_store
+from settings import configure, get_settings
+from sh01_index import SH01Index, has_document
+from utils import send_request_to_companies_house_api, get_companies_house_client
+from work_queue import WorkQueue, iter_ch_ids, iter_shard
+from workspace import write_text_atomic
 
 
-def get_filing_history(ch_id):
+def iter_filing_history(ch_id, known_transaction_ids=(), api_base_url=None):
     """
-    This function gets the filing history of a startup given its company house id.
-    :param ch_id:
-    :return:
+    This function pages through the filing history of a startup, most recent items first, and stops as soon
+    as it reaches an item that is already known.
+    :param ch_id: company house id
+    :param known_transaction_ids: transaction ids of items fetched during a previous sync
+    :param api_base_url: base URL of the Companies House API, ApiBaseUrl of the config by default
+    :return: generator of filing history items
     """
-    fh_req = 'https://api.companieshouse.gov.uk/company/{}/filing-history?start_index={}&items_per_page=100'
+    fh_req = (api_base_url or get_settings().api_base_url) + '/company/{}/filing-history?start_index={}&items_per_page=100'
     n_items = 100
     start_index = 0
-    sh01_docs = []
     while n_items == 100:
         response = send_request_to_companies_house_api(fh_req.format(ch_id, start_index))
-        n_items = len(response.get('items', []))
+        items = response.get('items', [])
+        n_items = len(items)
         start_index += n_items
-        sh01_docs.extend([i for i in response.get('items', []) if i.get('type', '') == 'SH01'])
-    return sh01_docs
+        for item in items:
+            if item.get('transaction_id') in known_transaction_ids:
+                return
+            yield item
+
+
+def get_filing_history(ch_id):
+    """
+    This function gets the filing history of a startup given its company house id.
+    :param ch_id:
+    :return:
+    """
+    return [i for i in iter_filing_history(ch_id) if i.get('type', '') == 'SH01']
+
+
+def sync_filing_history(ch_id, index, max_age=0):
+    """
+    This function fetches only the filing history items added since the last sync, stores them in the index
+    and returns the SH01 documents that still need to be downloaded and parsed.
+    :param ch_id: company house id
+    :param index: SH01Index
+    :param max_age: seconds during which a sync is considered fresh and the API is not called, e.g. when a
+     batch is resumed after a crash
+    :return: list of SH01 items
+    """
+    if max_age and index.synced_since(ch_id, max_age):
+        get_metrics().inc('filing_history_skipped')
+        return index.pending_sh01_items(ch_id)
+    with get_metrics().timer('filing_history'):
+        new_items = list(iter_filing_history(ch_id, index.known_transaction_ids(ch_id)))
+    get_metrics().inc('filing_history_items', len(new_items))
+    index.record_history(ch_id, new_items)
+    return index.pending_sh01_items(ch_id)
+
+
+def fetch_filing_histories(ch_ids, max_workers=8, fetch=get_filing_history):
+    """
+    This function fetches the filing histories of many companies concurrently. The requests share one pooled
+    client and rate limit budget, and at most 2 * max_workers companies are in flight at any time.
+    :param ch_ids: iterable of company house ids
+    :param max_workers: number of concurrent requests
+    :param fetch: function returning the SH01 documents of a company
+    :return: generator of (company house id, SH01 documents) in order of completion
+    """
+    ch_ids = iter(ch_ids)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+        while True:
+            for ch_id in ch_ids:
+                in_flight[executor.submit(fetch, ch_id)] = ch_id
+                if len(in_flight) >= 2 * max_workers:
+                    break
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                ch_id = in_flight.pop(future)
+                try:
+                    yield ch_id, future.result()
+                except Exception as e:
+                    warnings.warn(f'Error fetching filing history of {ch_id}. Error: {e}')
+
+
+def parse_document_at(doc_path, doc_item):
+    """
+    This function determines the form type of a downloaded document and parses it with the matching
+    DocumentProcessor. It only depends on its arguments and the settings of the process so that it can run in
+    a worker process. The parsing modules, with OpenCV and pdf2image, are imported on the first call only.
+    :param doc_path: document folder
+    :param doc_item: document item from the filing history
+    :return: dictionary with the extracted information, empty if the form type is not supported
+    """
+    from document_parser import DocumentProcessorFactory
+    from form_layouts import LayoutRecognizer
+    from form_type_extraction import classify_document
+    from page_provider import PageProvider
+
+    start = time.perf_counter()
+    settings = get_settings()
+    pages = PageProvider(doc_path, dpi=settings.page_dpi)
+    recognizer = LayoutRecognizer(pages) if settings.use_layout_ocr else None
+    form_type, form_type_stage = classify_document(doc_path, pages, recognizer)
+    try:
+        doc_proc = DocumentProcessorFactory.create_processor(form_type, doc_path, pages, recognizer)
+        results = doc_proc.parse_document()
+        results['form_type_stage'] = form_type_stage
+    except ValueError as ve:
+        warning_message = f'Error parsing document {doc_item["transaction_id"]}. Error: {ve}'
+        warnings.warn(warning_message)
+        get_metrics().inc('documents_unsupported', form_type=form_type)
+        results = {}
+    get_metrics().observe('parse', time.perf_counter() - start, form_type=form_type)
+    return results
 
 
 class CompaniesHouseHandler:
     """
-    This class handles the interaction with the Companies House API.
+    This class handles the interaction with the Companies House API. The settings given, as Settings, path of
+    a config file or dictionary of sections, become the settings of the process. Without settings, the
+    settings of the process are used.
     """
-    def __init__(self, config_path='config.txt'):
-        config = configparser.ConfigParser()
-        config.read(config_path)
-        self.COMPANY_HOUSE_KEY = config['general']['CompanyHouseKey']
-        self.WORK_DIRECTORY = config['general']['Dir']
+    def __init__(self, settings=None):
+        config = configure(settings) if settings is not None else get_settings()
+        self.settings = config
+        setup_metrics(enabled=config.getboolean('metrics', 'Enabled', fallback=True),
+                      log_path=config.get('metrics', 'EventLogPath', fallback=None),
+                      prometheus_file=config.get('metrics', 'PrometheusFile', fallback=None),
+                      prometheus_port=config.getint('metrics', 'PrometheusPort', fallback=0),
+                      flush_seconds=config.getfloat('metrics', 'FlushSeconds', fallback=30))
+        self.COMPANY_HOUSE_KEY = config.company_house_key
+        self.WORK_DIRECTORY = config.work_directory
+        self.CRAWLER_WORKERS = config.getint('api', 'CrawlerWorkers', fallback=8)
+        self.downloader = DocumentDownloader(get_companies_house_client(),
+                                             config.get('api', 'DocumentApiBaseUrl', fallback=DOCUMENT_API_URL),
+                                             max_workers=config.getint('api', 'DownloadWorkers', fallback=4))
+        self.PARSE_WORKERS = config.getint('pipeline', 'ParseWorkers', fallback=1)
+        self.QUEUE_SIZE = config.getint('pipeline', 'QueueSize', fallback=64)
+        self.HISTORY_MAX_AGE = config.getfloat('pipeline', 'HistoryMaxAgeHours', fallback=12) * 3600
+        self.index = SH01Index(config.get('general', 'IndexPath', fallback=self.WORK_DIRECTORY + '/sh01_index.sqlite'))
+        self.results = get_results_store()
+        self.manifest = JobManifest(config.get('general', 'ManifestPath',
+                                               fallback=self.WORK_DIRECTORY + '/manifest.sqlite'))
+        self.QUEUE_PATH = config.get('pipeline', 'WorkQueuePath', fallback='') or \
+            self.WORK_DIRECTORY + '/work_queue.sqlite'
+        self.QUEUE_BATCH_SIZE = config.getint('pipeline', 'WorkQueueBatchSize', fallback=200)
+        self.LEASE_SECONDS = config.getfloat('pipeline', 'LeaseSeconds', fallback=600)
+        self.HEARTBEAT_SECONDS = config.getfloat('pipeline', 'HeartbeatSeconds', fallback=60)
+        self.MAX_BATCH_ATTEMPTS = config.getint('pipeline', 'MaxBatchAttempts', fallback=3)
 
     def download_document(self, doc_item, ch_id):
         """
         This function downloads a document from the Companies House API and saves it in the WORK_DIRECTORY.
+        Pages are rasterized later, one at a time, when a processor asks for them. An item without a document
+        link is skipped, it stays pending in the index until it is fetched again with its link.
         :param doc_item: item from the filing history
         :param ch_id: company house id
-        :return:
+        :return: bool, whether the document is on disk and can be parsed
         """
-        doc_folder_path = self.WORK_DIRECTORY + '/' + ch_id
-        if 'links' not in doc_item or 'document_metadata' not in doc_item['links']:
-            return
-        doc_path = f'{doc_folder_path}/{doc_item["action_date"]}_{doc_item["transaction_id"]}/'
-        if Path(doc_path + 'document.pdf').is_file():
-            warnings.warn(f'SH01 document {doc_item["transaction_id"]} already downloaded. Download skipped.')
-            return
+        transaction_id = doc_item['transaction_id']
+        self.manifest.register(ch_id, transaction_id)
+        if not has_document(doc_item):
+            get_metrics().inc('documents', stage='no_document')
+            return False
+        doc_path = self.get_doc_path(doc_item, ch_id)
+        if is_download_complete(doc_path + 'document.pdf') and Path(doc_path + 'metadata.json').is_file():
+            warnings.warn(f'SH01 document {transaction_id} already downloaded. Download skipped.')
+            self.manifest.complete(ch_id, transaction_id, 'downloaded')
+            get_metrics().inc('documents', stage='download_skipped')
+            return True
 
         document_id = doc_item['links']['document_metadata'].split('/')[-1]
-        curl_command = f'curl -i -u{self.COMPANY_HOUSE_KEY}: https://document-api.companieshouse.gov.uk/document/{document_id}/content'
-        doc_content_res = subprocess.check_output(curl_command, shell=True)
-        aws_url = str(doc_content_res).split('Location: ')[-1].split('\\r\\nServer:')[0]
-        aws_response = requests.get(aws_url)
         Path(doc_path + 'pages/').mkdir(parents=True, exist_ok=True)
 
-        with open(doc_path + 'metadata.json', 'w') as f:
-            json.dump(doc_item, f)
-
-        with open(doc_path + 'document.pdf', 'wb') as f:
-            f.write(aws_response.content)
+        try:
+            self.downloader.download(document_id, doc_path + 'document.pdf')
+            write_text_atomic(doc_path + 'metadata.json', json.dumps(doc_item))
+        except Exception as e:
+            self.fail(doc_item, ch_id, 'downloaded', e)
+            raise
+        self.manifest.complete(ch_id, transaction_id, 'downloaded')
+        get_metrics().inc('documents', stage='downloaded')
+        return True
 
-        pages = convert_from_path(doc_path + '/document.pdf', 500, last_page=10)
-        for idx, page in enumerate(pages[:10]):
-            page.save(f'{doc_path}/pages/{idx}.jpeg', 'JPEG')
+    def get_doc_path(self, doc_item, ch_id):
+        """
+        This function returns the folder of a document in the WORK_DIRECTORY.
+        :param doc_item: document item from the filing history
+        :param ch_id: company house id of the startup
+        :return:
+        """
+        doc_folder_path = self.WORK_DIRECTORY + '/' + ch_id
+        return f'{doc_folder_path}/{doc_item["action_date"]}_{doc_item["transaction_id"]}/'
 
     def parse_document(self, doc_item, ch_id):
         """
@@ -79,46 +216,224 @@ class CompaniesHouseHandler:
         :param ch_id: company house id of the startup
         :return:
         """
-        doc_folder_path = self.WORK_DIRECTORY + '/' + ch_id
-        doc_path = f'{doc_folder_path}/{doc_item["action_date"]}_{doc_item["transaction_id"]}/'
-        form_type = determine_form_type(doc_path, pd.to_datetime(doc_item['action_date']))
+        return parse_document_at(self.get_doc_path(doc_item, ch_id), doc_item)
+
+    def parse_and_write(self, doc_item, ch_id):
+        """
+        This function parses a downloaded document and saves the results. A document that was parsed
+        before a crash is written from the results kept in the manifest without being parsed again. As in
+        the process pipeline, a document whose parsing or writing fails is reported and skipped, it is retried
+        on the next run.
+        :param doc_item: document item from the filing history
+        :param ch_id: company house id of the startup
+        :return: parsed results or None if the parsing or the writing failed
+        """
+        res = self.manifest.parsed_result(ch_id, doc_item['transaction_id'])
+        if res is None:
+            try:
+                res = self.parse_document(doc_item, ch_id)
+            except Exception as e:
+                self.fail(doc_item, ch_id, 'parsed', e)
+                warnings.warn(f'Error parsing document {doc_item["transaction_id"]}. Error: {e}')
+                return None
+            self.record_parsed(doc_item, ch_id, res)
         try:
-            doc_proc = DocumentProcessorFactory.create_processor(form_type, doc_path)
-            results = doc_proc.parse_document()
-        except ValueError as ve:
-            warning_message = f'Error parsing document {doc_item["transaction_id"]}. Error: {ve}'
-            warnings.warn(warning_message)
-            results = {}
-        return results
+            self.write_result(doc_item, ch_id, res)
+        except Exception as e:
+            warnings.warn(f'Error writing results of document {doc_item["transaction_id"]}. Error: {e}')
+            return None
+        return res
 
-    def process_ch_id(self, ch_id):
+    def record_parsed(self, doc_item, ch_id, res):
+        """
+        This function commits the parsed results of a document to the manifest.
+        :param doc_item: document item from the filing history
+        :param ch_id: company house id of the startup
+        :param res: parsed results
+        :return:
+        """
+        self.manifest.complete(ch_id, doc_item['transaction_id'], 'parsed', form_type=res.get('form_type'), result=res)
+        get_metrics().inc('documents', stage='parsed', form_type=res.get('form_type'))
+        log_event('document_parsed', ch_id=ch_id, transaction_id=doc_item['transaction_id'],
+                  **{k: res.get(k) for k in ('form_type', 'form_type_stage', 'share_price', 'n_allotted',
+                                             'total_shares')})
+
+    def fail(self, doc_item, ch_id, stage, error):
+        """
+        This function records that a stage of a document failed, in the manifest, the metrics and the event log.
+        :param doc_item: document item from the filing history
+        :param ch_id: company house id of the startup
+        :param stage: stage of the manifest
+        :param error: exception
+        :return:
+        """
+        self.manifest.fail(ch_id, doc_item['transaction_id'], stage, error)
+        get_metrics().inc('documents_failed', stage=stage)
+        log_event('document_failed', ch_id=ch_id, transaction_id=doc_item['transaction_id'], stage=stage,
+                  error=f'{type(error).__name__}: {error}')
+
+    def write_result(self, doc_item, ch_id, res):
+        """
+        This function saves the results of a parsed document next to it and in the results store, and marks
+        it as processed in the index.
+        :param doc_item: document item from the filing history
+        :param ch_id: company house id of the startup
+        :param res: parsed results
+        :return:
+        """
+        try:
+            write_text_atomic(self.get_doc_path(doc_item, ch_id) + 'result.json', json.dumps(res))
+            self.results.append(ch_id, res)
+        except Exception as e:
+            self.fail(doc_item, ch_id, 'written', e)
+            raise
+        self.index.mark_processed(ch_id, doc_item['transaction_id'])
+        self.manifest.complete(ch_id, doc_item['transaction_id'], 'written')
+        get_metrics().inc('documents', stage='written')
+
+    def process_ch_id(self, ch_id, sh01_docs=None):
         """
         This function processes a single company house id by getting the filing history,
-        downloading and parsing the documents and saving the results.
+        downloading and parsing the documents and saving the results. Only the SH01 documents that
+        were not processed during a previous run are downloaded and parsed.
         :param ch_id:
+        :param sh01_docs: pending SH01 items of the filing history, synced if not given
         :return:
         """
-        sh01_docs = get_filing_history(ch_id)
-        for doc in sh01_docs:
-            self.download_document(doc, ch_id)
-            res = self.parse_document(doc, ch_id)
-            doc_folder_path = self.WORK_DIRECTORY + '/' + ch_id
-            doc_path = f'{doc_folder_path}/{doc["action_date"]}_{doc["transaction_id"]}/'
-            with open(doc_path + 'result.json', 'w') as f:
-                json.dump(res, f)
+        for _ in self.iter_ch_id(ch_id, sh01_docs):
+            pass
         return
 
-    def process_ch_ids_list(self, ch_list_path=None):
+    def iter_ch_id(self, ch_id, sh01_docs=None):
+        """
+        This function processes a single company house id as process_ch_id and yields the results of every
+        document as soon as it is written.
+        :param ch_id: company house id
+        :param sh01_docs: pending SH01 items of the filing history, synced if not given
+        :return: generator of (document item, parsed results)
+        """
+        if sh01_docs is None:
+            sh01_docs = sync_filing_history(ch_id, self.index, self.HISTORY_MAX_AGE)
+        with ThreadPoolExecutor(max_workers=self.downloader.max_workers) as executor:
+            downloads = {executor.submit(self.download_document, doc, ch_id): doc for doc in sh01_docs}
+            for future in as_completed(downloads):
+                doc = downloads[future]
+                try:
+                    if not future.result():
+                        continue
+                except Exception as e:
+                    warnings.warn(f'Error downloading document {doc["transaction_id"]}. Error: {e}')
+                    continue
+                res = self.parse_and_write(doc, ch_id)
+                if res is not None:
+                    yield doc, res
+
+    def open_work_queue(self):
+        """
+        This function opens the queue of batches of companies shared by the workers of several hosts.
+        :return: WorkQueue
+        """
+        return WorkQueue(self.QUEUE_PATH, lease_seconds=self.LEASE_SECONDS,
+                         heartbeat_seconds=self.HEARTBEAT_SECONDS, max_attempts=self.MAX_BATCH_ATTEMPTS)
+
+    def process_ch_ids_list(self, ch_list_path=None, parse_workers=None, shard=None, use_queue=False):
         """
         This function processes a list of company house ids by calling process_ch_id for each id.
+        The ids are read from the list as they are processed. Filing histories are fetched concurrently ahead
+        of the processing. With more than one parse worker, the documents are parsed by a pool of processes
+        fed by a separate download stage. Several hosts sharing the work directory split the list either by
+        shard or by claiming batches from the work queue.
         :param ch_list_path: file path to the list of company house ids
+        :param parse_workers: number of parse worker processes, defaults to ParseWorkers of the config
+        :param shard: (i, N) to process only the companies of shard i out of N
+        :param use_queue: claim batches of the list from the work queue until it is empty. The first worker
+         fills the queue from the list.
         :return:
         """
         if ch_list_path is None:
             ch_list_path = self.WORK_DIRECTORY + '/company_house_ids_list'
-        with open(ch_list_path, 'r') as f:
-            ch_ids = f.readlines()
-        ch_ids = [i.replace('\n', '') for i in ch_ids]
-        for ch_id in ch_ids:
-            self.process_ch_id(ch_id)
+        if parse_workers is None:
+            parse_workers = self.PARSE_WORKERS or os.cpu_count()
+        ch_ids = iter_ch_ids(ch_list_path)
+        if shard is not None:
+            ch_ids = iter_shard(ch_ids, *shard)
+        if use_queue:
+            work_queue = self.open_work_queue()
+            work_queue.load(ch_ids, self.QUEUE_BATCH_SIZE)
+            # Closing the batches gives the batch being processed back to the queue if the processing raises
+            batches = closing(work_queue.iter_batches())
+        else:
+            batches = nullcontext([ch_ids])
+        start = time.perf_counter()
+        n_companies = 0
+        with batches as batches:
+            for batch in batches:
+                n_companies += self.process_ch_ids(batch, parse_workers)
+        log_event('batch_finished', companies=n_companies, wall_time=round(time.perf_counter() - start, 3),
+                  **get_metrics().snapshot())
         return
+
+    def process_ch_ids(self, ch_ids, parse_workers):
+        """
+        This function processes the companies of an iterable of company house ids.
+        :param ch_ids: iterable of company house ids
+        :param parse_workers: number of parse worker processes
+        :return: number of companies
+        """
+        n_companies = 0
+
+        def count(ids):
+            nonlocal n_companies
+            for ch_id in ids:
+                n_companies += 1
+                yield ch_id
+
+        for _ in self.iter_processed(count(ch_ids), parse_workers):
+            pass
+        # The parse worker processes write their page hits when they exit, at the end of the batch
+        flush_page_hit_stats()
+        return n_companies
+
+    def iter_processed(self, ch_ids, parse_workers=None):
+        """
+        This function processes the companies of an iterable of company house ids and yields the results of
+        every document as soon as it is written. Documents processed by a previous run are not processed
+        again and are not yielded, their results are in the results store.
+        :param ch_ids: iterable of company house ids, read as the processing goes
+        :param parse_workers: number of parse worker processes, defaults to ParseWorkers of the config
+        :return: generator of (company house id, document item, parsed results)
+        """
+        if parse_workers is None:
+            parse_workers = self.PARSE_WORKERS or os.cpu_count()
+        if parse_workers > 1:
+            from pipeline import iter_pipeline
+            yield from iter_pipeline(self, ch_ids, parse_workers, self.QUEUE_SIZE)
+            return
+        sync = partial(sync_filing_history, index=self.index, max_age=self.HISTORY_MAX_AGE)
+        for ch_id, sh01_docs in fetch_filing_histories(ch_ids, self.CRAWLER_WORKERS, fetch=sync):
+            for doc, res in self.iter_ch_id(ch_id, sh01_docs):
+                yield ch_id, doc, res
+
+    def iter_results(self, ch_ids, parse_workers=None):
+        """
+        This function processes companies and yields the record of every document as soon as it is parsed and
+        written, so that the results can be streamed into another system.
+        :param ch_ids: iterable of company house ids
+        :param parse_workers: number of parse worker processes, defaults to ParseWorkers of the config
+        :return: generator of dictionaries with the parsed results, the company house id and the transaction id
+        """
+        for ch_id, doc, res in self.iter_processed(ch_ids, parse_workers):
+            yield dict(res, ch_id=ch_id, transaction_id=doc['transaction_id'])
+
+
+def iter_results(ch_ids, settings=None, parse_workers=None):
+    """
+    This function is the entry point of the library: it processes companies with a CompaniesHouseHandler and
+    yields the record of every document as soon as it is parsed and written.
+    :param ch_ids: iterable of company house ids
+    :param settings: Settings, path of a config file or dictionary of sections, the settings of the process
+     by default
+    :param parse_workers: number of parse worker processes, defaults to ParseWorkers of the config
+    :return: generator of dictionaries with the parsed results, the company house id and the transaction id
+    """
+    yield from CompaniesHouseHandler(settings).iter_results(ch_ids, parse_workers)
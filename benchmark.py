@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+import argparse
+import functools
+import json
+import math
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+import document_parser
+import form_layouts
+import form_type_extraction
+import page_search
+import utils
+from document_parser import DocumentProcessorFactory, Offline5FormProcessor, Offline6FormProcessor, \
+    OnlineOldFormProcessor, OnlineFormProcessor
+from form_layouts import LAYOUTS, LayoutRecognizer
+from form_type_extraction import FormTypeCache, classify_document
+from page_provider import PageProvider, RASTERIZED_DPI
+from page_search import PageHitStats
+from settings import get_settings
+from utils import get_ocr_engine, get_content_cache
+
+DEFAULT_CORPUS = 'SC428761'
+ACCURACY_FIELDS = ['form_type', 'share_price', 'n_allotted', 'total_shares']
+STAGES = ['rasterize', 'crop', 'border_removal', 'ocr', 'regex', 'text_layer', 'fx']
+
+
+class StageProfiler:
+    """
+    This class accumulates the wall time and the number of calls of the stages of the pipeline. Time is
+    exclusive: a stage called from another one (e.g. a page rasterized while cropping) is only counted once,
+    in the innermost stage. Calls from several threads are summed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.psm_calls = defaultdict(int)
+
+    def reset(self):
+        with self.lock:
+            self.times.clear()
+            self.calls.clear()
+            self.psm_calls.clear()
+
+    def wrap(self, stage, func):
+        """
+        This function returns func timed as a stage.
+        :param stage: name of the stage
+        :param func: function to time
+        :return: wrapped function
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = getattr(self.local, 'stack', None)
+            if stack is None:
+                stack = self.local.stack = []
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                children = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                with self.lock:
+                    self.times[stage] += elapsed - children
+                    self.calls[stage] += 1
+        return wrapper
+
+    def wrap_ocr(self, func):
+        timed = self.wrap('ocr', func)
+
+        @functools.wraps(func)
+        def wrapper(img, psm, *args, **kwargs):
+            with self.lock:
+                self.psm_calls[psm] += 1
+            return timed(img, psm, *args, **kwargs)
+        return wrapper
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'stages': {stage: {'time': round(self.times[stage], 4), 'calls': self.calls[stage]}
+                           for stage in STAGES},
+                'ocr_calls': self.calls['ocr'],
+                'ocr_calls_per_psm': {str(psm): n for psm, n in sorted(self.psm_calls.items())},
+            }
+
+
+@contextmanager
+def instrument(profiler):
+    """
+    This context manager times the rasterization, crops, border removal, OCR calls and regex post-processing
+    of the pipeline by wrapping the functions where the modules look them up, and restores them on exit.
+    :param profiler: StageProfiler
+    :return:
+    """
+    targets = [
+        (PageProvider, '_render', 'rasterize'),
+        (PageProvider, 'region', 'crop'),
+        (document_parser, 'crop_image', 'crop'),
+        (form_layouts, 'crop_image', 'crop'),
+        (utils, 'remove_table_borders', 'border_removal'),
+        (utils, 'clean_detected_text', 'regex'),
+        (document_parser, 'clean_detected_text', 'regex'),
+        (form_layouts, 'clean_detected_text', 'regex'),
+        (document_parser, 'correct_wrongly_recognized_symbols', 'regex'),
+        (form_type_extraction, 'determine_form_type_from_text', 'regex'),
+        (Offline5FormProcessor, 'parse_share_line', 'regex'),
+        (Offline5FormProcessor, 'parse_total_shares', 'regex'),
+        (Offline6FormProcessor, 'parse_total_shares', 'regex'),
+        (OnlineOldFormProcessor, 'parse_share_price_n_allotted', 'regex'),
+        (OnlineOldFormProcessor, 'parse_total_shares', 'regex'),
+        (OnlineFormProcessor, 'parse_total_shares', 'regex'),
+        (form_type_extraction, 'load_text_layer', 'text_layer'),
+        (document_parser, 'load_text_layer', 'text_layer'),
+        (document_parser, 'process_currencies_share_price', 'fx'),
+    ]
+    originals = []
+    for owner, name, stage in targets:
+        # Keep the raw attribute so that static methods are restored as such
+        original = owner.__dict__[name]
+        originals.append((owner, name, original))
+        if isinstance(original, staticmethod):
+            setattr(owner, name, staticmethod(profiler.wrap(stage, original.__func__)))
+        else:
+            setattr(owner, name, profiler.wrap(stage, original))
+    engine = get_ocr_engine()
+    engine.image_to_text = profiler.wrap_ocr(type(engine).image_to_text.__get__(engine))
+    engine.image_to_data = profiler.wrap_ocr(type(engine).image_to_data.__get__(engine))
+    try:
+        yield
+    finally:
+        del engine.image_to_text
+        del engine.image_to_data
+        for owner, name, original in originals:
+            setattr(owner, name, original)
+
+
+def find_documents(roots):
+    """
+    This function finds the parsed documents of a corpus, i.e. the folders with a metadata.json and the
+    expected result.json.
+    :param roots: folders searched recursively
+    :return: sorted list of document folders
+    """
+    documents = set()
+    for root in roots:
+        for result_path in Path(root).glob('**/result.json'):
+            if (result_path.parent / 'metadata.json').is_file():
+                documents.add(result_path.parent)
+    return sorted(documents)
+
+
+def copy_document(doc_dir, target_dir, legacy_pages=True):
+    """
+    This function copies the inputs of a document, without the crops, texts and caches of previous runs,
+    so that every run starts cold and the corpus is left untouched.
+    :param doc_dir: document folder
+    :param target_dir: folder to copy to
+    :param legacy_pages: also copy the pages rasterized to JPEG by earlier versions of the pipeline
+    :return: document path, with a trailing slash as used by the processors
+    """
+    (target_dir / 'pages').mkdir(parents=True)
+    for name in ('document.pdf', 'metadata.json'):
+        if (doc_dir / name).is_file():
+            shutil.copy(doc_dir / name, target_dir / name)
+    if legacy_pages:
+        for page in (doc_dir / 'pages').glob('*.jpeg'):
+            if re.fullmatch(r'\d+\.jpeg', page.name):
+                shutil.copy(page, target_dir / 'pages' / page.name)
+    return str(target_dir) + '/'
+
+
+def field_matches(expected, actual):
+    if expected is None or actual is None:
+        return expected is None and actual is None
+    if isinstance(expected, (int, float)) and isinstance(actual, (int, float)):
+        return math.isclose(expected, actual, rel_tol=1e-6)
+    return expected == actual
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux. It is the peak of the whole process, so it is only reported for the
+    # run and not per document
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def benchmark_document(doc_dir, work_dir, profiler, legacy_pages=True, layout_ocr=True):
+    """
+    This function classifies and parses a copy of a document and compares the results to the expected ones.
+    The processor of the expected form type is used, so that parsing is measured even if the classification
+    is wrong.
+    :param doc_dir: document folder with the expected result.json
+    :param work_dir: folder the document is copied to
+    :param profiler: StageProfiler
+    :param legacy_pages: reuse the pages rasterized to JPEG instead of rendering the PDF
+    :param layout_ocr: read the fields with the layouts of form_layouts.py instead of one crop per field
+    :return: dictionary with the timings and the accuracy of the document
+    """
+    with open(doc_dir / 'result.json', 'r') as f:
+        expected = json.load(f)
+    doc_path = copy_document(doc_dir, work_dir, legacy_pages)
+    profiler.reset()
+    record = {'document': str(doc_dir), 'transaction_id': expected.get('transaction_id'), 'error': None}
+    start = time.perf_counter()
+    res = {}
+    try:
+        pages = PageProvider(doc_path, dpi=get_settings().page_dpi)
+        recognizer = LayoutRecognizer(pages) if layout_ocr else None
+        form_type, stage = classify_document(doc_path, pages, recognizer)
+        record['classify_time'] = round(time.perf_counter() - start, 4)
+        record['form_type_stage'] = stage
+        processor = DocumentProcessorFactory.create_processor(expected.get('form_type') or form_type, doc_path, pages,
+                                                              recognizer)
+        if not layout_ocr:
+            processor.recognizer = None
+        parse_start = time.perf_counter()
+        res = processor.parse_document()
+        record['parse_time'] = round(time.perf_counter() - parse_start, 4)
+        res['form_type'] = form_type
+    except Exception as e:
+        record['error'] = f'{type(e).__name__}: {e}'
+    record['wall_time'] = round(time.perf_counter() - start, 4)
+    record.update(profiler.snapshot())
+    record['fields'] = {field: {'expected': expected.get(field), 'actual': res.get(field),
+                                'ok': field_matches(expected.get(field), res.get(field))}
+                        for field in ACCURACY_FIELDS}
+    record['expected_form_type'] = expected.get('form_type')
+    return record
+
+
+def check_border_removal(roots, max_text_loss=0.015):
+    """
+    This function compares the table border removal with the previous implementation,
+    utils.remove_table_borders_contours, on the regions of the fields read with border removal, on the pages
+    rasterized to JPEG of the documents of the expected form types with such fields.
+    :param roots: folders with parsed documents
+    :param max_text_loss: largest share of the ink of the text, away from the table lines, that may be removed
+    :return: dictionary with the measures of every region, the largest text loss and the regions over the limit
+    """
+    import cv2
+    regions = []
+    for doc_dir in find_documents(roots):
+        with open(doc_dir / 'result.json', 'r') as f:
+            form_type = json.load(f).get('form_type')
+        for field, layout in LAYOUTS.get(form_type, {}).items():
+            if not layout.remove_borders:
+                continue
+            for page in layout.pages:
+                img = cv2.imread(str(doc_dir / 'pages' / f'{page}.jpeg'), cv2.IMREAD_GRAYSCALE)
+                if img is None:
+                    continue
+                x0, x1, y0, y1 = layout.region
+                crop = img[x0 * img.shape[0] // 100: x1 * img.shape[0] // 100,
+                           y0 * img.shape[1] // 100: y1 * img.shape[1] // 100]
+                measures = utils.compare_table_border_removal(crop, RASTERIZED_DPI)
+                regions.append(dict({'document': str(doc_dir), 'field': field, 'page': page},
+                                    **{k: round(v, 4) for k, v in measures.items()}))
+    worst = max((r['text_loss'] for r in regions), default=0.0)
+    return {'regions': regions, 'max_text_loss': worst, 'limit': max_text_loss,
+            'over_limit': [r for r in regions if r['text_loss'] > max_text_loss]}
+
+
+def summarize(records):
+    """
+    This function aggregates the records of the documents, overall and per expected form type.
+    :param records: list of document records
+    :return: dictionary
+    """
+    def aggregate(group):
+        n = len(group)
+        return {
+            'documents': n,
+            'errors': sum(r['error'] is not None for r in group),
+            'wall_time': round(sum(r['wall_time'] for r in group), 4),
+            'stages': {stage: {'time': round(sum(r['stages'][stage]['time'] for r in group), 4),
+                               'calls': sum(r['stages'][stage]['calls'] for r in group)} for stage in STAGES},
+            'ocr_calls': sum(r['ocr_calls'] for r in group),
+            'accuracy': {field: round(sum(r['fields'][field]['ok'] for r in group) / n, 4) if n else None
+                         for field in ACCURACY_FIELDS},
+            'documents_correct': sum(all(f['ok'] for f in r['fields'].values()) for r in group),
+        }
+
+    by_form_type = defaultdict(list)
+    for record in records:
+        by_form_type[record['expected_form_type']].append(record)
+    summary = aggregate(records)
+    summary['peak_rss_mb'] = peak_rss_mb()
+    summary['form_types'] = {str(form_type): aggregate(group) for form_type, group in sorted(
+        by_form_type.items(), key=lambda item: str(item[0]))}
+    return summary
+
+
+def compare_to_baseline(summary, baseline, time_tolerance=0.2):
+    """
+    This function lists the regressions of a run compared to a previous one: lower accuracy on any field,
+    more OCR calls, or a total or stage time slower by more than the tolerance.
+    :param summary: summary of this run
+    :param baseline: summary of the previous run
+    :param time_tolerance: allowed relative slowdown
+    :return: list of messages, empty if there is no regression
+    """
+    regressions = []
+    for field, accuracy in summary['accuracy'].items():
+        previous = baseline['accuracy'].get(field)
+        if previous is not None and accuracy is not None and accuracy < previous:
+            regressions.append(f'{field} accuracy {previous:.2%} -> {accuracy:.2%}')
+    if summary['ocr_calls'] > baseline['ocr_calls']:
+        regressions.append(f'OCR calls {baseline["ocr_calls"]} -> {summary["ocr_calls"]}')
+    timings = [('total', summary['wall_time'], baseline['wall_time'])] + [
+        (stage, summary['stages'][stage]['time'], baseline['stages'].get(stage, {}).get('time', 0))
+        for stage in STAGES]
+    for name, current, previous in timings:
+        # Stages taking less than 50 ms are too noisy to compare
+        if previous > 0.05 and current > previous * (1 + time_tolerance):
+            regressions.append(f'{name} time {previous:.2f}s -> {current:.2f}s')
+    return regressions
+
+
+def run_benchmark(roots, legacy_pages=True, layout_ocr=None, content_cache=False):
+    """
+    This function benchmarks the form type detection and the document processors over the documents of
+    the given corpora.
+    :param roots: folders with parsed documents
+    :param legacy_pages: reuse the pages rasterized to JPEG instead of rendering the PDF
+    :param layout_ocr: read the fields with the layouts of form_layouts.py instead of one crop per field,
+     LayoutOcr of the config by default
+    :param content_cache: read and fill the cache of pages and OCR results, e.g. to measure a parse of
+     documents processed before
+    :return: dictionary with the records of the documents and their summary
+    """
+    if layout_ocr is None:
+        layout_ocr = get_settings().use_layout_ocr
+    engine = get_ocr_engine()
+    try:
+        engine_version = engine.version
+    except Exception:
+        engine_version = None
+    profiler = StageProfiler()
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir, instrument(profiler):
+        # A cold form type cache, so that the classification is measured and the cache of the data folder
+        # is not modified
+        previous_cache = form_type_extraction._cache
+        form_type_extraction._cache = FormTypeCache(tmp_dir + '/form_types.sqlite')
+        # No learned page order either, so that the pages searched and the OCR calls do not depend on earlier runs
+        # and the page order of the data folder is not modified
+        previous_stats = page_search._stats
+        page_search._stats = PageHitStats(tmp_dir + '/page_hits.sqlite')
+        previous_content_cache_enabled = get_content_cache().enabled
+        get_content_cache().enabled = content_cache
+        try:
+            for i, doc_dir in enumerate(find_documents(roots)):
+                record = benchmark_document(doc_dir, Path(tmp_dir) / str(i), profiler, legacy_pages, layout_ocr)
+                records.append(record)
+                print(f'{record["document"]}: {record["wall_time"]:.2f}s, {record["ocr_calls"]} OCR calls, '
+                      f'{sum(f["ok"] for f in record["fields"].values())}/{len(ACCURACY_FIELDS)} fields correct'
+                      + (f', {record["error"]}' if record['error'] else ''), file=sys.stderr)
+        finally:
+            form_type_extraction._cache = previous_cache
+            page_search._stats = previous_stats
+            get_content_cache().enabled = previous_content_cache_enabled
+    return {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'ocr_engine': type(engine).__name__,
+        'ocr_engine_version': engine_version,
+        'page_dpi': get_settings().page_dpi,
+        'legacy_pages': legacy_pages,
+        'layout_ocr': layout_ocr,
+        'content_cache': content_cache,
+        'documents': records,
+        'summary': summarize(records),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the speed and accuracy of the parsing on documents '
+                                                 'with a known result.json.')
+    parser.add_argument('corpus', nargs='*',
+                        help=f'folders with parsed documents, {DEFAULT_CORPUS} of the work directory by default')
+    parser.add_argument('--output', help='JSON file to write, standard output by default')
+    parser.add_argument('--from-pdf', action='store_true',
+                        help='rasterize the PDFs instead of reusing the pages rasterized to JPEG')
+    parser.add_argument('--layout-ocr', choices=['on', 'off'],
+                        help='read the fields from page passes with layouts or with one crop per field, '
+                             'LayoutOcr of the config by default')
+    parser.add_argument('--content-cache', action='store_true',
+                        help='use the cache of pages and OCR results, disabled by default to measure a cold run')
+    parser.add_argument('--baseline', help='JSON output of a previous run, exit with an error on regressions')
+    parser.add_argument('--time-tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown compared to the baseline')
+    parser.add_argument('--max-border-text-loss', type=float, default=0.015,
+                        help='largest share of text ink the table border removal may remove compared to the '
+                             'previous implementation, exit with an error above it')
+    args = parser.parse_args()
+
+    layout_ocr = None if args.layout_ocr is None else args.layout_ocr == 'on'
+    corpus = args.corpus or [get_settings().work_directory + '/' + DEFAULT_CORPUS]
+    report = run_benchmark(corpus, legacy_pages=not args.from_pdf, layout_ocr=layout_ocr,
+                           content_cache=args.content_cache)
+    report['border_removal'] = check_border_removal(corpus, args.max_border_text_loss)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    summary = report['summary']
+    print(f'{summary["documents"]} documents in {summary["wall_time"]:.2f}s, {summary["ocr_calls"]} OCR calls, '
+          f'peak RSS {summary["peak_rss_mb"]} MB', file=sys.stderr)
+    for stage in STAGES:
+        print(f'  {stage}: {summary["stages"][stage]["time"]:.2f}s in {summary["stages"][stage]["calls"]} calls',
+              file=sys.stderr)
+    print('  accuracy: ' + ', '.join(f'{field} {accuracy:.0%}' for field, accuracy in summary['accuracy'].items()
+                                     if accuracy is not None), file=sys.stderr)
+    border_removal = report['border_removal']
+    print(f'  border removal: text loss at most {border_removal["max_text_loss"]:.2%} on '
+          f'{len(border_removal["regions"])} regions', file=sys.stderr)
+    regressions = [f'border removal text loss {r["text_loss"]:.2%} on page {r["page"]} of {r["document"]}'
+                   for r in border_removal['over_limit']]
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions += compare_to_baseline(summary, json.load(f)['summary'], args.time_tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}', file=sys.stderr)
+    sys.exit(1 if regressions else 0)
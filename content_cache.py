@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from metrics import get_metrics
+
+
+def content_key(*parts):
+    """
+    This function hashes the parts of a cache key, e.g. the hash of a PDF with the page number and the
+    resolution, or the bytes of a crop with the page segmentation mode and the version of the OCR engine.
+    :param parts: bytes, numpy arrays or values converted to text
+    :return: hexadecimal digest
+    """
+    import numpy as np
+    digest = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(f'{part.shape}{part.dtype}'.encode('utf-8'))
+            part = np.ascontiguousarray(part).data
+        elif not isinstance(part, (bytes, bytearray, memoryview)):
+            part = str(part).encode('utf-8')
+        digest.update(part)
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+class ContentCache:
+    """
+    This class keeps rasterized pages and OCR results on disk, addressed by the hash of what produced them,
+    so that reprocessing documents after a change of the parsing only repeats the parsing. Entries are files
+    under the cache folder, indexed in SQLite with their size and last access so that the least recently used
+    ones are evicted when the cache grows over max_bytes. The total size is kept up to date in the index, so
+    that a write does not sum the sizes of all the entries. Several processes can share the cache: files are
+    written atomically and an entry evicted by another process is a miss.
+    """
+
+    def __init__(self, conn, root, max_bytes=2 << 30, enabled=True):
+        self.conn = conn
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, kind TEXT NOT NULL, '
+                          'size INTEGER NOT NULL, accessed REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), '
+                          'total INTEGER NOT NULL)')
+        # Caches created before the total was kept start from the sum of their entries
+        self.conn.execute('INSERT OR IGNORE INTO usage (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM entries')
+
+    def _path(self, key):
+        return self.root / key[:2] / key
+
+    def get_bytes(self, kind, key):
+        """
+        This function returns the content of an entry.
+        :param kind: kind of entry, e.g. 'page' or 'ocr_text', to count hits and misses
+        :param key: key returned by content_key
+        :return: bytes or None on a miss
+        """
+        if not self.enabled:
+            return None
+        try:
+            data = self._path(key).read_bytes()
+        except FileNotFoundError:
+            get_metrics().inc('content_cache', kind=kind, outcome='miss')
+            return None
+        with self.lock:
+            self.conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+        get_metrics().inc('content_cache', kind=kind, outcome='hit')
+        return data
+
+    def put_bytes(self, kind, key, data):
+        """
+        This function stores an entry and evicts the least recently used ones if the cache is over its size.
+        :param kind: kind of entry
+        :param key: key returned by content_key
+        :param data: content
+        :return:
+        """
+        if not self.enabled or len(data) > self.max_bytes // 10:
+            return
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=key + '.', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                replaced = self.conn.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+                self.conn.execute('INSERT OR REPLACE INTO entries (key, kind, size, accessed) VALUES (?, ?, ?, ?)',
+                                  (key, kind, len(data), time.time()))
+                self.conn.execute('UPDATE usage SET total = total + ?',
+                                  (len(data) - (replaced[0] if replaced else 0),))
+                evicted = self._evict()
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        for key in evicted:
+            self._path(key).unlink(missing_ok=True)
+
+    def _evict(self):
+        total = self.size()
+        if total <= self.max_bytes:
+            return []
+        # Evict down to 90% of the size, so that the next writes do not evict again
+        evicted = []
+        for key, size in self.conn.execute('SELECT key, size FROM entries ORDER BY accessed'):
+            if total <= self.max_bytes * 0.9:
+                break
+            evicted.append(key)
+            total -= size
+        self.conn.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in evicted])
+        self.conn.execute('UPDATE usage SET total = ?', (total,))
+        get_metrics().inc('content_cache_evicted', len(evicted))
+        return evicted
+
+    def size(self):
+        """
+        This function returns the total size of the entries.
+        :return: bytes
+        """
+        return self.conn.execute('SELECT total FROM usage').fetchone()[0]
+
+    def get_image(self, kind, key):
+        """
+        This function returns an image stored with put_image.
+        :return: image or None on a miss
+        """
+        import cv2
+        import numpy as np
+        data = self.get_bytes(kind, key)
+        if data is None:
+            return None
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+
+    def put_image(self, kind, key, img):
+        """
+        This function stores an image losslessly, so that the crops of a cached page hash to the same keys
+        as the crops of the rendered page.
+        :return:
+        """
+        if not self.enabled:
+            return
+        import cv2
+        ok, encoded = cv2.imencode('.png', img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if ok:
+            self.put_bytes(kind, key, encoded.tobytes())
+
+    def get_json(self, kind, key):
+        """
+        This function returns a value stored with put_json.
+        :return: value or None on a miss
+        """
+        data = self.get_bytes(kind, key)
+        return None if data is None else json.loads(data.decode('utf-8'))
+
+    def put_json(self, kind, key, value):
+        """
+        This function stores a JSON serializable value.
+        :return:
+        """
+        if self.enabled:
+            self.put_bytes(kind, key, json.dumps(value).encode('utf-8'))
+
+    def stats(self):
+        """
+        This function returns the number and the size of the entries of every kind.
+        :return: dictionary {kind: (entries, bytes)}
+        """
+        with self.lock:
+            return {kind: (count, size) for kind, count, size in
+                    self.conn.execute('SELECT kind, COUNT(*), SUM(size) FROM entries GROUP BY kind')}
+
+    def clear(self):
+        """
+        This function removes all the entries.
+        :return:
+        """
+        with self.lock:
+            keys = [row[0] for row in self.conn.execute('SELECT key FROM entries')]
+            self.conn.execute('DELETE FROM entries')
+            self.conn.execute('UPDATE usage SET total = 0')
+            for key in keys:
+                self._path(key).unlink(missing_ok=True)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+from pathlib import Path
+
+from metrics import get_metrics
+from workspace import write_text_atomic
+
+DOCUMENT_API_URL = 'https://document-api.companieshouse.gov.uk'
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DocumentDownloader:
+    """
+    Downloads documents from the Companies House document API in-process. The request to the content
+    endpoint goes through the pooled, rate limited client and the redirect to the storage bucket is
+    followed natively (the credentials are dropped on the cross-host redirect). The body is streamed to
+    disk in chunks and verified against the Content-Length header and the PDF signature before it is
+    moved into place.
+    """
+
+    def __init__(self, client, document_api_url=DOCUMENT_API_URL, chunk_size=1 << 16, max_workers=4):
+        self.client = client
+        self.document_api_url = document_api_url.rstrip('/')
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+
+    def download(self, document_id, pdf_path):
+        """
+        This function downloads a document and writes it atomically to pdf_path. A checksum file
+        pdf_path + '.sha256' is written next to it once the download is complete, see write_checksum.
+        :param document_id: id of the document in the document API
+        :param pdf_path: path of the PDF file
+        :return: sha256 hex digest of the document
+        """
+        url = f'{self.document_api_url}/document/{document_id}/content'
+        part_path = pdf_path + '.part'
+        sha256 = hashlib.sha256()
+        n_bytes = 0
+        Path(pdf_path).parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with get_metrics().timer('download'), self.client.get(url, stream=True, auth=(self.client.api_key, ''),
+                                 headers={'Accept': 'application/pdf'}) as response:
+                if response.status_code != 200:
+                    raise DownloadError(f'Document {document_id} returned status {response.status_code}')
+                expected_size = None
+                if 'Content-Encoding' not in response.headers:
+                    expected_size = response.headers.get('Content-Length')
+                with open(part_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        if n_bytes == 0 and not chunk.startswith(b'%PDF'):
+                            raise DownloadError(f'Document {document_id} is not a PDF')
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        n_bytes += len(chunk)
+                    f.flush()
+                    os.fsync(f.fileno())
+            if expected_size is not None and int(expected_size) != n_bytes:
+                raise DownloadError(f'Document {document_id} truncated: {n_bytes} of {expected_size} bytes')
+            os.replace(part_path, pdf_path)
+        finally:
+            # Nothing is left behind by a failed download
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        get_metrics().inc('download_bytes', n_bytes)
+        digest = sha256.hexdigest()
+        write_checksum(pdf_path, digest)
+        return digest
+
+
+def write_checksum(pdf_path, digest):
+    """
+    This function writes the checksum file of a document: a sha256sum line followed by the size and the
+    modification time of the file, so that an unchanged document is not hashed again on the next run.
+    :param pdf_path: path of the PDF file
+    :param digest: sha256 hex digest of the document
+    :return:
+    """
+    stat = Path(pdf_path).stat()
+    write_text_atomic(pdf_path + '.sha256', f'{digest}  {Path(pdf_path).name}\n{stat.st_size} {stat.st_mtime_ns}\n')
+
+
+def is_download_complete(pdf_path):
+    """
+    This function checks that a previously downloaded document is complete and matches its checksum.
+    Documents downloaded before checksums were recorded are accepted if they end with the PDF trailer.
+    The document is only hashed again when its size or modification time differs from the recorded ones;
+    a checksum file without them is rewritten with them once the document matches.
+    :param pdf_path: path of the PDF file
+    :return: bool
+    """
+    if not Path(pdf_path).is_file():
+        return False
+    stat = Path(pdf_path).stat()
+    if not Path(pdf_path + '.sha256').is_file():
+        with open(pdf_path, 'rb') as f:
+            f.seek(max(stat.st_size - 1024, 0))
+            return b'%%EOF' in f.read()
+    with open(pdf_path + '.sha256', 'r') as f:
+        lines = f.read().splitlines()
+    expected = lines[0].split()[0]
+    if len(lines) > 1 and lines[1].split() == [str(stat.st_size), str(stat.st_mtime_ns)]:
+        return True
+    if file_sha256(pdf_path) != expected:
+        return False
+    write_checksum(pdf_path, expected)
+    return True
+
+
+def file_sha256(path):
+    """
+    This function computes the sha256 hex digest of a file.
+    :param path: path of the file
+    :return:
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def document_sha256(pdf_path):
+    """
+    This function returns the sha256 of a downloaded document, from its checksum file when available.
+    :param pdf_path: path of the PDF file
+    :return: hex digest or None if the document does not exist
+    """
+    if Path(pdf_path + '.sha256').is_file():
+        with open(pdf_path + '.sha256', 'r') as f:
+            return f.read().split()[0]
+    if not Path(pdf_path).is_file():
+        return None
+    return file_sha256(pdf_path)
@@ -2,29 +2,31 @@
 import json
 import logging
 import re
-import configparser
 from abc import ABC, abstractmethod
 
-import cv2
-import pandas as pd
-
-from utils import process_currencies_share_price, correct_wrongly_recognized_symbols, get_text_from_image, crop_image
-
-
-config = configparser.ConfigParser()
+from form_layouts import LAYOUTS, LayoutRecognizer, page_pass
+from metrics import get_metrics
+from page_provider import PageProvider
+from page_search import search_pages
+from plausibility import check_values
+from text_layer import load_text_layer
+from settings import get_settings
+from utils import process_currencies_share_price, correct_wrongly_recognized_symbols, ocr_image, crop_image, \
+    clean_detected_text, parse_filing_date
+from workspace import ScratchWorkspace
 
 
 class DocumentProcessorFactory:
     @staticmethod
-    def create_processor(form_type, doc_path):
+    def create_processor(form_type, doc_path, pages=None, recognizer=None):
         if form_type == 'online':
-            return OnlineFormProcessor(doc_path, form_type)
+            return OnlineFormProcessor(doc_path, form_type, pages, recognizer)
         elif form_type == 'online_old':
-            return OnlineOldFormProcessor(doc_path, form_type)
+            return OnlineOldFormProcessor(doc_path, form_type, pages, recognizer)
         elif form_type == 'offline6':
-            return Offline6FormProcessor(doc_path, form_type)
+            return Offline6FormProcessor(doc_path, form_type, pages, recognizer)
         elif form_type == 'offline5':
-            return Offline5FormProcessor(doc_path, form_type)
+            return Offline5FormProcessor(doc_path, form_type, pages, recognizer)
         else:
             raise ValueError(f"Unsupported form type: {form_type}")
 
@@ -34,11 +36,258 @@ class AbstractDocumentProcessor(ABC):
     This class processes a document and extracts the relevant information.
     """
 
-    def __init__(self, doc_path, form_type):
+    def __init__(self, doc_path, form_type, pages=None, recognizer=None):
+        settings = get_settings()
         self.form_type = form_type
         self.doc_path = doc_path
+        self.pages = pages if pages is not None else PageProvider(doc_path, dpi=settings.page_dpi)
+        if recognizer is None and settings.use_layout_ocr and form_type in LAYOUTS:
+            recognizer = LayoutRecognizer(self.pages)
+        self.recognizer = recognizer
         with open(self.doc_path + '/metadata.json', 'r') as f:
-            self.date = pd.to_datetime(json.load(f)['date'])
+            metadata = json.load(f)
+        self.date = parse_filing_date(metadata['date'])
+        self.transaction_id = metadata['transaction_id']
+        # The self link of the filing is /company/<company house id>/filing-history/<transaction id>
+        self_link = metadata.get('links', {}).get('self', '').split('/')
+        self.ch_id = self_link[2] if len(self_link) > 2 and self_link[1] == 'company' else None
+        if 'capital' in metadata['description_values']:
+            self.capital = metadata['description_values']['capital'][0]
+            self.capital['figure'] = float(self.capital['figure'].replace(',', ''))
+        else:
+            self.capital = None
+        self._text_pages = None
+        self._located = {}
+        self._searched = {}
+        self.workspace = ScratchWorkspace(doc_path, debug=settings.debug_crops)
+        self.fx_rate = {}
+
+    def ocr(self, name, img, psm):
+        """
+        This function extracts the text of a crop, keeping the crop in the scratch workspace of the document.
+        :param name: name of the crop
+        :param img: image
+        :param psm: tesseract page segmentation mode
+        :return: post-processed text
+        """
+        self.workspace.put(name, img)
+        detected_text = ocr_image(img, psm)
+        self.workspace.put_text(name, detected_text)
+        return detected_text
+
+    def text_layer_page(self, page):
+        """
+        This function returns the cleaned text of a page from the PDF text layer.
+        :param page: page number
+        :return: text, empty if the text layer is disabled or missing
+        """
+        if not get_settings().use_text_layer:
+            return ''
+        if self._text_pages is None:
+            self._text_pages = [clean_detected_text(t) for t in load_text_layer(self.doc_path)]
+        if page >= len(self._text_pages):
+            return ''
+        return self._text_pages[page]
+
+    def _read_text(self, field, parse, text, page):
+        """
+        This function parses a field from the text of its region, if the pattern of the layout is found in it,
+        and keeps the page as one where the field is located.
+        :return: value or None
+        """
+        if text is None or re.search(LAYOUTS[self.form_type][field].pattern, text) is None:
+            return None
+        located = self._located.setdefault(field, [])
+        if page not in located:
+            located.append(page)
+        try:
+            return parse(text)
+        except (IndexError, ValueError):
+            return None
+
+    def _read_page_pass(self, field, parse, page):
+        layout = LAYOUTS[self.form_type][field]
+        self._searched.setdefault(field, set()).add(page)
+        region, _, _ = page_pass(page, self.form_type, layout.remove_borders)
+        text = self.recognizer.region_text(page, layout.region, layout.psm, layout.remove_borders, region)
+        return self._read_text(field, parse, text, page)
+
+    def _candidate_pages(self, field):
+        return [page for page in LAYOUTS[self.form_type][field].pages if page < self.pages.page_count()]
+
+    def read_field(self, field, parse, fallback=True):
+        """
+        This function reads a field with the layout of the form type. The text of the field region is
+        taken from the text layer if there is one, else from the single OCR pass of its page, shared with
+        the other fields of the page, searching the candidate pages in the learned page order. Only if no
+        valid value is found are the fallback passes of iter_fallback_values run.
+        :param field: name of the field in the layout
+        :param parse: function of the region text returning the value, or None if it is not valid
+        :param fallback: run the fallback passes if no valid value is found, otherwise they are left to the
+         plausibility gate
+        :return: value or None
+        """
+        layout = LAYOUTS[self.form_type][field]
+        metrics = get_metrics()
+        for page in layout.pages:
+            value = self._read_text(field, parse, self.text_layer_page(page), page)
+            if value is not None:
+                metrics.inc('layout_field', form_type=self.form_type, field=field, source='text_layer')
+                return value
+        self._located[field] = []
+        self._searched[field] = set()
+
+        found = search_pages(self._candidate_pages(field), lambda page: self._read_page_pass(field, parse, page),
+                             lambda value: True, key=f'{self.form_type}_{field}', max_workers=1)
+        if found is not None:
+            metrics.inc('layout_field', form_type=self.form_type, field=field, source='page_pass')
+            return found[1]
+
+        if fallback:
+            for value, source in self.iter_fallback_values(field, parse):
+                metrics.inc('layout_field', form_type=self.form_type, field=field, source=source)
+                return value
+        metrics.inc('layout_field', form_type=self.form_type, field=field, source='missing')
+        return None
+
+    def iter_fallback_values(self, field, parse):
+        """
+        This function reads a field again with passes more expensive than the first read, cheapest first:
+        the page passes of the candidate pages not searched yet, then the field crop OCRed on its own with the
+        page segmentation modes of the layout on the pages where the field was located, then the field crop
+        of these pages rendered at FallbackDpi, if their PDF can be rendered finer. The passes only run as the
+        values are consumed, so that the caller stops them at the first plausible value.
+        :param field: name of the field in the layout
+        :param parse: function of the region text returning the value, or None if it is not valid
+        :return: generator of (value, source of the value), every value once
+        """
+        layout = LAYOUTS[self.form_type][field]
+        candidates = self._candidate_pages(field)
+        seen = []
+
+        def new(value):
+            if value is None or value in seen:
+                return False
+            seen.append(value)
+            return True
+
+        searched = self._searched.setdefault(field, set())
+        for page in candidates:
+            if page not in searched:
+                value = self._read_page_pass(field, parse, page)
+                if new(value):
+                    yield value, 'more_pages'
+
+        # A field of a single page is OCRed again even if its pattern was not recognized in the page pass
+        located = list(self._located.get(field) or [])
+        if not located and len(candidates) == 1:
+            located = candidates
+        for page in located:
+            for psm in (layout.psm,) + layout.fallback_psms:
+                text = self.recognizer.region_text(page, layout.region, psm, layout.remove_borders, reuse=False)
+                value = self._read_text(field, parse, text, page)
+                if new(value):
+                    yield value, 're_ocr'
+
+        fallback_dpi = get_settings().fallback_dpi
+        for page in located:
+            if fallback_dpi > self.pages.dpi and self.pages.source_dpi(page) is None:
+                text = self.recognizer.region_text(page, layout.region, layout.psm, layout.remove_borders,
+                                                   reuse=False, dpi=fallback_dpi)
+                value = self._read_text(field, parse, text, page)
+                if new(value):
+                    yield value, 're_crop_dpi'
+
+    def check_plausibility(self, share_price, n_allotted, total_shares):
+        """
+        This function checks the values of the document, see plausibility.check_values. The share price is
+        compared to the nominal value only if both are in pounds.
+        :return: list of (check, fields), empty if the values are plausible
+        """
+        price_in_capital_currency = self.capital is not None and self.capital.get('currency') == 'GBP' and \
+            not self.fx_rate
+        return check_values(share_price, n_allotted, total_shares, self.capital, price_in_capital_currency)
+
+    def apply_plausibility_gate(self, values):
+        """
+        This function accepts the values read from the text layer and the page passes if they are plausible.
+        Otherwise the fallback passes of the fields that failed a check are run until a value passes the
+        checks of its field. A missing value is replaced by the first value of the fallback passes even if
+        it is not plausible, and implausible values are kept if no fallback value is better.
+        :param values: dictionary with share_price, n_allotted and total_shares
+        :return: (values, failed checks of the values)
+        """
+        metrics = get_metrics()
+        failed = self.check_plausibility(**values)
+        if not failed:
+            metrics.inc('plausibility', form_type=self.form_type, outcome='accepted')
+            return values, failed
+        for check, _ in failed:
+            metrics.inc('plausibility_failed', form_type=self.form_type, check=check)
+
+        def implicates(checks, names):
+            return any(name in fields for _, fields in checks for name in names)
+
+        def parse_share_price_n_allotted(text):
+            # Every value read records the exchange rate of its own currency, if any
+            self.fx_rate.clear()
+            return self.parse_share_price_n_allotted_field(text)
+
+        fx_rate = dict(self.fx_rate)
+        for field, parse, names in (('total_shares', self.parse_total_shares_field, ('total_shares',)),
+                                    ('share_price_n_allotted', parse_share_price_n_allotted,
+                                     ('share_price', 'n_allotted'))):
+            if not implicates(failed, names):
+                continue
+            missing = any(values[name] is None for name in names)
+            for value, source in self.iter_fallback_values(field, parse):
+                trial = dict(values, **dict(zip(names, value if len(names) > 1 else (value,))))
+                trial_failed = self.check_plausibility(**trial)
+                plausible = not implicates(trial_failed, names)
+                if plausible or missing:
+                    metrics.inc('layout_field', form_type=self.form_type, field=field, source=source)
+                    values, failed, missing = trial, trial_failed, False
+                    fx_rate = dict(self.fx_rate)
+                if plausible:
+                    break
+            # Keep the exchange rate of the value kept, not of the last value read
+            self.fx_rate.clear()
+            self.fx_rate.update(fx_rate)
+        metrics.inc('plausibility', form_type=self.form_type, outcome='implausible' if failed else 'fallback')
+        return values, failed
+
+    def parse_share_price_n_allotted_field(self, text):
+        """
+        This function parses and validates the share price and number of shares allotted from the text of
+        their region.
+        :param text: cleaned text
+        :return: (share price, number allotted) or None if they are not valid
+        """
+        share_price, n_allotted = self.parse_share_price_n_allotted(text)
+        if share_price is None or n_allotted is None or share_price < 0 or n_allotted <= 0:
+            return None
+        return share_price, n_allotted
+
+    def parse_total_shares_field(self, text):
+        """
+        This function parses and validates the total number of shares from the text of its region.
+        :param text: cleaned text
+        :return: total number of shares or None if it is not valid
+        """
+        return self.total_shares_value(self.parse_total_shares(text))
+
+    @staticmethod
+    def total_shares_value(total_shares):
+        """
+        This function converts the total number of shares parsed from a document, a number or a text depending
+        on the form type, to a float, so that the results of every form type and reading have the same type.
+        :param total_shares: number, text or None
+        :return: total number of shares or None if it is not positive
+        """
+        if total_shares is None:
+            return None
+        total_shares = float(total_shares)
+        return total_shares if total_shares > 0 else None
 
     @abstractmethod
     def extract_share_price_n_allotted(self) -> (float, float):
@@ -61,18 +310,52 @@ class AbstractDocumentProcessor(ABC):
         This function parses the document and extracts the relevant information.
         :return: dictionary with the extracted information
         """
+        metrics = get_metrics()
+        outcomes = {}
+        use_layout = self.recognizer is not None
+        # With the plausibility gate, the fallback passes of a field only run if the values are implausible
+        gate = use_layout and get_settings().plausibility_gate
         try:
-            share_price, n_allotted = self.extract_share_price_n_allotted()
+            with metrics.timer('extract', form_type=self.form_type, field='share_price_n_allotted'):
+                if use_layout:
+                    share_price, n_allotted = self.read_field(
+                        'share_price_n_allotted', self.parse_share_price_n_allotted_field,
+                        fallback=not gate) or (None, None)
+                else:
+                    share_price, n_allotted = self.extract_share_price_n_allotted()
         except Exception as e:
             share_price, n_allotted = None, None
+            outcomes['share_price'] = outcomes['n_allotted'] = 'error'
             logging.error(
                 f'Error in extracting share price and number of shares at path: {self.doc_path}. Error: {e}')
         try:
-            total_shares = self.extract_total_shares()
+            with metrics.timer('extract', form_type=self.form_type, field='total_shares'):
+                if use_layout:
+                    total_shares = self.read_field('total_shares', self.parse_total_shares_field, fallback=not gate)
+                else:
+                    total_shares = self.total_shares_value(self.extract_total_shares())
         except Exception as e:
             total_shares = None
+            outcomes['total_shares'] = 'error'
             logging.error(f'Error in extracting total shares at path: {self.doc_path}. Error: {e}')
 
+        values = {'share_price': share_price, 'n_allotted': n_allotted, 'total_shares': total_shares}
+        failed = None
+        try:
+            with metrics.timer('extract', form_type=self.form_type, field='plausibility'):
+                if gate:
+                    values, failed = self.apply_plausibility_gate(values)
+                else:
+                    failed = self.check_plausibility(**values)
+                    metrics.inc('plausibility', form_type=self.form_type,
+                                outcome='implausible' if failed else 'accepted')
+        except Exception as e:
+            logging.error(f'Error in checking the plausibility at path: {self.doc_path}. Error: {e}')
+        share_price, n_allotted, total_shares = values['share_price'], values['n_allotted'], values['total_shares']
+        for field, value in values.items():
+            outcome = outcomes.get(field, 'missing' if value is None else 'ok')
+            metrics.inc('field_extracted', form_type=self.form_type, field=field, outcome=outcome)
+
         if n_allotted is not None and total_shares is not None and share_price is not None:
             fundraising = n_allotted * share_price
             valuation = total_shares * share_price
@@ -85,15 +368,6 @@ class AbstractDocumentProcessor(ABC):
             valuation = None
             equity = None
 
-        with open(self.doc_path + '/metadata.json', 'r') as f:
-            metadata = json.load(f)
-            if 'capital' in metadata['description_values']:
-                capital = metadata['description_values']['capital'][0]
-                capital['figure'] = float(capital['figure'].replace(',', ''))
-            else:
-                capital = None
-            transaction_id = metadata['transaction_id']
-
         d = {
             'date': self.date.strftime("%Y-%m-%d"),
             'form_type': self.form_type,
@@ -103,52 +377,80 @@ class AbstractDocumentProcessor(ABC):
             'fundraising': fundraising,
             'valuation': valuation,
             'equity': equity,
-            'capital': capital,
-            'transaction_id': transaction_id
+            'capital': self.capital,
+            'fx_rate': self.fx_rate or None,
+            'transaction_id': self.transaction_id,
+            'implausible': None if failed is None else [check for check, _ in failed]
         }
         return d
 
 
 class Offline5FormProcessor(AbstractDocumentProcessor):
-    def extract_share_price_n_allotted(self) -> (float, float):
+    @staticmethod
+    def parse_share_line(detected_text):
         """
-        This function extracts the share price and number of shares allotted from an offline form 6.
-        :return:
+        This function parses the line of the allotted shares in the table of an offline form.
+        :param detected_text:
+        :return: (share price text with its currency, number of shares allotted) or None if there is no line
         """
-        img = cv2.imread(self.doc_path + 'pages/0.jpeg')
-        crop_image(img, self.doc_path + 'pages/{}.jpg'.format('0cropped'), 50, 90, remove_borders=True)
-
-        detected_text = get_text_from_image(self.doc_path, '0cropped', 6)
-        detected_text = detected_text.split('currency')[1]
         reg = re.search(r"(\d(\n)?\s?\.?£?\$?€?(\n)?){6}", detected_text)
-
-        # If the regex does not match, try different tesseract psm
         if reg is None:
-            detected_text = get_text_from_image(self.doc_path, '0cropped', 11)
-            reg = re.search(r"(\d(\n)?\s?\.?£?\$?€?(\n)?){6}", detected_text)
-            if reg is None:
-                return None, None
+            return None
 
         table_line = detected_text[reg.span()[0]:].replace('|', ' ').replace('\\', '')
 
         price_share = correct_wrongly_recognized_symbols(table_line.split()[2])
         n_allotted = correct_wrongly_recognized_symbols(table_line.split()[0])
 
-        n_allotted = float(n_allotted)
+        return price_share, float(n_allotted)
+
+    def parse_share_price_n_allotted(self, detected_text):
+        """
+        This function parses the share price in GBP and number of shares allotted from the text of the
+        table of allotted shares.
+        :param detected_text:
+        :return: (share price, number allotted) or (None, None)
+        """
+        # The table follows the first mention of the currency, in the instructions above it
+        if 'currency' in detected_text:
+            detected_text = detected_text.split('currency', 1)[1]
+        share_line = self.parse_share_line(detected_text)
+        if share_line is None:
+            return None, None
+        return process_currencies_share_price(share_line[0], self.date, self.fx_rate), share_line[1]
+
+    def extract_share_price_n_allotted(self) -> (float, float):
+        """
+        This function extracts the share price and number of shares allotted from an offline form 6.
+        :return:
+        """
+        img = self.pages.page(0)
+        crop = crop_image(img, x0=50, x1=90, remove_borders=True, dpi=self.pages.dpi)
+
+        detected_text = self.ocr('0cropped', crop, 6)
+        share_line = self.parse_share_line(detected_text.split('currency')[1])
+
+        # If the regex does not match, try different tesseract psm
+        if share_line is None:
+            get_metrics().inc('ocr_psm_fallback', form_type=self.form_type, psm=11)
+            detected_text = self.ocr('0cropped', crop, 11)
+            share_line = self.parse_share_line(detected_text)
+            if share_line is None:
+                get_metrics().inc('ocr_psm_fallback_failed', form_type=self.form_type, psm=11)
+                return None, None
 
-        price_share = process_currencies_share_price(price_share, self.date)
+        price_share, n_allotted = share_line
+        price_share = process_currencies_share_price(price_share, self.date, self.fx_rate)
 
         return price_share, n_allotted
 
-    def extract_total_shares(self) -> float | None:
+    @staticmethod
+    def parse_total_shares(detected_text):
         """
-        This function extracts the total number of shares from an offline form 5.
-        :return:
+        This function parses the total number of shares from the statement of capital of an offline form 5.
+        :param detected_text:
+        :return: total number of shares or None
         """
-        page_file = self.doc_path + 'pages/{}.jpeg'.format(1)
-        img = cv2.imread(page_file)
-        crop_image(img, self.doc_path + 'pages/{}.jpg'.format('2cropped'), x1=50)
-        detected_text = get_text_from_image(self.doc_path, '2cropped', 4)
         reg = re.search('totals\s?\|?\s?\d\d', detected_text)
         if reg is None:
             logging.error('Error in extracting total shares:{}'.format(detected_text))
@@ -161,47 +463,62 @@ class Offline5FormProcessor(AbstractDocumentProcessor):
             logging.error('Error in extracting total shares:{}'.format(table_line))
             return None
 
+    def extract_total_shares(self) -> float | None:
+        """
+        This function extracts the total number of shares from an offline form 5.
+        :return:
+        """
+        img = self.pages.page(1)
+        crop = crop_image(img, x1=50)
+        return self.parse_total_shares(self.ocr('2cropped', crop, 4))
+
 
 class Offline6FormProcessor(Offline5FormProcessor):
+    @staticmethod
+    def parse_total_shares(detected_text):
+        """
+        This function parses the total number of shares from the statement of capital of an offline form 6.
+        :param detected_text:
+        :return: total number of shares or None if the page does not contain the totals
+        """
+        if 'ist total aggregate' not in detected_text:
+            return None
+        reg = re.search(r"(\d(\n)?\s?\.?£?\$?€?(\n)?){6}", detected_text)
+        if reg is None:
+            return None
+        table_line = detected_text[reg.span()[0]:].replace('|', ' ')
+        total_sh = table_line.split()[0]
+        return total_sh
+
     def extract_total_shares(self) -> float | None:
         """
         This function extracts the total number of shares from an offline form 6.
         :return:
         """
 
-        def extract_from_text(text):
-            if 'ist total aggregate' not in text:
-                return None
-            reg = re.search(r"(\d(\n)?\s?\.?£?\$?€?(\n)?){6}", text)
-            if reg is None:
+        def extract_from_page(page):
+            img = self.pages.page(page)
+            if img is None:
                 return None
-            table_line = text[reg.span()[0]:].replace('|', ' ')
-            total_sh = table_line.split()[0]
-            return total_sh
-
-        for page in range(1, 4):
-            page_file = self.doc_path + 'pages/{}.jpeg'.format(page)
-            img = cv2.imread(page_file)
-            crop_image(img, self.doc_path + 'pages/{}.jpg'.format('2cropped'), x0=50, x1=90, remove_borders=True)
-        detected_text = get_text_from_image(self.doc_path, '2cropped', 4)
-        total_shares = extract_from_text(detected_text)
-        if total_shares is not None:
-            return total_shares
-        return None
+            crop = crop_image(img, x0=50, x1=90, remove_borders=True, dpi=self.pages.dpi)
+            return self.parse_total_shares(self.ocr('{}cropped'.format(page), crop, 4))
+
+        found = search_pages(range(1, 4), extract_from_page, lambda total_sh: True,
+                             key=self.form_type + '_total_shares')
+        if found is None:
+            return None
+        return found[1]
 
 
 class OnlineOldFormProcessor(AbstractDocumentProcessor):
 
-    def extract_share_price_n_allotted(self):
+    @staticmethod
+    def parse_share_price_n_allotted(detected_text):
         """
-        This function extracts the share price and number of shares allotted from an online form.
+        This function parses the share price and number of shares allotted from the text of the first page.
+        :param detected_text:
         :return:
         """
-
-        img = cv2.imread(self.doc_path + 'pages/0.jpeg')
-        crop_image(img, self.doc_path + 'pages/0cropped.jpg', 39, 90)
-        detected_text = get_text_from_image(self.doc_path, '0cropped', 6)
-
         if 'amount paid' not in detected_text.lower():
             return None, None
 
@@ -216,57 +533,112 @@ class OnlineOldFormProcessor(AbstractDocumentProcessor):
 
         return float(price_share), float(n_allotted)
 
+    def extract_share_price_n_allotted(self):
+        """
+        This function extracts the share price and number of shares allotted from an online form.
+        The text layer of the PDF is used if it is valid, otherwise the first page is OCRed.
+        :return:
+        """
+        try:
+            share_price, n_allotted = self.parse_share_price_n_allotted(self.text_layer_page(0))
+            if share_price is not None:
+                return share_price, n_allotted
+        except (IndexError, ValueError):
+            pass
+
+        img = self.pages.page(0)
+        crop = crop_image(img, x0=39, x1=90)
+        detected_text = self.ocr('0cropped', crop, 6)
+        return self.parse_share_price_n_allotted(detected_text)
+
+    @staticmethod
+    def parse_total_shares(detected_text):
+        """
+        This function parses the total number of shares from the text of a page.
+        :param detected_text:
+        :return: total number of shares or None if the page does not contain the totals
+        """
+        if 'statement of capital (totals)' not in detected_text.lower():
+            return None
+        try:
+            total_shares = (
+                detected_text.lower().split('total number')[1].split('of shares')[0].replace(
+                    ':', '').replace('/', '7').replace(
+                    '§', '5').replace(' ', '').replace(
+                    "'", '').replace('\n', ' '))
+        except IndexError:
+            logging.error('Error in extracting total shares')
+            return None
+        return total_shares
+
     def extract_total_shares(self):
         """
         This function extracts the total number of shares from an online old form.
         :return:
         """
-
         for page in range(1, 10):
-            page_file = self.doc_path + 'pages/{}.jpeg'.format(page)
-            img = cv2.imread(page_file)
+            total_shares = self.parse_total_shares(self.text_layer_page(page))
+            if total_shares is not None:
+                try:
+                    float(total_shares)
+                    return total_shares
+                except ValueError:
+                    break
+
+        def extract_from_page(page):
+            img = self.pages.page(page)
             if img is None:
-                continue
-            crop_image(img, self.doc_path + 'pages/2cropped.jpg', remove_borders=False)
-            detected_text = get_text_from_image(self.doc_path, '2cropped', 4)
+                return ''
+            crop = crop_image(img, remove_borders=False)
+            return self.ocr('{}cropped'.format(page), crop, 4)
 
-            if 'statement of capital (totals)' not in detected_text.lower():
-                continue
-            try:
-                total_shares = (
-                    detected_text.lower().split('total number')[1].split('of shares')[0].replace(
-                        ':', '').replace('/', '7').replace(
-                        '§', '5').replace(' ', '').replace(
-                        "'", '').replace('\n', ' '))
-            except IndexError:
-                logging.error('Error in extracting total shares')
-                return None
-            return total_shares
+        found = search_pages(range(1, min(self.pages.page_count(), 10)), extract_from_page,
+                             lambda text: 'statement of capital (totals)' in text.lower(),
+                             key=self.form_type + '_total_shares')
+        if found is None:
+            return None
+        return self.parse_total_shares(found[1])
 
 
 class OnlineFormProcessor(OnlineOldFormProcessor):
 
+    @staticmethod
+    def parse_total_shares(detected_text):
+        """
+        This function parses the total number of shares from the text of a page.
+        :param detected_text:
+        :return: total number of shares or None if the page does not contain the totals
+        """
+        if 'total number of shares' not in detected_text.lower():
+            return None
+        total_shares = correct_wrongly_recognized_symbols(
+            detected_text.lower().split('total number of shares')[1].split('\n')[0])
+        return int(total_shares)
+
     def extract_total_shares(self) -> int | None:
         """
         This function extracts the total number of shares from an online form.
         :return:
         """
+        for page in range(2, 10):
+            try:
+                total_shares = self.parse_total_shares(self.text_layer_page(page))
+            except ValueError:
+                break
+            if total_shares is not None:
+                return total_shares
 
-        def extract_from_text(page_number, doc_path):
-            page_file = doc_path + 'pages/{}.jpeg'.format(page_number)
-            img = cv2.imread(page_file)
+        def extract_from_text(page_number):
+            img = self.pages.page(page_number)
             if img is None:
                 return ''
-            crop_image(img, doc_path + 'pages/2cropped.jpg', x0=0, x1=50, remove_borders=False)
-            text = get_text_from_image(doc_path, '2cropped', 6)
+            crop = crop_image(img, x0=0, x1=50, remove_borders=False)
+            text = self.ocr('{}cropped'.format(page_number), crop, 6)
             return text
 
-        for page in range(2, 10):
-            detected_text = extract_from_text(page, self.doc_path)
-            if 'total number of shares' in detected_text.lower():
-                break
-        if 'total number of shares' not in detected_text.lower():
+        found = search_pages(range(2, min(self.pages.page_count(), 10)), extract_from_text,
+                             lambda text: 'total number of shares' in text.lower(),
+                             key=self.form_type + '_total_shares')
+        if found is None:
             return None
-        total_shares = correct_wrongly_recognized_symbols(
-            detected_text.lower().split('total number of shares')[1].split('\n')[0])
-        return int(total_shares)
+        return self.parse_total_shares(found[1])
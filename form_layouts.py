@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import namedtuple
+
+from utils import crop_image, clean_detected_text, ocr_image_words
+
+# Regions are (x0, x1, y0, y1) in percentages of the page height (x) and width (y), as in utils.crop_image.
+# pages are the candidate pages, searched in the learned page order when there are several. pattern must
+# be found in the text of the region before it is parsed. fallback_psms are the page segmentation modes of
+# the targeted re-OCR of the field crop when the value read from the page pass is missing or implausible.
+FieldLayout = namedtuple('FieldLayout', ['pages', 'region', 'psm', 'remove_borders', 'pattern', 'fallback_psms'])
+
+FOOTER_REGION = (80, 100, 0, 100)
+FOOTER_PSM = 6
+
+_OFFLINE_SHARE_PRICE_N_ALLOTTED = FieldLayout((0,), (50, 90, 0, 100), 6, True, r'currency', (11,))
+_ONLINE_SHARE_PRICE_N_ALLOTTED = FieldLayout((0,), (39, 90, 0, 100), 6, False, r'amount paid', ())
+
+LAYOUTS = {
+    'offline5': {
+        'share_price_n_allotted': _OFFLINE_SHARE_PRICE_N_ALLOTTED,
+        'total_shares': FieldLayout((1,), (0, 50, 0, 100), 4, False, r'totals\s?\|?\s?\d\d', (6,)),
+    },
+    'offline6': {
+        'share_price_n_allotted': _OFFLINE_SHARE_PRICE_N_ALLOTTED,
+        'total_shares': FieldLayout((1, 2, 3), (50, 90, 0, 100), 4, True, r'ist total aggregate', (6,)),
+    },
+    'online_old': {
+        'share_price_n_allotted': _ONLINE_SHARE_PRICE_N_ALLOTTED,
+        'total_shares': FieldLayout(tuple(range(1, 10)), (0, 100, 0, 100), 4, False,
+                                    r'statement of capital \(totals\)', ()),
+    },
+    'online': {
+        'share_price_n_allotted': _ONLINE_SHARE_PRICE_N_ALLOTTED,
+        'total_shares': FieldLayout(tuple(range(2, 10)), (0, 50, 0, 100), 6, False, r'total number of shares', (4,)),
+    },
+}
+
+
+def _union(regions):
+    return (min(r[0] for r in regions), max(r[1] for r in regions),
+            min(r[2] for r in regions), max(r[3] for r in regions))
+
+
+def page_pass(page, form_type=None, remove_borders=False):
+    """
+    This function returns the region and page segmentation mode of the single OCR pass of a page for the
+    fields read with or without table border removal: the union of the regions of these fields of the form
+    type found on the page. A pass only serves fields with the same border removal, since removing the borders
+    of a table also removes the strokes of the text touching them. If the form type is not known yet, the pass
+    of the first page without border removal also covers the footer, so that the form type and the fields of
+    every form type read without border removal are read from the same recognition.
+    :param page: page number
+    :param form_type: form type or None if it is not known yet
+    :param remove_borders: border removal of the fields
+    :return: (region, psm, remove_borders) or None if no such field is on the page
+    """
+    if form_type is None:
+        fields = [layout['share_price_n_allotted'] for layout in LAYOUTS.values()] if page == 0 else []
+        regions = [f.region for f in fields if f.remove_borders == remove_borders]
+        if not remove_borders:
+            regions.append(FOOTER_REGION)
+        if not regions:
+            return None
+        return _union(regions), FOOTER_PSM, remove_borders
+    fields = [f for f in LAYOUTS[form_type].values() if page in f.pages and f.remove_borders == remove_borders]
+    if not fields:
+        return None
+    return _union([f.region for f in fields]), fields[0].psm, remove_borders
+
+
+def _contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] >= inner[1] and outer[2] <= inner[2] and outer[3] >= inner[3]
+
+
+class LayoutRecognizer:
+    """
+    This class OCRs regions of the pages of a document with word-level boxes and keeps the recognized words,
+    so that the text of any region inside a recognized one is read without another OCR call. The form type
+    detection and the document processor share the recognizer of a document.
+    """
+
+    def __init__(self, pages, dpi_hint=92):
+        self.pages = pages
+        self.dpi_hint = dpi_hint
+        self.passes = {}
+        self.n_ocr_calls = 0
+        self.lock = threading.Lock()
+
+    def recognize(self, page, region, psm, remove_borders=False, dpi=None):
+        """
+        This function OCRs a region of a page, once.
+        :param page: page number
+        :param region: (x0, x1, y0, y1) in percentages of the page
+        :param psm: tesseract page segmentation mode
+        :param remove_borders: remove the table borders before the OCR
+        :param dpi: resolution of the page, defaults to the resolution of the page provider. A page at another
+         resolution is not kept by the page provider
+        :return: list of (word, center x, center y) with the centers in percentages of the page, None if the
+         document has fewer pages
+        """
+        key = (page, tuple(region), psm, remove_borders, dpi)
+        with self.lock:
+            if key in self.passes:
+                return self.passes[key]
+        img = self.pages.page(page, dpi, keep=dpi is None)
+        if img is None:
+            return None
+        x0, x1, y0, y1 = region
+        crop = crop_image(img, x0=x0, x1=x1, y0=y0, y1=y1, remove_borders=remove_borders,
+                          dpi=dpi or self.pages.dpi)
+        top = x0 * img.shape[0] // 100
+        left = y0 * img.shape[1] // 100
+        words = [(word, 100 * (top + word.top + word.height / 2) / img.shape[0],
+                  100 * (left + word.left + word.width / 2) / img.shape[1])
+                 for word in ocr_image_words(crop, psm, self.dpi_hint)]
+        with self.lock:
+            self.n_ocr_calls += 1
+            self.passes[key] = words
+        return words
+
+    def find_pass(self, page, region, psm, remove_borders=False):
+        """
+        This function returns the key of a recognized pass of the page that covers the region with the same
+        page segmentation mode and border removal, at the resolution of the page provider.
+        :return: key of the pass or None
+        """
+        with self.lock:
+            for key in self.passes:
+                if key[0] == page and key[2] == psm and key[3] == remove_borders and key[4] is None and \
+                        _contains(key[1], region):
+                    return key
+        return None
+
+    def region_text(self, page, region, psm, remove_borders=False, pass_region=None, reuse=True, clean=True,
+                    dpi=None):
+        """
+        This function returns the text of the words of a region, read from a pass of the page that covers it
+        or else from a new pass over pass_region.
+        :param page: page number
+        :param region: (x0, x1, y0, y1) in percentages of the page
+        :param psm: tesseract page segmentation mode
+        :param remove_borders: remove the table borders, only passes with the same border removal are reused
+        :param pass_region: region of the new pass, defaults to the region
+        :param reuse: read the words from any pass covering the region, otherwise only from the pass over
+         pass_region with these settings, e.g. to OCR a field crop alone again
+        :param clean: post-process the text with clean_detected_text
+        :param dpi: resolution of a new pass, e.g. to crop a field again from a finer rendering of the page.
+         Passes at another resolution than the one of the page provider are not reused
+        :return: text or None if the document has fewer pages
+        """
+        key = self.find_pass(page, region, psm, remove_borders) if reuse and dpi is None else None
+        if key is not None:
+            words = self.passes[key]
+        else:
+            words = self.recognize(page, pass_region or region, psm, remove_borders, dpi)
+        if words is None:
+            return None
+        x0, x1, y0, y1 = region
+        selected = sorted((w.block, w.par, w.line, w.word, w.text) for w, x, y in words
+                          if x0 <= x <= x1 and y0 <= y <= y1)
+        lines = []
+        previous_line = None
+        for block, par, line, _, text in selected:
+            if (block, par, line) != previous_line:
+                lines.append([])
+                previous_line = (block, par, line)
+            lines[-1].append(text)
+        text = '\n'.join(' '.join(line) for line in lines)
+        return clean_detected_text(text) if clean else text
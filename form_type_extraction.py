@@ -1,10 +1,18 @@
 import json
-import subprocess
+import threading
+import time
 from pathlib import Path
-import cv2
-import pandas as pd
 from datetime import datetime
 
+from document_downloader import document_sha256
+from form_layouts import FOOTER_REGION, page_pass
+from metrics import get_metrics
+from text_layer import load_text_layer
+from page_provider import PageProvider
+from settings import get_settings, on_configure
+from utils import open_sqlite, recognize_text, parse_filing_date
+from workspace import ScratchWorkspace, write_text_atomic
+
 
 def determine_form_type_from_text(text, filing_date=None):
     """
@@ -28,34 +36,163 @@ def determine_form_type_from_text(text, filing_date=None):
     return 'unknown'
 
 
-def determine_form_type(doc_path, filing_date):
+class FormTypeCache:
     """
-    This function determines the type of form based on the text extracted from the document.
-    :return:
+    Persistent cache of the form types, keyed by transaction id and hash of the PDF.
     """
 
-    with open(doc_path + '/metadata.json', 'r') as f:
-        filing_date = pd.to_datetime(json.load(f)['date'])
+    def __init__(self, db_path):
+        self.conn = open_sqlite(db_path)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS form_types (
+                    transaction_id TEXT NOT NULL,
+                    pdf_sha256 TEXT NOT NULL,
+                    form_type TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    PRIMARY KEY (transaction_id, pdf_sha256)
+                )
+            ''')
 
-    if Path(doc_path + 'pages/form_type.txt').is_file():
-        with open(doc_path + 'pages/form_type.txt', 'r') as f:
-            detected_text = f.read()
+    def get(self, transaction_id, pdf_sha256):
+        with self.lock:
+            row = self.conn.execute('SELECT form_type FROM form_types WHERE transaction_id = ? AND pdf_sha256 = ?',
+                                    (transaction_id, pdf_sha256)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, transaction_id, pdf_sha256, form_type, stage):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO form_types VALUES (?, ?, ?, ?)',
+                              (transaction_id, pdf_sha256, form_type, stage))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_form_type_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            config = get_settings()
+            _cache = FormTypeCache(config.get('parsing', 'FormTypeCachePath',
+                                              fallback=config.work_directory + '/form_types.sqlite'))
+        return _cache
+
+
+@on_configure
+def _reset_form_type_cache():
+    global _cache
+    with _cache_lock:
+        _cache = None
+
+
+def ocr_footers(doc_path, pages, filing_date, dpi):
+    """
+    This function OCRs the bottom 20% of the first three pages until the form type is recognized.
+    :return: form type
+    """
+    workspace = ScratchWorkspace(doc_path, debug=get_settings().debug_crops)
+    form_type = 'unknown'
+    for page in range(3):
+        # The pages at the resolutions of the footer OCR are not used by the processors
+        crop_img = pages.region(page, x0=80, dpi=dpi, keep=False)
+        if crop_img is None:
+            continue
+        workspace.put('formtype', crop_img)
+        detected_text = recognize_text(crop_img, 6)
         form_type = determine_form_type_from_text(detected_text, filing_date)
         if form_type != 'unknown':
+            write_text_atomic(doc_path + 'pages/form_type.txt', detected_text)
             return form_type
+    return form_type
+
 
+def read_footers(doc_path, recognizer, filing_date):
+    """
+    This function reads the footers of the first three pages from the OCR passes of the layout recognizer
+    until the form type is recognized. The pass of the first page also covers the fields of every form type
+    read without table border removal, so that the processor reads them without another OCR call.
+    :return: form type
+    """
     for page in range(3):
-        img = cv2.imread(doc_path + 'pages/{}.jpeg'.format(page))
-        if img is None:
+        region, psm, remove_borders = page_pass(page)
+        detected_text = recognizer.region_text(page, FOOTER_REGION, psm, remove_borders, region, clean=False)
+        if detected_text is None:
             continue
-        crop_img = img[8 * img.shape[0] // 10:, :]
-        cv2.imwrite(doc_path + 'pages/formtype.jpg', crop_img)
-        tesseract_command = 'tesseract {} {} --psm 6'.format(doc_path + 'pages/formtype.jpg',
-                                                             doc_path + 'pages/form_type')
-        subprocess.call(tesseract_command, shell=True)
+        form_type = determine_form_type_from_text(detected_text, filing_date)
+        if form_type != 'unknown':
+            write_text_atomic(doc_path + 'pages/form_type.txt', detected_text)
+            return form_type
+    return 'unknown'
+
+
+def classify_document(doc_path, pages=None, recognizer=None):
+    """
+    This function determines the type of form of a document with the cheapest stage that can decide it:
+    the persistent cache, the text recognized during a previous run, the text layer of the PDF, the OCR of
+    the page footers at low resolution and finally at full resolution. The creator and producer of a PDF do
+    not tell the form type: the paper forms of every version are scanned by the same software. With a layout
+    recognizer, the footers are first read from the page passes shared with the document processor.
+    :param doc_path: document folder
+    :param pages: PageProvider of the document, shared with the document processor
+    :param recognizer: LayoutRecognizer of the document, shared with the document processor
+    :return: (form type, name of the stage that decided it)
+    """
+    start = time.perf_counter()
+    form_type, stage = _classify_document(doc_path, pages, recognizer)
+    metrics = get_metrics()
+    metrics.observe('classify', time.perf_counter() - start, stage=stage)
+    metrics.inc('form_type_classified', stage=stage, form_type=form_type)
+    return form_type, stage
+
+
+def _classify_document(doc_path, pages, recognizer):
+    with open(doc_path + '/metadata.json', 'r') as f:
+        metadata = json.load(f)
+    filing_date = parse_filing_date(metadata['date'])
+    settings = get_settings()
+    cache = get_form_type_cache()
+    pdf_sha256 = document_sha256(doc_path + 'document.pdf') or ''
+
+    def decide(form_type, stage):
+        if form_type != 'unknown':
+            cache.put(metadata['transaction_id'], pdf_sha256, form_type, stage)
+        return form_type, stage
+
+    form_type = cache.get(metadata['transaction_id'], pdf_sha256)
+    if form_type is not None:
+        return form_type, 'cache'
+
+    if Path(doc_path + 'pages/form_type.txt').is_file():
         with open(doc_path + 'pages/form_type.txt', 'r') as f:
             detected_text = f.read()
         form_type = determine_form_type_from_text(detected_text, filing_date)
         if form_type != 'unknown':
-            return form_type
-    return form_type
+            return decide(form_type, 'form_type_text')
+
+    if settings.use_text_layer:
+        form_type = determine_form_type_from_text('\n'.join(load_text_layer(doc_path)), filing_date)
+        if form_type != 'unknown':
+            return decide(form_type, 'text_layer')
+
+    if pages is None:
+        pages = PageProvider(doc_path)
+    if recognizer is not None:
+        form_type = read_footers(doc_path, recognizer, filing_date)
+        if form_type != 'unknown':
+            return decide(form_type, 'footer_page_pass')
+    form_type = ocr_footers(doc_path, pages, filing_date, settings.form_type_low_dpi)
+    if form_type != 'unknown':
+        return decide(form_type, 'footer_ocr_low_res')
+    return decide(ocr_footers(doc_path, pages, filing_date, settings.form_type_dpi), 'footer_ocr')
+
+
+def determine_form_type(doc_path, filing_date, pages=None):
+    """
+    This function determines the type of form based on the text extracted from the document.
+    :param pages: PageProvider of the document, shared with the document processor
+    :return:
+    """
+    return classify_document(doc_path, pages)[0]
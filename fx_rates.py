@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+import csv
+import datetime
+import threading
+from collections import OrderedDict
+
+import requests
+
+EXCHANGE_RATES_API_URL = 'https://api.exchangeratesapi.io'
+
+
+class FxRateError(Exception):
+    pass
+
+
+class ExchangeRatesApiSource:
+    """
+    Rates from the exchangeratesapi.io API, as GBP per unit of the base currency.
+    """
+    name = 'exchangeratesapi.io'
+
+    def __init__(self, api_url=EXCHANGE_RATES_API_URL, access_key=None, timeout=30):
+        self.api_url = api_url.rstrip('/')
+        self.params = {'access_key': access_key} if access_key else {}
+        self.session = requests.Session()
+        self.timeout = timeout
+
+    def get_rates(self, start, end, base):
+        """
+        This function returns the rates of the business days between start and end.
+        :param start: first date
+        :param end: last date
+        :param base: base currency, e.g. 'USD'
+        :return: dictionary {date: rate}
+        """
+        if start == end:
+            response = self._get(f'{self.api_url}/{start:%Y-%m-%d}', {'base': base, 'symbols': 'GBP'})
+            if 'rates' not in response:
+                raise FxRateError(f'No {base} rate for {start:%Y-%m-%d}: {response}')
+            return {start: response['rates']['GBP']}
+        response = self._get(f'{self.api_url}/history', {'start_at': f'{start:%Y-%m-%d}', 'end_at': f'{end:%Y-%m-%d}',
+                                                         'base': base, 'symbols': 'GBP'})
+        if 'rates' not in response:
+            raise FxRateError(f'No {base} rates between {start:%Y-%m-%d} and {end:%Y-%m-%d}: {response}')
+        return {datetime.date.fromisoformat(d): r['GBP'] for d, r in response['rates'].items()}
+
+    def _get(self, url, params):
+        try:
+            response = self.session.get(url, timeout=self.timeout, params={**params, **self.params})
+            response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, ValueError) as e:
+            # The message of the exception may contain the URL with the access key
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            raise FxRateError(f'Request to {url} failed: {type(e).__name__}'
+                              + (f' (status {status})' if status is not None else '')) from e
+
+
+class CsvRateSource:
+    """
+    Rates from a local CSV file with the columns date, base, rate (GBP per unit of the base currency),
+    for reproducible runs without network.
+    """
+
+    def __init__(self, csv_path):
+        self.name = f'csv:{csv_path}'
+        self.rates = {}
+        with open(csv_path, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                base = row['base'].upper()
+                self.rates.setdefault(base, {})[datetime.date.fromisoformat(row['date'])] = float(row['rate'])
+
+    def get_rates(self, start, end, base):
+        return {d: r for d, r in self.rates.get(base, {}).items() if start <= d <= end}
+
+
+class FxRateProvider:
+    """
+    This class returns exchange rates to GBP by date and base currency. Rates are looked up in an in-memory
+    LRU, then in a persistent SQLite store and only then requested from the source. A miss fetches the whole
+    window of `window_days` around the date in one request, and prefetch loads the range of a batch upfront.
+    Days without a published rate (weekends, holidays) get the rate of the previous business day, as the API
+    does.
+    """
+
+    def __init__(self, conn, source, window_days=31, max_cached=4096):
+        self.conn = conn
+        self.source = source
+        self.window_days = window_days
+        self.max_cached = max_cached
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS fx_rates (
+                    date TEXT NOT NULL,
+                    base TEXT NOT NULL,
+                    rate REAL NOT NULL,
+                    source TEXT NOT NULL,
+                    rate_date TEXT NOT NULL,
+                    PRIMARY KEY (date, base)
+                )
+            ''')
+
+    def _remember(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+
+    def prefetch(self, start, end, bases=('USD', 'EUR')):
+        """
+        This function loads the rates of every day between start and end into the store. The days after the
+        newest published rate are not stored, since their rate may still be published.
+        :param start: first date
+        :param end: last date
+        :param bases: base currencies
+        :return: number of days stored
+        """
+        n_days = 0
+        for base in bases:
+            # Start a week earlier so that the first days of the range have a previous business day
+            rates = self.source.get_rates(start - datetime.timedelta(days=7), end, base)
+            if not rates:
+                continue
+            rows = []
+            day = start
+            known = sorted(rates)
+            idx = -1
+            while day <= min(end, known[-1]):
+                while idx + 1 < len(known) and known[idx + 1] <= day:
+                    idx += 1
+                if idx >= 0:
+                    rate_date = known[idx]
+                    rows.append((day.isoformat(), base, rates[rate_date], self.source.name, rate_date.isoformat()))
+                day += datetime.timedelta(days=1)
+            with self.lock:
+                self.conn.executemany('INSERT OR REPLACE INTO fx_rates VALUES (?, ?, ?, ?, ?)', rows)
+            n_days += len(rows)
+        return n_days
+
+    def get_rate(self, date, base):
+        """
+        This function returns the rate to convert an amount in the base currency to GBP on a date.
+        :param date: date
+        :param base: base currency, e.g. 'USD'
+        :return: dictionary with the rate, its source and the date the rate was published
+        """
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        key = (date.isoformat(), base)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        half_window = datetime.timedelta(days=self.window_days // 2)
+        for attempt in range(2):
+            with self.lock:
+                row = self.conn.execute('SELECT rate, source, rate_date FROM fx_rates WHERE date = ? AND base = ?',
+                                        key).fetchone()
+            if row is not None:
+                value = {'base': base, 'rate': row[0], 'source': row[1], 'rate_date': row[2]}
+                with self.lock:
+                    self._remember(key, value)
+                return value
+            if attempt == 0:
+                self.prefetch(date - half_window, min(date + half_window, datetime.date.today()), bases=(base,))
+        # The date is after the newest published rate: the rate of the previous business day is used but
+        # neither stored nor cached, so that the rate of the date is used once it is published
+        with self.lock:
+            row = self.conn.execute('SELECT rate, source, rate_date FROM fx_rates WHERE base = ? AND date < ? '
+                                    'AND date >= ? ORDER BY date DESC LIMIT 1',
+                                    (base, key[0], (date - half_window).isoformat())).fetchone()
+        if row is not None:
+            return {'base': base, 'rate': row[0], 'source': row[1], 'rate_date': row[2]}
+        raise FxRateError(f'No {base} rate available for {date:%Y-%m-%d} from {self.source.name}')
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import get_metrics
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that keeps the requests to the Companies House API within the rate limit.
+    The bucket refills continuously with `capacity` tokens per `window_seconds` and is re-synchronised with the
+    X-Ratelimit-* headers returned by the API, so that several clients sharing the same key stay within budget.
+    """
+
+    def __init__(self, capacity, window_seconds):
+        self.capacity = float(capacity)
+        self.window_seconds = float(window_seconds)
+        self.tokens = float(capacity)
+        self.blocked_until = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.capacity / self.window_seconds
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Blocks until a token is available and consumes it.
+        :return: time spent waiting in seconds
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """
+        Stops handing out tokens for the given number of seconds, e.g. after a 429 response.
+        :param seconds:
+        :return:
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers):
+        """
+        Updates the bucket from the rate limit headers of a Companies House API response.
+        :param headers: response headers
+        :return:
+        """
+        remain = headers.get('X-Ratelimit-Remain')
+        reset = headers.get('X-Ratelimit-Reset')
+        if remain is None:
+            return
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, float(remain))
+        if float(remain) <= 0 and reset is not None:
+            self.pause(max(float(reset) - time.time(), 0))
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket whose state is kept in a SQLite database, so that the processes of several hosts sharing the
+    database draw from one rate limit budget instead of each assuming the whole budget. The state is read and
+    updated in one transaction per token, which is cheap compared to the rate of the API. Times are wall
+    clock times, the clocks of the hosts are assumed to be synchronised.
+    """
+
+    def __init__(self, conn, capacity, window_seconds, name='companies_house'):
+        super().__init__(capacity, window_seconds)
+        self.conn = conn
+        self.name = name
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                              'updated REAL NOT NULL, blocked_until REAL NOT NULL)')
+            self.conn.execute('INSERT OR IGNORE INTO buckets VALUES (?, ?, ?, 0)', (name, self.capacity, time.time()))
+
+    def _update(self, update):
+        """
+        This function refills the shared bucket and applies an update to it in one transaction.
+        :param update: function of (now, tokens, blocked_until) returning (tokens, blocked_until, result)
+        :return: result of the update
+        """
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                tokens, updated, blocked_until = self.conn.execute(
+                    'SELECT tokens, updated, blocked_until FROM buckets WHERE name = ?', (self.name,)).fetchone()
+                now = time.time()
+                tokens = min(self.capacity, tokens + max(now - updated, 0) * self.rate)
+                tokens, blocked_until, result = update(now, tokens, blocked_until)
+                self.conn.execute('UPDATE buckets SET tokens = ?, updated = ?, blocked_until = ? WHERE name = ?',
+                                  (tokens, now, blocked_until, self.name))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return result
+
+    def acquire(self):
+        def take(now, tokens, blocked_until):
+            if now >= blocked_until and tokens >= 1:
+                return tokens - 1, blocked_until, None
+            return tokens, blocked_until, max(blocked_until - now, (1 - tokens) / self.rate)
+
+        waited = 0.0
+        while True:
+            delay = self._update(take)
+            if delay is None:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        self._update(lambda now, tokens, blocked_until: (tokens, max(blocked_until, now + seconds), None))
+
+    def update_from_headers(self, headers):
+        remain = headers.get('X-Ratelimit-Remain')
+        reset = headers.get('X-Ratelimit-Reset')
+        if remain is None:
+            return
+        self._update(lambda now, tokens, blocked_until: (min(tokens, float(remain)), blocked_until, None))
+        if float(remain) <= 0 and reset is not None:
+            self.pause(max(float(reset) - time.time(), 0))
+
+
+class CompaniesHouseClient:
+    """
+    Pooled HTTP client for the Companies House API with a shared token bucket and bounded retries with
+    exponential backoff. The bucket is shared by the threads of the process, or by several hosts when a
+    SharedTokenBucket is given.
+    """
+
+    def __init__(self, api_key, requests_per_window=600, window_seconds=300, max_retries=5, backoff_factor=2.0,
+                 pool_size=16, timeout=60, bucket=None):
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.bucket = bucket if bucket is not None else TokenBucket(requests_per_window, window_seconds)
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = api_key
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff_factor ** attempt
+
+    def _get(self, url, decode_json=False, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        metrics = get_metrics()
+        for attempt in range(self.max_retries + 1):
+            waited = self.bucket.acquire()
+            if waited:
+                metrics.inc('api_throttled')
+                metrics.observe('api_throttle_wait', waited)
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.inc('api_requests', status='connection_error')
+                if attempt == self.max_retries:
+                    raise
+                metrics.inc('api_retries', reason='connection_error')
+                logging.warning(f'Request to {url} failed: {e}. Retrying.')
+                time.sleep(self._backoff(attempt))
+                continue
+            metrics.observe('api_request', time.perf_counter() - start)
+            metrics.inc('api_requests', status=response.status_code)
+            self.bucket.update_from_headers(response.headers)
+            if response.status_code in RETRY_STATUS_CODES:
+                if attempt == self.max_retries:
+                    metrics.inc('api_retries_exhausted', reason=response.status_code)
+                    response.close()
+                    response.raise_for_status()
+                metrics.inc('api_retries', reason=response.status_code)
+                delay = self._backoff(attempt, response.headers.get('Retry-After'))
+                response.close()
+                if response.status_code == 429:
+                    self.bucket.pause(delay)
+                logging.warning(f'Request to {url} returned {response.status_code}. Retrying in {delay:.0f}s.')
+                time.sleep(delay)
+                continue
+            if not decode_json:
+                return response
+            try:
+                return response.json()
+            except json.decoder.JSONDecodeError:
+                if attempt == self.max_retries:
+                    raise
+                metrics.inc('api_retries', reason='non_json')
+                delay = self._backoff(attempt)
+                logging.warning(f'Non-JSON response from {url}. Retrying in {delay:.0f}s.')
+                self.bucket.pause(delay)
+                time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        """
+        Sends a GET request, waiting for the rate limit and retrying on throttling, server errors
+        and connection errors, at most max_retries times.
+        :param url:
+        :return: response
+        :raise requests.HTTPError: if the API still throttles or fails after the last retry, so that the
+         error is not taken for a response
+        """
+        return self._get(url, **kwargs)
+
+    def get_json(self, url):
+        """
+        Sends a GET request and decodes the JSON body. The API sometimes answers with a non-JSON body when
+        it is overloaded, in that case the request is retried with backoff, within the same max_retries
+        retries as throttling and server errors.
+        :param url:
+        :return: decoded JSON
+        :raise requests.HTTPError: if the API still throttles or fails after the last retry
+        """
+        return self._get(url, decode_json=True)
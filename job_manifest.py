@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+
+from utils import open_sqlite
+
+STAGES = ['history_fetched', 'downloaded', 'parsed', 'written']
+# Index of the stored stage in STAGES, to compare stages in SQL
+_STAGE_INDEX = 'CASE stage {} END'.format(' '.join(f"WHEN '{stage}' THEN {i}" for i, stage in enumerate(STAGES)))
+
+
+class JobManifest:
+    """
+    This class tracks every (company, transaction) of a batch through the stages of the pipeline. Each stage
+    is committed in one SQLite statement once its output is safely on disk, so that after a crash a restart
+    resumes every document at the first stage that did not complete, and only failed stages are retried.
+    Rasterization and classification have no stage of their own: pages are rendered in memory on demand and
+    form types are checkpointed by the form type cache.
+    """
+
+    def __init__(self, db_path):
+        self.conn = open_sqlite(db_path)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    ch_id TEXT NOT NULL,
+                    transaction_id TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    failed_stage TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    form_type TEXT,
+                    result TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (ch_id, transaction_id)
+                )
+            ''')
+
+    def register(self, ch_id, transaction_id):
+        """
+        This function adds a document found in the filing history, unless it is already tracked.
+        :param ch_id: company house id
+        :param transaction_id: transaction id of the SH01 item
+        :return:
+        """
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO jobs (ch_id, transaction_id, stage, updated_at) '
+                              'VALUES (?, ?, ?, ?)', (ch_id, transaction_id, STAGES[0], time.time()))
+
+    def is_done(self, ch_id, transaction_id, stage):
+        """
+        This function tells if a stage, and therefore all the stages before it, completed for a document.
+        :param ch_id: company house id
+        :param transaction_id: transaction id of the SH01 item
+        :param stage: one of STAGES
+        :return: bool
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT stage FROM jobs WHERE ch_id = ? AND transaction_id = ?',
+                                    (ch_id, transaction_id)).fetchone()
+        return row is not None and STAGES.index(row[0]) >= STAGES.index(stage)
+
+    def complete(self, ch_id, transaction_id, stage, form_type=None, result=None):
+        """
+        This function commits a completed stage of a document. A document only moves forward: completing a
+        stage before the stored one, e.g. the download of a document found on disk, changes nothing, so that
+        a document parsed before is not parsed again.
+        :param ch_id: company house id
+        :param transaction_id: transaction id of the SH01 item
+        :param stage: one of STAGES
+        :param form_type: form type, once parsed
+        :param result: parsed results, kept so that writing can resume without parsing again
+        :return:
+        """
+        with self.lock:
+            self.conn.execute(
+                'UPDATE jobs SET stage = ?, failed_stage = NULL, error = NULL, '
+                'form_type = COALESCE(?, form_type), result = COALESCE(?, result), updated_at = ? '
+                f'WHERE ch_id = ? AND transaction_id = ? AND {_STAGE_INDEX} <= ?',
+                (stage, form_type, json.dumps(result) if result is not None else None, time.time(),
+                 ch_id, transaction_id, STAGES.index(stage)))
+
+    def fail(self, ch_id, transaction_id, stage, error):
+        """
+        This function records that a stage of a document failed, it is retried on the next run.
+        :param ch_id: company house id
+        :param transaction_id: transaction id of the SH01 item
+        :param stage: one of STAGES
+        :param error: error message
+        :return:
+        """
+        with self.lock:
+            self.conn.execute('UPDATE jobs SET failed_stage = ?, error = ?, attempts = attempts + 1, updated_at = ? '
+                              'WHERE ch_id = ? AND transaction_id = ?',
+                              (stage, str(error), time.time(), ch_id, transaction_id))
+
+    def parsed_result(self, ch_id, transaction_id):
+        """
+        This function returns the parsed results of a document that was parsed but not written yet.
+        :param ch_id: company house id
+        :param transaction_id: transaction id of the SH01 item
+        :return: results or None
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT stage, result FROM jobs WHERE ch_id = ? AND transaction_id = ?',
+                                    (ch_id, transaction_id)).fetchone()
+        if row is None or row[0] != 'parsed' or row[1] is None:
+            return None
+        return json.loads(row[1])
+
+    def summary(self):
+        """
+        This function counts the documents per completed stage and the failures per failed stage.
+        :return: dictionary {'stages': {stage: count}, 'failed': {stage: count}}
+        """
+        with self.lock:
+            stages = dict(self.conn.execute('SELECT stage, COUNT(*) FROM jobs GROUP BY stage').fetchall())
+            failed = dict(self.conn.execute('SELECT failed_stage, COUNT(*) FROM jobs WHERE failed_stage IS NOT NULL '
+                                            'GROUP BY failed_stage').fetchall())
+        return {'stages': {stage: stages.get(stage, 0) for stage in STAGES}, 'failed': failed}
+
+    def failures(self):
+        """
+        This function lists the documents whose last attempt failed.
+        :return: list of (company house id, transaction id, failed stage, error, attempts)
+        """
+        with self.lock:
+            return self.conn.execute('SELECT ch_id, transaction_id, failed_stage, error, attempts FROM jobs '
+                                     'WHERE failed_stage IS NOT NULL ORDER BY ch_id').fetchall()
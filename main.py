@@ -1,5 +1,93 @@
+import argparse
+import datetime
+
 from api_handler import CompaniesHouseHandler
+from results_store import export_results
+from settings import configure
+from utils import get_content_cache, get_fx_rate_provider
+from work_queue import parse_shard, iter_ch_ids
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download and parse the SH01 documents of a list of companies.')
+    parser.add_argument('--config', help='config file, SH01_CONFIG or config.txt by default')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='process the list of company house ids (default)')
+    run_parser.add_argument('--ids', help='file with one company house id per line')
+    run_parser.add_argument('--shard', type=parse_shard,
+                            help='i/N to process only the companies whose id hashes to shard i out of N')
+    run_parser.add_argument('--queue', action='store_true',
+                            help='claim batches of companies from the work queue shared with the workers of '
+                                 'other hosts, the first worker fills it from the list')
+
+    results_parser = subparsers.add_parser('results', help='query the results store')
+    results_parser.add_argument('action', choices=['export', 'backfill'],
+                                help='export the results as CSV or load the existing result.json files')
+    results_parser.add_argument('--output', help='CSV file to write, standard output by default')
+    results_parser.add_argument('--ch-id', help='only this company')
+    results_parser.add_argument('--form-type', help='only this form type')
+    results_parser.add_argument('--since', help='only filings on or after this date (YYYY-MM-DD)')
+    results_parser.add_argument('--until', help='only filings on or before this date (YYYY-MM-DD)')
+
+    subparsers.add_parser('status', help='show the progress of the documents through the pipeline stages')
+
+    queue_parser = subparsers.add_parser('queue', help='show the progress of the batches of the work queue')
+    queue_parser.add_argument('action', choices=['status', 'load', 'reset'],
+                              help='count the batches by status, fill the queue from the list of ids once the '
+                                   'previous run is finished, or remove all the batches')
+    queue_parser.add_argument('--ids', help='file with one company house id per line, for load')
+
+    cache_parser = subparsers.add_parser('cache', help='inspect the cache of rasterized pages and OCR results')
+    cache_parser.add_argument('action', choices=['stats', 'clear'],
+                              help='show the size of the cache or remove its entries, e.g. after upgrading '
+                                   'poppler')
+
+    fx_parser = subparsers.add_parser('fx', help='load the exchange rates used to convert share prices to GBP')
+    fx_parser.add_argument('action', choices=['prefetch'],
+                           help='store the rates of every day of a date range, e.g. before a batch')
+    fx_parser.add_argument('--since', required=True, type=datetime.date.fromisoformat,
+                           help='first date (YYYY-MM-DD)')
+    fx_parser.add_argument('--until', type=datetime.date.fromisoformat, default=datetime.date.today(),
+                           help='last date (YYYY-MM-DD), today by default')
+    fx_parser.add_argument('--bases', default='USD,EUR', help='comma separated base currencies')
+    args = parser.parse_args()
+    if args.config:
+        configure(args.config)
+
+    if args.command == 'cache':
+        cache = get_content_cache()
+        if args.action == 'clear':
+            cache.clear()
+        for kind, (entries, size) in sorted(cache.stats().items()):
+            print(f'{kind}: {entries} entries, {size / 2 ** 20:.1f} MB')
+        raise SystemExit(0)
+
+    if args.command == 'fx':
+        n_days = get_fx_rate_provider().prefetch(args.since, args.until, bases=tuple(args.bases.upper().split(',')))
+        print(f'{n_days} daily rates stored')
+        raise SystemExit(0)
+
     ch_handler = CompaniesHouseHandler()
-    ch_handler.process_ch_ids_list()
+    if args.command == 'results':
+        if args.action == 'backfill':
+            print(f'{ch_handler.results.backfill(ch_handler.WORK_DIRECTORY)} results loaded')
+        else:
+            export_results(ch_handler.results, args.output, ch_id=args.ch_id, form_type=args.form_type,
+                           since=args.since, until=args.until)
+    elif args.command == 'status':
+        summary = ch_handler.manifest.summary()
+        for stage, count in summary['stages'].items():
+            print(f'{stage}: {count} documents, {summary["failed"].get(stage, 0)} failed')
+        for ch_id, transaction_id, stage, error, attempts in ch_handler.manifest.failures():
+            print(f'{ch_id} {transaction_id} failed at {stage} after {attempts} attempts: {error}')
+    elif args.command == 'queue':
+        work_queue = ch_handler.open_work_queue()
+        if args.action == 'reset':
+            print(f'{work_queue.reset()} batches removed')
+        elif args.action == 'load':
+            ch_ids = iter_ch_ids(args.ids or ch_handler.WORK_DIRECTORY + '/company_house_ids_list')
+            print(f'{work_queue.load(ch_ids, ch_handler.QUEUE_BATCH_SIZE)} batches added')
+        for status, count in sorted(work_queue.summary().items()):
+            print(f'{status}: {count} batches')
+    else:
+        ch_handler.process_ch_ids_list(getattr(args, 'ids', None), shard=getattr(args, 'shard', None),
+                                       use_queue=getattr(args, 'queue', False))
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import groupby
+from pathlib import Path
+
+from workspace import write_text_atomic
+
+PROMETHEUS_PREFIX = 'sh01_'
+
+event_logger = logging.getLogger('sh01.events')
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters and timers labelled by stage, form type, field, etc. Recording a value
+    is a dictionary update under a lock, cheap enough to stay enabled in production. Timers keep the count,
+    the sum and the maximum of the observed durations. The state of a worker process can be drained and
+    merged into the registry of the main process.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.timers = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        This function increments a counter.
+        :param name: name of the counter
+        :param value: increment
+        :param labels: labels of the counter
+        :return:
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, seconds, **labels):
+        """
+        This function records a duration.
+        :param name: name of the timer
+        :param seconds: duration
+        :param labels: labels of the timer
+        :return:
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        This context manager records the duration of its block, also when it raises.
+        :param name: name of the timer
+        :param labels: labels of the timer
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def drain(self):
+        """
+        This function returns the recorded values and resets them, e.g. to send them from a worker process.
+        :return: state that can be pickled and passed to merge
+        """
+        with self.lock:
+            state = {'counters': list(self.counters.items()), 'timers': list(self.timers.items())}
+            self.counters = defaultdict(float)
+            self.timers = {}
+        return state
+
+    def merge(self, state):
+        """
+        This function adds the values drained from another registry.
+        :param state: value returned by drain
+        :return:
+        """
+        with self.lock:
+            for key, value in state['counters']:
+                self.counters[key] += value
+            for key, (count, total, maximum) in state['timers']:
+                timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+                timer[0] += count
+                timer[1] += total
+                timer[2] = max(timer[2], maximum)
+
+    def snapshot(self):
+        """
+        This function returns the recorded values in a JSON serializable form.
+        :return: dictionary {'counters': [...], 'timers': [...]}
+        """
+        with self.lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'timers': [{'name': name, 'labels': dict(labels), 'count': count, 'sum': round(total, 6),
+                            'max': round(maximum, 6)}
+                           for (name, labels), (count, total, maximum) in sorted(self.timers.items())],
+            }
+
+    def to_prometheus(self):
+        """
+        This function formats the recorded values in the Prometheus text exposition format. Counters are
+        exposed as <name>_total, typed counter, and timers as a summary <name>_seconds with _count and _sum,
+        and a gauge <name>_seconds_max.
+        :return: text
+        """
+        def format_labels(labels):
+            if not labels:
+                return ''
+            escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+            return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timers = sorted(self.timers.items())
+        # The samples of a family follow its TYPE line, the entries are sorted by name so they are contiguous
+        for name, family in groupby(counters, key=lambda item: item[0][0]):
+            metric = f'{PROMETHEUS_PREFIX}{name}_total'
+            lines.append(f'# TYPE {metric} counter')
+            for (_, labels), value in family:
+                lines.append(f'{metric}{format_labels(labels)} {float(value)!r}')
+        for name, family in groupby(timers, key=lambda item: item[0][0]):
+            family = list(family)
+            metric = f'{PROMETHEUS_PREFIX}{name}_seconds'
+            lines.append(f'# TYPE {metric} summary')
+            for (_, labels), (count, total, _) in family:
+                lines.append(f'{metric}_count{format_labels(labels)} {count}')
+                lines.append(f'{metric}_sum{format_labels(labels)} {total:.6f}')
+            lines.append(f'# TYPE {metric}_max gauge')
+            for (_, labels), (_, _, maximum) in family:
+                lines.append(f'{metric}_max{format_labels(labels)} {maximum:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """
+    This function returns the metrics registry of the process.
+    :return: Metrics
+    """
+    return _metrics
+
+
+def log_event(event, **fields):
+    """
+    This function writes a structured event as one JSON line to the event log, if one is configured.
+    :param event: name of the event
+    :param fields: JSON serializable fields of the event
+    :return:
+    """
+    if event_logger.isEnabledFor(logging.INFO):
+        event_logger.info(json.dumps({'ts': round(time.time(), 3), 'event': event, **fields}, default=str))
+
+
+def write_prometheus_file(path):
+    """
+    This function writes the metrics of the process in the Prometheus text format, e.g. for the textfile
+    collector of the node exporter.
+    :param path: path of the file
+    :return:
+    """
+    write_text_atomic(path, get_metrics().to_prometheus())
+
+
+_outputs_lock = threading.Lock()
+_prometheus_files = set()
+_prometheus_servers = {}
+
+
+def setup_metrics(enabled=True, log_path=None, prometheus_file=None, prometheus_port=0, flush_seconds=30):
+    """
+    This function configures the outputs of the metrics of the process. It can be called again, e.g. by every
+    handler: an output already set up, such as the writes of a Prometheus file or the endpoint of a port, is
+    not set up twice.
+    :param enabled: record metrics
+    :param log_path: file the structured JSON events are appended to
+    :param prometheus_file: file rewritten every flush_seconds and at exit with the metrics in the Prometheus
+     text format
+    :param prometheus_port: port of an HTTP endpoint serving /metrics, 0 to disable it
+    :param flush_seconds: interval between two writes of the Prometheus file
+    :return:
+    """
+    _metrics.enabled = enabled
+    if not enabled:
+        return
+    if log_path and not any(getattr(h, 'baseFilename', None) == os.path.abspath(log_path)
+                            for h in event_logger.handlers):
+        Path(log_path).parent.mkdir(parents=True, exist_ok=True)
+        handler = logging.FileHandler(log_path)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        event_logger.addHandler(handler)
+        event_logger.setLevel(logging.INFO)
+        event_logger.propagate = False
+    with _outputs_lock:
+        if prometheus_file and os.path.abspath(prometheus_file) not in _prometheus_files:
+            _prometheus_files.add(os.path.abspath(prometheus_file))
+
+            def flush():
+                while True:
+                    time.sleep(flush_seconds)
+                    write_prometheus_file(prometheus_file)
+
+            threading.Thread(target=flush, daemon=True).start()
+            atexit.register(write_prometheus_file, prometheus_file)
+        if prometheus_port and prometheus_port not in _prometheus_servers:
+            _prometheus_servers[prometheus_port] = serve_prometheus(prometheus_port)
+
+
+def serve_prometheus(port):
+    """
+    This function serves the metrics of the process in the Prometheus text format on /metrics, on a
+    background thread.
+    :param port: port of the HTTP endpoint
+    :return: server
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class PrometheusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            body = get_metrics().to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), PrometheusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import subprocess
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from functools import cached_property
+
+from workspace import scratch_dir
+
+# A word recognized by tesseract, with its bounding box in pixels and its position in the layout of the page
+OcrWord = namedtuple('OcrWord', ['text', 'left', 'top', 'width', 'height', 'conf', 'block', 'par', 'line', 'word'])
+
+
+def parse_tsv(tsv):
+    """
+    This function parses the TSV output of tesseract into its words.
+    :param tsv: TSV text, with or without the header line
+    :return: list of OcrWord
+    """
+    words = []
+    for row in tsv.splitlines():
+        columns = row.split('\t')
+        # Only the rows of level 5 are words, the others are pages, blocks, paragraphs and lines
+        if len(columns) < 12 or columns[0] != '5' or not columns[11].strip():
+            continue
+        words.append(OcrWord(columns[11], int(columns[6]), int(columns[7]), int(columns[8]), int(columns[9]),
+                             float(columns[10]), int(columns[2]), int(columns[3]), int(columns[4]),
+                             int(columns[5])))
+    return words
+
+
+class OcrEngine(ABC):
+    """
+    This class recognizes the text of images given as numpy arrays.
+    """
+    name = None
+
+    @abstractmethod
+    def image_to_text(self, img, psm, dpi=None) -> str:
+        """
+        Abstract method to recognize the text of an image.
+        :param img: BGR or grayscale image
+        :param psm: tesseract page segmentation mode
+        :param dpi: resolution hint passed to tesseract
+        :return: recognized text
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def image_to_data(self, img, psm, dpi=None) -> list:
+        """
+        Abstract method to recognize the words of an image with their bounding boxes, in one pass.
+        :param img: BGR or grayscale image
+        :param psm: tesseract page segmentation mode
+        :param dpi: resolution hint passed to tesseract
+        :return: list of OcrWord
+        """
+        raise NotImplementedError
+
+    @property
+    def version(self) -> str:
+        """
+        Version of the engine, used to tell apart results of different tesseract releases.
+        :return:
+        """
+        return self.name
+
+
+class SubprocessTesseractEngine(OcrEngine):
+    """
+    This engine runs the tesseract command line tool on a temporary copy of the image. Every call starts a
+    new process and reloads the language model, it is the fallback when tesserocr is not installed.
+    """
+    name = 'tesseract-cli'
+
+    def _run(self, img, psm, dpi, configs=()):
+        import cv2
+        with tempfile.NamedTemporaryFile(suffix='.jpg', dir=scratch_dir()) as f:
+            cv2.imwrite(f.name, img)
+            command = ['tesseract', f.name, 'stdout', '--psm', str(psm)]
+            if dpi is not None:
+                command += ['--dpi', str(dpi)]
+            return subprocess.run(command + list(configs), capture_output=True, check=True).stdout.decode('utf-8')
+
+    def image_to_text(self, img, psm, dpi=None) -> str:
+        return self._run(img, psm, dpi)
+
+    def image_to_data(self, img, psm, dpi=None) -> list:
+        return parse_tsv(self._run(img, psm, dpi, ['tsv']))
+
+    @cached_property
+    def version(self) -> str:
+        output = subprocess.run(['tesseract', '--version'], capture_output=True).stdout.decode('utf-8')
+        return f'{self.name} {output.splitlines()[0] if output else ""}'.strip()
+
+
+class TesserocrEngine(OcrEngine):
+    """
+    This engine keeps one tesseract API handle per thread alive for the whole run, so the language model
+    is loaded once per worker and images are passed in memory.
+    """
+    name = 'tesserocr'
+
+    def __init__(self, lang='eng'):
+        import tesserocr
+        self.tesserocr = tesserocr
+        self.lang = lang
+        self.local = threading.local()
+
+    def _api(self):
+        if getattr(self.local, 'api', None) is None:
+            self.local.api = self.tesserocr.PyTessBaseAPI(lang=self.lang)
+        return self.local.api
+
+    def _set_image(self, img, psm, dpi):
+        import cv2
+        api = self._api()
+        # PSM is an enum of tesserocr that cannot be instantiated, SetPageSegMode takes the plain int
+        api.SetPageSegMode(int(psm))
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        height, width = img.shape
+        api.SetImageBytes(img.tobytes(), width, height, 1, width)
+        if dpi is not None:
+            api.SetSourceResolution(dpi)
+        return api
+
+    def image_to_text(self, img, psm, dpi=None) -> str:
+        return self._set_image(img, psm, dpi).GetUTF8Text()
+
+    def image_to_data(self, img, psm, dpi=None) -> list:
+        return parse_tsv(self._set_image(img, psm, dpi).GetTSVText(0))
+
+    @property
+    def version(self) -> str:
+        return f'{self.name} {self.tesserocr.tesseract_version().splitlines()[0]}'
+
+
+def create_ocr_engine(engine='auto'):
+    """
+    This function creates an OCR engine.
+    :param engine: 'tesserocr', 'subprocess' or 'auto' to use tesserocr when it is installed
+    :return: OcrEngine
+    """
+    if engine == 'subprocess':
+        return SubprocessTesseractEngine()
+    try:
+        return TesserocrEngine()
+    except ImportError:
+        if engine == 'tesserocr':
+            raise
+        return SubprocessTesseractEngine()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import cv2
+import numpy as np
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+from content_cache import content_key
+from document_downloader import document_sha256
+from metrics import get_metrics
+from settings import get_settings
+from utils import get_content_cache
+
+RASTERIZED_DPI = 500
+
+
+class PageProvider:
+    """
+    This class renders the pages of a document on demand. Only the requested page is rasterized, at the
+    resolution chosen by the caller, and straight to grayscale since every crop is OCRed in grayscale: a page
+    at 500 DPI takes about 24 MB instead of 72 MB in colour. Pages rasterized to JPEG by earlier versions of
+    the pipeline are reused, decoded at a reduced resolution by the JPEG decoder when a lower resolution is
+    requested. The decoded pages are kept in an LRU cache bounded in bytes, so that form type detection and
+    the processors share them within a fixed memory budget per worker. Pages rendered from the PDF are also
+    kept in the content cache, keyed by the hash of the PDF, the page and the resolution, so that documents
+    parsed again or downloaded twice are not rasterized again. Pages can be requested from several threads.
+    """
+
+    def __init__(self, doc_path, dpi=RASTERIZED_DPI, max_cache_bytes=None, max_pages=10, content_cache=None):
+        self.doc_path = doc_path
+        self.pdf_path = doc_path + 'document.pdf'
+        self.dpi = dpi
+        if max_cache_bytes is None:
+            max_cache_bytes = get_settings().getint('parsing', 'PageCacheMB', fallback=160) << 20
+        self.max_cache_bytes = max_cache_bytes
+        self.max_pages = max_pages
+        self.content_cache = content_cache if content_cache is not None else get_content_cache()
+        self._n_pages = None
+        self._pdf_sha256 = None
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self.lock = threading.Lock()
+
+    def page_count(self):
+        """
+        This function returns the number of pages available, at most max_pages.
+        :return:
+        """
+        with self.lock:
+            if self._n_pages is None:
+                self._n_pages = self._count_pages()
+        return self._n_pages
+
+    def _count_pages(self):
+        if Path(self.pdf_path).is_file():
+            return min(int(pdfinfo_from_path(self.pdf_path)['Pages']), self.max_pages)
+        n_pages = 0
+        while Path(self.doc_path + 'pages/{}.jpeg'.format(n_pages)).is_file():
+            n_pages += 1
+        return n_pages
+
+    def source_dpi(self, n):
+        """
+        This function returns the resolution of the source of page n, above which a rendering adds no detail.
+        :param n: page number
+        :return: resolution of a page rasterized to JPEG, None for a page rendered from the PDF
+        """
+        return RASTERIZED_DPI if Path(self.doc_path + 'pages/{}.jpeg'.format(n)).is_file() else None
+
+    @staticmethod
+    def _read_jpeg(path, dpi):
+        # The JPEG decoder can scale down by 2, 4 or 8 while decoding, which is faster and needs less memory
+        # than decoding the full page and resizing it
+        flag, decoded_dpi = cv2.IMREAD_GRAYSCALE, RASTERIZED_DPI
+        for reduction, reduced_flag in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                                        (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+            if RASTERIZED_DPI / reduction >= dpi:
+                flag, decoded_dpi = reduced_flag, RASTERIZED_DPI / reduction
+                break
+        img = cv2.imread(path, flag)
+        if img is not None and decoded_dpi != dpi:
+            img = cv2.resize(img, None, fx=dpi / decoded_dpi, fy=dpi / decoded_dpi, interpolation=cv2.INTER_AREA)
+        return img
+
+    def _render(self, n, dpi):
+        legacy_page = self.doc_path + 'pages/{}.jpeg'.format(n)
+        if Path(legacy_page).is_file():
+            with get_metrics().timer('rasterize', source='jpeg'):
+                return self._read_jpeg(legacy_page, dpi)
+        key = None
+        if self.content_cache.enabled:
+            if self._pdf_sha256 is None:
+                self._pdf_sha256 = document_sha256(self.pdf_path)
+            key = content_key('page_gray', self._pdf_sha256, n, dpi)
+            img = self.content_cache.get_image('page', key)
+            if img is not None:
+                return img
+        with get_metrics().timer('rasterize', source='pdf'):
+            pages = convert_from_path(self.pdf_path, dpi, first_page=n + 1, last_page=n + 1, grayscale=True)
+            if not pages:
+                return None
+            img = np.asarray(pages[0].convert('L'))
+        if key is not None:
+            self.content_cache.put_image('page', key, img)
+        return img
+
+    def page(self, n, dpi=None, keep=True):
+        """
+        This function returns page n as a grayscale image.
+        :param n: page number, starting at 0
+        :param dpi: resolution, defaults to the resolution of the provider
+        :param keep: keep the page in the LRU cache, e.g. not for a page only needed once at a low resolution
+        :return: image or None if the document has fewer pages
+        """
+        dpi = dpi or self.dpi
+        if n >= self.page_count():
+            return None
+        key = (n, dpi)
+        with self.lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        img = self._render(n, dpi)
+        if img is None or not keep:
+            return img
+        with self.lock:
+            if key not in self._cache:
+                self._cache[key] = img
+                self._cache_bytes += img.nbytes
+            # The most recent page is kept even if it alone is over the budget
+            while self._cache_bytes > self.max_cache_bytes and len(self._cache) > 1:
+                self._cache_bytes -= self._cache.popitem(last=False)[1].nbytes
+        return img
+
+    def region(self, n, x0=0, x1=100, y0=0, y1=100, dpi=None, keep=True):
+        """
+        This function returns a region of page n. The bounds are percentages of the page height (x) and
+        width (y), as in utils.crop_image.
+        :param keep: keep the page in the LRU cache. If not, the region is copied so that the page is freed.
+        :return: image or None if the document has fewer pages
+        """
+        img = self.page(n, dpi, keep)
+        if img is None:
+            return None
+        crop = img[
+               x0 * img.shape[0] // 100:
+               x1 * img.shape[0] // 100,
+               y0 * img.shape[1] // 100:
+               y1 * img.shape[1] // 100
+               ]
+        return crop if keep else crop.copy()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from settings import get_settings, on_configure
+from utils import open_sqlite
+
+
+class PageHitStats:
+    """
+    This class counts on which page the searched content was found, per form type, so that later searches
+    start with the most likely pages. The counts are kept in SQLite and incremented in place, so that the
+    processes of a batch add up their counts instead of overwriting each other's. The hits of a process are
+    buffered and written once per batch by flush. The order of the pages only changes when the counts are
+    flushed, so that all the documents of a batch are searched in the same order whatever the documents
+    parsed before them.
+    """
+
+    def __init__(self, db_path):
+        self.conn = open_sqlite(db_path)
+        self.lock = threading.Lock()
+        self.pending = {}
+        with self.lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS page_hits (
+                    key TEXT NOT NULL,
+                    page INTEGER NOT NULL,
+                    n INTEGER NOT NULL,
+                    PRIMARY KEY (key, page)
+                )
+            ''')
+            self.counts = self._load()
+
+    def _load(self):
+        return {(key, page): n for key, page, n in self.conn.execute('SELECT key, page, n FROM page_hits')}
+
+    def order(self, key, candidates):
+        """
+        This function sorts the candidate pages from the most to the least likely, keeping the original order
+        between pages with the same count.
+        :param key: name of the search, e.g. the form type
+        :param candidates: page numbers
+        :return: list of page numbers
+        """
+        with self.lock:
+            counts = {page: self.counts.get((key, page), 0) for page in candidates}
+        return sorted(candidates, key=lambda page: -counts[page])
+
+    def record(self, key, page):
+        """
+        This function records that the searched content was found on a page, until the next flush.
+        :param key: name of the search
+        :param page: page number
+        :return:
+        """
+        with self.lock:
+            self.pending[(key, page)] = self.pending.get((key, page), 0) + 1
+
+    def flush(self):
+        """
+        This function adds the hits recorded since the last flush to the stored counts and reloads the counts,
+        with the hits of the other processes.
+        :return:
+        """
+        with self.lock:
+            if not self.pending:
+                self.counts = self._load()
+                return
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany('INSERT INTO page_hits (key, page, n) VALUES (?, ?, ?) '
+                                      'ON CONFLICT (key, page) DO UPDATE SET n = n + excluded.n',
+                                      [(key, page, n) for (key, page), n in self.pending.items()])
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.pending = {}
+            self.counts = self._load()
+
+
+_stats = None
+_stats_lock = threading.Lock()
+
+
+def get_page_hit_stats():
+    global _stats
+    with _stats_lock:
+        if _stats is None:
+            config = get_settings()
+            _stats = PageHitStats(config.get('parsing', 'PageHitsPath',
+                                             fallback=config.work_directory + '/page_hits.sqlite'))
+        return _stats
+
+
+@atexit.register
+def flush_page_hit_stats():
+    """
+    This function writes the page hits recorded by the process, at the end of a batch. It also runs when the
+    process exits, so that the hits of the parse worker processes are kept.
+    :return:
+    """
+    with _stats_lock:
+        if _stats is not None:
+            _stats.flush()
+
+
+@on_configure
+def _reset_page_hit_stats():
+    global _stats
+    flush_page_hit_stats()
+    with _stats_lock:
+        _stats = None
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_search_executor():
+    """
+    This function returns the process-wide thread pool of the page searches. Its threads live as long as the
+    process, so that an OCR engine keeping one handle per thread loads its language model once per thread
+    and not at every search.
+    :return: ThreadPoolExecutor
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=get_settings().getint('parsing', 'PageSearchWorkers', fallback=4),
+                thread_name_prefix='page_search')
+        return _executor
+
+
+def search_pages(candidates, extract, accept, key=None, max_workers=None, stats=None):
+    """
+    This function runs extract on the candidate pages, most likely pages first, and returns as soon as a page
+    is accepted. With more than one worker, up to max_workers pages are processed concurrently on the thread
+    pool of the process. Pages ranked after an accepted page are not started, and pages ranked before it are
+    still awaited, so the result is the same as checking the pages one by one in ranked order. Pages already
+    being processed when the search ends are awaited, so that no OCR runs after the function returns. With
+    one worker, the pages are processed one by one in the calling thread.
+    :param candidates: page numbers
+    :param extract: function of the page number returning e.g. the recognized text
+    :param accept: function of the extracted value telling if the page contains what is searched
+    :param key: name of the search used to learn the page order, e.g. the form type
+    :param max_workers: number of pages processed concurrently, PageSearchWorkers of the config by default
+    :param stats: PageHitStats, defaults to the persistent statistics of the work directory
+    :return: (page, extracted value) of the accepted page or None
+    """
+    if stats is None:
+        stats = get_page_hit_stats()
+    if max_workers is None:
+        max_workers = get_settings().getint('parsing', 'PageSearchWorkers', fallback=4)
+    ranked = stats.order(key, candidates) if key is not None else list(candidates)
+    best = None
+    if max_workers <= 1:
+        for page in ranked:
+            value = extract(page)
+            if value is not None and accept(value):
+                best = (page, value)
+                break
+    else:
+        executor = get_search_executor()
+        rank = {page: idx for idx, page in enumerate(ranked)}
+        running = {}
+        n_submitted = 0
+        try:
+            while True:
+                # Pages are submitted in ranked order and never after an accepted page
+                while len(running) < max_workers and n_submitted < len(ranked) and \
+                        (best is None or n_submitted < rank[best[0]]):
+                    running[executor.submit(extract, ranked[n_submitted])] = ranked[n_submitted]
+                    n_submitted += 1
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page = running.pop(future)
+                    value = future.result()
+                    if value is not None and accept(value) and (best is None or rank[page] < rank[best[0]]):
+                        best = (page, value)
+                if best is not None and all(rank[page] > rank[best[0]] for page in running.values()) and \
+                        n_submitted >= rank[best[0]]:
+                    break
+        finally:
+            wait(running)
+    if best is not None and key is not None:
+        stats.record(key, best[0])
+    return best
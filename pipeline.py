@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import queue
+import threading
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
+
+from api_handler import fetch_filing_histories, sync_filing_history, parse_document_at
+from metrics import get_metrics
+from settings import configure, get_settings
+
+_DOWNLOADS_DONE = object()
+
+
+def parse_document_in_worker(doc_path, doc_item):
+    """
+    This function parses a document in a worker process and returns the metrics recorded meanwhile, so that
+    they are merged into the metrics of the main process.
+    :param doc_path: document folder
+    :param doc_item: document item from the filing history
+    :return: (results, drained metrics)
+    """
+    try:
+        return parse_document_at(doc_path, doc_item), get_metrics().drain()
+    except Exception as e:
+        e.metrics = get_metrics().drain()
+        raise
+
+
+def run_pipeline(handler, ch_ids, parse_workers, queue_size=64):
+    """
+    This function processes companies with separate download and parse stages. Filing histories are
+    fetched and documents downloaded on threads of the main process. Downloaded documents go into a bounded
+    queue consumed by a pool of parse worker processes, and the results are written as they complete.
+    :param handler: CompaniesHouseHandler
+    :param ch_ids: iterable of company house ids
+    :param parse_workers: number of parse worker processes
+    :param queue_size: maximum number of documents downloading or waiting to be parsed
+    :return:
+    """
+    for _ in iter_pipeline(handler, ch_ids, parse_workers, queue_size):
+        pass
+
+
+def iter_pipeline(handler, ch_ids, parse_workers, queue_size=64):
+    """
+    This function processes companies as run_pipeline and yields the results of every document as soon as
+    they are written. If the caller stops iterating, no new document is downloaded and the documents being
+    parsed are finished before the generator closes.
+    :param handler: CompaniesHouseHandler
+    :param ch_ids: iterable of company house ids
+    :param parse_workers: number of parse worker processes
+    :param queue_size: maximum number of documents downloading or waiting to be parsed
+    :return: generator of (company house id, document item, parsed results)
+    """
+    downloaded = queue.Queue()
+    slots = threading.Semaphore(queue_size)
+    stopped = threading.Event()
+
+    def download(doc, ch_id):
+        try:
+            has_document = handler.download_document(doc, ch_id)
+        except Exception as e:
+            warnings.warn(f'Error downloading document {doc["transaction_id"]}. Error: {e}')
+            has_document = False
+        if not has_document:
+            slots.release()
+            return
+        downloaded.put((doc, ch_id))
+
+    def download_stage():
+        try:
+            sync = partial(sync_filing_history, index=handler.index, max_age=handler.HISTORY_MAX_AGE)
+            with ThreadPoolExecutor(max_workers=handler.downloader.max_workers) as executor:
+                for ch_id, sh01_docs in fetch_filing_histories(ch_ids, handler.CRAWLER_WORKERS, fetch=sync):
+                    if stopped.is_set():
+                        return
+                    for doc in sh01_docs:
+                        slots.acquire()
+                        if stopped.is_set():
+                            return
+                        executor.submit(download, doc, ch_id)
+        finally:
+            downloaded.put(_DOWNLOADS_DONE)
+
+    downloader = threading.Thread(target=download_stage, daemon=True)
+    downloader.start()
+
+    # Worker processes are spawned rather than forked because the download threads are already running. They
+    # get the settings of the main process, which may not come from the config file of the working directory.
+    context = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(max_workers=parse_workers, mp_context=context, initializer=configure,
+                                 initargs=(get_settings(),)) as pool:
+            in_flight = {}
+            downloads_done = False
+            while not downloads_done or in_flight:
+                while not downloads_done:
+                    try:
+                        item = downloaded.get(timeout=0.1 if in_flight else None)
+                    except queue.Empty:
+                        break
+                    if item is _DOWNLOADS_DONE:
+                        downloads_done = True
+                        break
+                    doc, ch_id = item
+                    res = handler.manifest.parsed_result(ch_id, doc['transaction_id'])
+                    if res is not None:
+                        handler.write_result(doc, ch_id, res)
+                        slots.release()
+                        yield ch_id, doc, res
+                        continue
+                    in_flight[pool.submit(parse_document_in_worker, handler.get_doc_path(doc, ch_id), doc)] = item
+                if not in_flight:
+                    continue
+                done, _ = wait(in_flight, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    doc, ch_id = in_flight.pop(future)
+                    slots.release()
+                    try:
+                        res, worker_metrics = future.result()
+                    except Exception as e:
+                        if hasattr(e, 'metrics'):
+                            get_metrics().merge(e.metrics)
+                        handler.fail(doc, ch_id, 'parsed', e)
+                        warnings.warn(f'Error parsing document {doc["transaction_id"]}. Error: {e}')
+                        continue
+                    get_metrics().merge(worker_metrics)
+                    handler.record_parsed(doc, ch_id, res)
+                    try:
+                        handler.write_result(doc, ch_id, res)
+                    except Exception as e:
+                        warnings.warn(f'Error writing results of document {doc["transaction_id"]}. Error: {e}')
+                        continue
+                    yield ch_id, doc, res
+    finally:
+        stopped.set()
+        # Unblock the download stage if it waits for a slot
+        slots.release()
+        downloader.join()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import math
+
+# Nominal values of shares are round: 1, 2, 2.5 or 5 times a power of ten, e.g. £1, £0.10, £0.001 or £0.25
+ROUND_MANTISSAS = (1, 2, 2.5, 5, 10)
+
+
+def is_round_nominal(nominal, tolerance=0.005):
+    """
+    This function tells if a nominal value per share is round. The capital figures of the filing history are
+    rounded, hence the relative tolerance.
+    :param nominal: nominal value per share
+    :param tolerance: relative tolerance
+    :return: bool
+    """
+    if nominal is None or nominal <= 0 or not math.isfinite(nominal):
+        return False
+    mantissa = nominal / 10 ** math.floor(math.log10(nominal))
+    return any(abs(mantissa - m) <= tolerance * m for m in ROUND_MANTISSAS)
+
+
+def nominal_value(capital, total_shares):
+    """
+    This function derives the nominal value per share from the capital of the filing history, i.e. the
+    aggregate nominal value of the shares after the allotment, and the total number of shares.
+    :param capital: {'figure': float, 'currency': text} or None
+    :param total_shares: total number of shares
+    :return: nominal value per share or None if it cannot be derived
+    """
+    if not capital or not capital.get('figure') or not total_shares:
+        return None
+    return capital['figure'] / total_shares
+
+
+def _number(value):
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def check_values(share_price, n_allotted, total_shares, capital=None, price_in_capital_currency=False,
+                 tolerance=0.005):
+    """
+    This function checks the extracted values of a document against each other and against the capital of
+    the filing history. Each failed check names the fields that may be misread, so that only their fallback
+    OCR passes are run. A company with share classes of different nominal values fails the nominal check even
+    when the values are right, which only costs the fallback passes. The total number of shares is not
+    compared to the earlier and later filings of the company: it also goes down, e.g. when shares are
+    bought back or consolidated.
+    :param share_price: share price, as a number or as a text
+    :param n_allotted: number of shares allotted, as a number or as a text
+    :param total_shares: total number of shares after the allotment, as a number or as a text
+    :param capital: capital of the filing history, {'figure': float, 'currency': text}, or None
+    :param price_in_capital_currency: the share price is in the currency of the capital, so that it can be
+     compared to the nominal value
+    :param tolerance: relative tolerance of the comparisons
+    :return: list of (check, fields), empty if the values are plausible
+    """
+    share_price, n_allotted, total_shares = _number(share_price), _number(n_allotted), _number(total_shares)
+    failed = []
+    missing = tuple(field for field, value in (('share_price', share_price), ('n_allotted', n_allotted),
+                                               ('total_shares', total_shares)) if value is None)
+    if missing:
+        failed.append(('missing', missing))
+    if total_shares is None:
+        return failed
+    if n_allotted is not None and total_shares < n_allotted * (1 - tolerance):
+        failed.append(('total_below_allotted', ('total_shares', 'n_allotted')))
+    nominal = nominal_value(capital, total_shares)
+    if nominal is not None:
+        if not is_round_nominal(nominal, tolerance):
+            failed.append(('nominal_not_round', ('total_shares',)))
+        elif price_in_capital_currency and share_price is not None and share_price < nominal * (1 - tolerance):
+            # Shares cannot be allotted at a discount to their nominal value
+            failed.append(('price_below_nominal', ('share_price',)))
+    return failed
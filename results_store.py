@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+
+from settings import get_settings, on_configure
+from utils import open_sqlite
+
+RESULT_COLUMNS = ['transaction_id', 'ch_id', 'date', 'form_type', 'form_type_stage', 'share_price', 'n_allotted',
+                  'total_shares', 'fundraising', 'valuation', 'equity', 'capital_figure', 'capital_currency',
+                  'fx_rate', 'fx_source']
+
+
+class ResultsStore:
+    """
+    Append-only store of the parsed SH01 documents of all companies in one SQLite table. Every record is
+    written in its own transaction and a transaction id appears once: writing it again replaces the
+    previous record, e.g. after a parser change.
+    """
+
+    def __init__(self, db_path):
+        self.conn = open_sqlite(db_path)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS results (
+                    transaction_id TEXT PRIMARY KEY,
+                    ch_id TEXT NOT NULL,
+                    date TEXT,
+                    form_type TEXT,
+                    form_type_stage TEXT,
+                    share_price REAL,
+                    n_allotted REAL,
+                    total_shares REAL,
+                    fundraising REAL,
+                    valuation REAL,
+                    equity REAL,
+                    capital_figure REAL,
+                    capital_currency TEXT,
+                    fx_rate REAL,
+                    fx_source TEXT,
+                    record TEXT NOT NULL,
+                    written_at REAL NOT NULL
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS results_ch_id ON results (ch_id)')
+
+    @staticmethod
+    def _row(ch_id, res):
+        capital = res.get('capital') or {}
+        fx_rate = res.get('fx_rate') or {}
+        values = dict(res, ch_id=ch_id, capital_figure=capital.get('figure'), capital_currency=capital.get('currency'),
+                      fx_rate=fx_rate.get('rate'), fx_source=fx_rate.get('source'))
+        for key in ('total_shares', 'n_allotted', 'share_price'):
+            try:
+                values[key] = float(values[key]) if values.get(key) is not None else None
+            except (TypeError, ValueError):
+                values[key] = None
+        return [values.get(column) for column in RESULT_COLUMNS] + [json.dumps(res), time.time()]
+
+    def append(self, ch_id, res):
+        """
+        This function stores the results of a parsed document.
+        :param ch_id: company house id
+        :param res: dictionary returned by AbstractDocumentProcessor.parse_document
+        :return:
+        """
+        self.append_many([(ch_id, res)])
+
+    def append_many(self, records):
+        """
+        This function stores the results of several parsed documents in one transaction.
+        :param records: iterable of (company house id, results)
+        :return: number of records written
+        """
+        rows = [self._row(ch_id, res) for ch_id, res in records if res.get('transaction_id')]
+        placeholders = ', '.join(['?'] * (len(RESULT_COLUMNS) + 2))
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.executemany(f'INSERT OR REPLACE INTO results VALUES ({placeholders})', rows)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return len(rows)
+
+    def query(self, ch_id=None, form_type=None, since=None, until=None):
+        """
+        This function returns the stored results, ordered by company and date.
+        :param ch_id: only this company
+        :param form_type: only this form type
+        :param since: only filings on or after this date (YYYY-MM-DD)
+        :param until: only filings on or before this date (YYYY-MM-DD)
+        :return: generator of dictionaries with RESULT_COLUMNS
+        """
+        conditions, params = [], []
+        for condition, value in (('ch_id = ?', ch_id), ('form_type = ?', form_type), ('date >= ?', since),
+                                 ('date <= ?', until)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        with self.lock:
+            rows = self.conn.execute(f'SELECT {", ".join(RESULT_COLUMNS)} FROM results {where} '
+                                     f'ORDER BY ch_id, date', params).fetchall()
+        for row in rows:
+            yield dict(zip(RESULT_COLUMNS, row))
+
+    def export_csv(self, f, **filters):
+        """
+        This function writes the stored results as CSV.
+        :param f: writable text file
+        :param filters: arguments of query
+        :return: number of rows written
+        """
+        writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS)
+        writer.writeheader()
+        n_rows = 0
+        for row in self.query(**filters):
+            writer.writerow(row)
+            n_rows += 1
+        return n_rows
+
+    def backfill(self, work_directory, batch_size=1000):
+        """
+        This function loads the result.json files of the work directory, laid out as
+        <work_directory>/<company house id>/<date>_<transaction id>/result.json, into the store.
+        :param work_directory: work directory
+        :param batch_size: number of records written per transaction
+        :return: number of records written
+        """
+        n_written = 0
+        batch = []
+        for result_path in Path(work_directory).glob('*/*/result.json'):
+            with open(result_path, 'r') as f:
+                try:
+                    res = json.load(f)
+                except ValueError:
+                    continue
+            batch.append((result_path.parent.parent.name, res))
+            if len(batch) >= batch_size:
+                n_written += self.append_many(batch)
+                batch = []
+        return n_written + self.append_many(batch)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_results_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            config = get_settings()
+            _store = ResultsStore(config.get('general', 'ResultsPath',
+                                             fallback=config.work_directory + '/results.sqlite'))
+        return _store
+
+
+@on_configure
+def _reset_results_store():
+    global _store
+    with _store_lock:
+        _store = None
+
+
+def export_results(store, output_path=None, **filters):
+    """
+    This function exports the stored results as CSV to a file or to the standard output.
+    :param store: ResultsStore
+    :param output_path: path of the CSV file, standard output if None
+    :param filters: arguments of ResultsStore.query
+    :return: number of rows written
+    """
+    if output_path is None:
+        return store.export_csv(sys.stdout, **filters)
+    with open(output_path, 'w', newline='') as f:
+        return store.export_csv(f, **filters)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import configparser
+import os
+import threading
+
+DEFAULT_CONFIG_PATH = 'config.txt'
+COMPANIES_HOUSE_API_URL = 'https://api.companieshouse.gov.uk'
+
+
+class Settings(configparser.ConfigParser):
+    """
+    Configuration of the pipeline, with the sections and keys of config.txt. Every value has a default, so
+    the parsing can be used as a library without a config file. The Companies House key can also be given
+    in the COMPANIES_HOUSE_KEY environment variable. Settings can be pickled, e.g. to configure worker
+    processes the same way as the main process.
+    """
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_CONFIG_PATH):
+        """
+        This function reads the settings from a config file.
+        :param path: path of the config file
+        :return: Settings
+        """
+        settings = cls()
+        if not settings.read(path):
+            raise FileNotFoundError(f'Config file {path} not found')
+        return settings
+
+    @classmethod
+    def from_dict(cls, sections):
+        """
+        This function builds the settings from a dictionary, e.g. {'general': {'Dir': 'data'}}.
+        :param sections: dictionary {section: {key: value}}
+        :return: Settings
+        """
+        settings = cls()
+        settings.read_dict(sections)
+        return settings
+
+    def to_dict(self):
+        return {section: dict(self[section]) for section in self.sections()}
+
+    def __reduce__(self):
+        return Settings.from_dict, (self.to_dict(),)
+
+    @property
+    def work_directory(self):
+        return self.get('general', 'Dir', fallback='data')
+
+    @property
+    def company_house_key(self):
+        return self.get('general', 'CompanyHouseKey', fallback=os.environ.get('COMPANIES_HOUSE_KEY', ''))
+
+    @property
+    def sqlite_wal(self):
+        return self.getboolean('general', 'SqliteWal', fallback=True)
+
+    @property
+    def api_base_url(self):
+        return self.get('api', 'ApiBaseUrl', fallback=COMPANIES_HOUSE_API_URL).rstrip('/')
+
+    @property
+    def use_text_layer(self):
+        return self.getboolean('parsing', 'UseTextLayer', fallback=True)
+
+    @property
+    def page_dpi(self):
+        return self.getint('parsing', 'PageDpi', fallback=500)
+
+    @property
+    def form_type_dpi(self):
+        return self.getint('parsing', 'FormTypeDpi', fallback=200)
+
+    @property
+    def form_type_low_dpi(self):
+        return self.getint('parsing', 'FormTypeLowDpi', fallback=100)
+
+    @property
+    def debug_crops(self):
+        return self.getboolean('parsing', 'DebugCrops', fallback=False)
+
+    @property
+    def use_layout_ocr(self):
+        return self.getboolean('parsing', 'LayoutOcr', fallback=False)
+
+    @property
+    def plausibility_gate(self):
+        return self.getboolean('parsing', 'PlausibilityGate', fallback=True)
+
+    @property
+    def fallback_dpi(self):
+        return self.getint('parsing', 'FallbackDpi', fallback=600)
+
+
+_settings = None
+_settings_lock = threading.Lock()
+_reset_callbacks = []
+
+
+def on_configure(reset):
+    """
+    This function registers a function called when the settings of the process are changed by configure,
+    e.g. to drop a client or a store created from the previous settings so that the next use creates it from
+    the new ones.
+    :param reset: function without arguments
+    :return: reset, so that it can be used as a decorator
+    """
+    _reset_callbacks.append(reset)
+    return reset
+
+
+def configure(settings=None):
+    """
+    This function sets the settings of the process. The clients, caches and stores of the process created
+    from the previous settings are dropped and created again from the new ones on their next use.
+    :param settings: Settings, path of a config file, dictionary of sections or None to read the default
+     config file
+    :return: Settings
+    """
+    global _settings
+    if settings is None:
+        settings = os.environ.get('SH01_CONFIG', DEFAULT_CONFIG_PATH)
+    if isinstance(settings, (str, os.PathLike)):
+        settings = Settings.from_file(settings)
+    elif isinstance(settings, dict):
+        settings = Settings.from_dict(settings)
+    with _settings_lock:
+        _settings = settings
+    for reset in _reset_callbacks:
+        reset()
+    return settings
+
+
+def get_settings():
+    """
+    This function returns the settings of the process. Unless configure was called, they are read from the
+    file named by the SH01_CONFIG environment variable or config.txt, if it exists, and defaults otherwise.
+    :return: Settings
+    """
+    global _settings
+    with _settings_lock:
+        if _settings is None:
+            _settings = Settings()
+            _settings.read(os.environ.get('SH01_CONFIG', DEFAULT_CONFIG_PATH))
+        return _settings
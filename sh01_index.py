@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+
+from utils import open_sqlite
+
+
+def has_document(item):
+    """
+    This function tells if a filing history item links to its document. The link is sometimes added to the
+    item some time after the filing appears in the history.
+    :param item: filing history item
+    :return: bool
+    """
+    return 'document_metadata' in item.get('links', {})
+
+
+class SH01Index:
+    """
+    Persistent local index of the filing histories keyed by company house id. It stores the most recent
+    transaction seen for every company and all of its SH01 items, so that a refresh only pages through
+    the filings added since the last run and only downloads and parses the SH01 documents not processed yet.
+    """
+
+    def __init__(self, db_path):
+        self.conn = open_sqlite(db_path)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS companies (
+                    ch_id TEXT PRIMARY KEY,
+                    last_transaction_id TEXT,
+                    last_date TEXT,
+                    synced_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS sh01_items (
+                    transaction_id TEXT PRIMARY KEY,
+                    ch_id TEXT NOT NULL,
+                    date TEXT,
+                    item TEXT NOT NULL,
+                    processed INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS sh01_items_ch_id ON sh01_items (ch_id);
+            ''')
+
+    def known_transaction_ids(self, ch_id):
+        """
+        This function returns the transaction ids at which paging through the filing history can stop. While
+        SH01 items are pending without a document link, paging only stops at a resolved SH01 item older than
+        all of them, so that they are fetched again until they have their link.
+        :param ch_id: company house id
+        :return: set of transaction ids
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT transaction_id, date, item, processed FROM sh01_items WHERE ch_id = ?', (ch_id,)).fetchall()
+            last = self.conn.execute(
+                'SELECT last_transaction_id FROM companies WHERE ch_id = ?', (ch_id,)).fetchone()
+        resolved = {}
+        unlinked_dates = []
+        for transaction_id, date, item, processed in rows:
+            if processed or has_document(json.loads(item)):
+                resolved[transaction_id] = date or ''
+            else:
+                unlinked_dates.append(date or '')
+        if unlinked_dates:
+            oldest = min(unlinked_dates)
+            return {transaction_id for transaction_id, date in resolved.items() if date < oldest}
+        known = set(resolved)
+        if last is not None and last[0] is not None:
+            known.add(last[0])
+        return known
+
+    def record_history(self, ch_id, new_items):
+        """
+        This function stores the filing history items fetched since the last sync. An item fetched again
+        replaces the stored one as long as it is not processed, e.g. once its document link was added.
+        :param ch_id: company house id
+        :param new_items: filing history items, most recent first
+        :return:
+        """
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                for item in new_items:
+                    if item.get('type', '') != 'SH01':
+                        continue
+                    self.conn.execute(
+                        'INSERT INTO sh01_items (transaction_id, ch_id, date, item) VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT (transaction_id) DO UPDATE SET date = excluded.date, item = excluded.item '
+                        'WHERE processed = 0',
+                        (item['transaction_id'], ch_id, item.get('date'), json.dumps(item)))
+                if new_items:
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO companies (ch_id, last_transaction_id, last_date, synced_at) '
+                        'VALUES (?, ?, ?, ?)',
+                        (ch_id, new_items[0].get('transaction_id'), new_items[0].get('date'), time.time()))
+                else:
+                    self.conn.execute('UPDATE companies SET synced_at = ? WHERE ch_id = ?', (time.time(), ch_id))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def synced_since(self, ch_id, seconds):
+        """
+        This function tells if the filing history of a company was synced during the last seconds.
+        :param ch_id: company house id
+        :param seconds: maximum age of the sync
+        :return: bool
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT synced_at FROM companies WHERE ch_id = ?', (ch_id,)).fetchone()
+        return row is not None and row[0] is not None and time.time() - row[0] < seconds
+
+    def pending_sh01_items(self, ch_id):
+        """
+        This function returns the SH01 items of a company that have not been processed yet.
+        :param ch_id: company house id
+        :return: list of filing history items
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT item FROM sh01_items WHERE ch_id = ? AND processed = 0 ORDER BY date DESC', (ch_id,))
+            return [json.loads(r[0]) for r in rows]
+
+    def mark_processed(self, ch_id, transaction_id):
+        """
+        This function marks a SH01 document as downloaded and parsed.
+        :param ch_id: company house id
+        :param transaction_id: transaction id of the SH01 item
+        :return:
+        """
+        with self.lock:
+            self.conn.execute('UPDATE sh01_items SET processed = 1 WHERE ch_id = ? AND transaction_id = ?',
+                              (ch_id, transaction_id))
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+FILLER_TYPES = ['AA', 'CS01', 'PSC04', 'AD01', 'TM01', 'AP01']
+
+
+class StubCompaniesHouse:
+    """
+    Local stand-in for the Companies House API and document API, to measure the throughput of the pipeline
+    without the rate limits of the real services. The filing histories and PDFs are served from the documents
+    of a fixture folder laid out as the work directory (<ch_id>/<date>_<transaction_id>/metadata.json and
+    document.pdf). Synthetic companies reuse the fixture documents under new ids to scale out to thousands of
+    companies. Latency, rate limiting (429 with the X-Ratelimit-* headers) and random 429 or non-JSON
+    responses can be configured.
+    """
+
+    def __init__(self, fixtures_dir, n_synthetic=0, filler_items=0, latency=0.0, jitter=0.0,
+                 requests_per_window=0, window_seconds=300, error_rate=0.0, non_json_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.requests_per_window = requests_per_window
+        self.window_seconds = window_seconds
+        self.error_rate = error_rate
+        self.non_json_rate = non_json_rate
+        self.filler_items = filler_items
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_start = time.time()
+        self.window_count = 0
+        self.stats = {'requests': 0, 'rate_limited': 0, 'injected_429': 0, 'non_json': 0}
+        self.documents = {}
+        self.histories = {}
+        self._load_fixtures(Path(fixtures_dir))
+        fixture_ids = sorted(self.histories)
+        for i in range(n_synthetic if fixture_ids else 0):
+            self._add_synthetic(f'SYN{i:06d}', fixture_ids[i % len(fixture_ids)])
+
+    def _load_fixtures(self, fixtures_dir):
+        for metadata_path in sorted(fixtures_dir.glob('*/*/metadata.json')):
+            pdf_path = metadata_path.parent / 'document.pdf'
+            if not pdf_path.is_file():
+                continue
+            with open(metadata_path, 'r') as f:
+                item = json.load(f)
+            if 'links' not in item or 'document_metadata' not in item['links']:
+                continue
+            document_id = item['links']['document_metadata'].split('/')[-1]
+            self.documents[document_id] = pdf_path
+            self.histories.setdefault(metadata_path.parent.parent.name, []).append(item)
+        for ch_id, items in self.histories.items():
+            items.sort(key=lambda i: i.get('date', ''), reverse=True)
+            self.histories[ch_id] = self._with_filler(ch_id, items)
+
+    def _with_filler(self, ch_id, sh01_items):
+        # Other filings interleaved with the SH01 items, so that the histories span several pages
+        items = list(sh01_items)
+        for i in range(self.filler_items):
+            items.insert(self.random.randint(0, len(items)), {
+                'type': FILLER_TYPES[i % len(FILLER_TYPES)], 'category': 'other', 'date': '2015-01-01',
+                'transaction_id': f'FILLER{ch_id}{i:05d}', 'description': 'filler'})
+        return items
+
+    def _add_synthetic(self, ch_id, fixture_id):
+        items = []
+        for item in self.histories[fixture_id]:
+            item = json.loads(json.dumps(item))
+            item['transaction_id'] = item['transaction_id'] + ch_id
+            if 'links' in item and 'document_metadata' in item['links']:
+                document_id = item['links']['document_metadata'].split('/')[-1]
+                synthetic_id = f'{document_id}-{ch_id}'
+                self.documents[synthetic_id] = self.documents[document_id]
+                item['links']['document_metadata'] = f'/document/{synthetic_id}'
+                item['links']['self'] = f'/company/{ch_id}/filing-history/{item["transaction_id"]}'
+            items.append(item)
+        self.histories[ch_id] = items
+
+    def company_ids(self):
+        return sorted(self.histories)
+
+    def throttle(self):
+        """
+        This function counts a request against the rate limit and randomly injects failures.
+        :return: (status or None if the request is served, rate limit headers, inject a non-JSON body)
+        """
+        with self.lock:
+            self.stats['requests'] += 1
+            now = time.time()
+            if now - self.window_start >= self.window_seconds:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            headers = {}
+            if self.requests_per_window:
+                reset = self.window_start + self.window_seconds
+                headers = {'X-Ratelimit-Limit': str(self.requests_per_window),
+                           'X-Ratelimit-Remain': str(max(self.requests_per_window - self.window_count, 0)),
+                           'X-Ratelimit-Reset': str(int(reset)),
+                           'X-Ratelimit-Window': f'{self.window_seconds}s'}
+                if self.window_count > self.requests_per_window:
+                    self.stats['rate_limited'] += 1
+                    headers['Retry-After'] = str(max(int(reset - now), 1))
+                    return 429, headers, False
+            draw = self.random.random()
+            if draw < self.error_rate:
+                self.stats['injected_429'] += 1
+                headers['Retry-After'] = '1'
+                return 429, headers, False
+            if draw < self.error_rate + self.non_json_rate:
+                self.stats['non_json'] += 1
+                return None, headers, True
+            return None, headers, False
+
+    def wait(self):
+        if self.latency or self.jitter:
+            time.sleep(max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0))
+
+    def filing_history(self, ch_id, start_index, items_per_page):
+        items = self.histories.get(ch_id)
+        if items is None:
+            return None
+        return {'items': items[start_index:start_index + items_per_page], 'start_index': start_index,
+                'items_per_page': items_per_page, 'total_count': len(items), 'filing_history_status':
+                'filing-history-available'}
+
+    def document_metadata(self, document_id, base_url):
+        pdf_path = self.documents.get(document_id)
+        if pdf_path is None:
+            return None
+        return {'id': document_id, 'links': {'self': f'{base_url}/document/{document_id}',
+                                             'document': f'{base_url}/document/{document_id}/content'},
+                'resources': {'application/pdf': {'content_length': pdf_path.stat().st_size}}}
+
+    def serve(self, host='127.0.0.1', port=0):
+        """
+        This function starts the server on a background thread.
+        :param host: interface to listen on
+        :param port: port, 0 for any free port
+        :return: (server, base url)
+        """
+        server = ThreadingHTTPServer((host, port), _make_handler(self))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f'http://{host}:{server.server_address[1]}'
+
+
+def _make_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send(self, status, body=b'', headers=None, content_type='application/json'):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, data, headers, non_json):
+            if data is None:
+                self.send(404, json.dumps({'errors': [{'error': 'not-found'}]}).encode(), headers)
+            elif non_json:
+                # The API sometimes answers with an HTML page when it is overloaded
+                self.send(200, b'<html><body>Service unavailable</body></html>', headers, 'text/html')
+            else:
+                self.send(200, json.dumps(data).encode(), headers)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path.startswith('/storage/'):
+                # Storage bucket of the document contents, not rate limited
+                pdf_path = stub.documents.get(url.path[len('/storage/'):].removesuffix('.pdf'))
+                if pdf_path is None:
+                    self.send(404)
+                else:
+                    stub.wait()
+                    self.send(200, pdf_path.read_bytes(), content_type='application/pdf')
+                return
+            stub.wait()
+            status, headers, non_json = stub.throttle()
+            if status is not None:
+                self.send(status, json.dumps({'error': 'rate limit exceeded'}).encode(), headers)
+                return
+            match = re.fullmatch(r'/company/([^/]+)/filing-history', url.path)
+            if match:
+                query = parse_qs(url.query)
+                start_index = int(query.get('start_index', ['0'])[0])
+                items_per_page = min(int(query.get('items_per_page', ['25'])[0]), 100)
+                self.send_json(stub.filing_history(match.group(1), start_index, items_per_page), headers, non_json)
+                return
+            match = re.fullmatch(r'/document/([^/]+)/content', url.path)
+            if match:
+                if match.group(1) not in stub.documents:
+                    self.send(404, headers=headers)
+                    return
+                self.send(302, headers=dict(headers, Location=f'/storage/{match.group(1)}.pdf'))
+                return
+            match = re.fullmatch(r'/document/([^/]+)', url.path)
+            if match:
+                base_url = f'http://{self.headers.get("Host", "")}'
+                self.send_json(stub.document_metadata(match.group(1), base_url), headers, non_json)
+                return
+            self.send(404)
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a local stand-in of the Companies House API and '
+                                                 'document API from fixture documents. Point ApiBaseUrl and '
+                                                 'DocumentApiBaseUrl of the config at it.')
+    parser.add_argument('--fixtures', default='data', help='folder with <ch_id>/<date>_<transaction_id>/ documents')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--companies', type=int, default=0, help='number of synthetic companies to add')
+    parser.add_argument('--filler-items', type=int, default=150,
+                        help='non SH01 filings added to every filing history, to exercise the pagination')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='maximum random variation of the latency')
+    parser.add_argument('--requests-per-window', type=int, default=600, help='rate limit, 0 to disable it')
+    parser.add_argument('--window-seconds', type=float, default=300)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 429')
+    parser.add_argument('--non-json-rate', type=float, default=0.0,
+                        help='share of requests answered with a non-JSON body')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--write-ids', help='file to write the company house ids served, one per line')
+    args = parser.parse_args()
+
+    stub = StubCompaniesHouse(args.fixtures, n_synthetic=args.companies, filler_items=args.filler_items,
+                              latency=args.latency, jitter=args.jitter,
+                              requests_per_window=args.requests_per_window, window_seconds=args.window_seconds,
+                              error_rate=args.error_rate, non_json_rate=args.non_json_rate, seed=args.seed)
+    if args.write_ids:
+        with open(args.write_ids, 'w') as f:
+            f.write('\n'.join(stub.company_ids()) + '\n')
+    server, base_url = stub.serve(args.host, args.port)
+    print(f'Serving {len(stub.histories)} companies and {len(stub.documents)} documents on {base_url}')
+    try:
+        while True:
+            time.sleep(60)
+            print(json.dumps(stub.stats))
+    except KeyboardInterrupt:
+        server.shutdown()
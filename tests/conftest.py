@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+import sys
+from pathlib import Path
+
+# The modules of the repository are at its top level
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+import utils
+from content_cache import ContentCache, content_key
+from ocr_engine import OcrWord
+from settings import configure
+from utils import open_sqlite
+
+
+def open_cache(tmp_path, max_bytes=1000, enabled=True):
+    root = tmp_path / 'cache'
+    return ContentCache(open_sqlite(str(root / 'index.sqlite'), wal=True), root, max_bytes=max_bytes,
+                        enabled=enabled)
+
+
+def test_put_and_get(tmp_path):
+    cache = open_cache(tmp_path, max_bytes=1 << 20)
+    key = content_key('ocr_text', b'crop', 6, 'tesseract 5.3.0')
+    assert cache.get_json('ocr_text', key) is None
+    cache.put_json('ocr_text', key, 'total number of shares 100')
+    assert cache.get_json('ocr_text', key) == 'total number of shares 100'
+
+    img = np.arange(200, dtype=np.uint8).reshape(10, 20)
+    cache.put_image('page', content_key('page_gray', 'sha', 0, 250), img)
+    assert np.array_equal(cache.get_image('page', content_key('page_gray', 'sha', 0, 250)), img)
+    assert set(cache.stats()) == {'ocr_text', 'page'}
+
+
+def test_disabled_cache_and_large_entries_are_not_stored(tmp_path):
+    disabled = open_cache(tmp_path / 'disabled', enabled=False)
+    disabled.put_bytes('page', 'a' * 40, b'x')
+    assert disabled.get_bytes('page', 'a' * 40) is None
+    cache = open_cache(tmp_path)
+    cache.put_bytes('page', 'b' * 40, b'x' * 101)
+    assert cache.get_bytes('page', 'b' * 40) is None
+    assert cache.size() == 0
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = open_cache(tmp_path)
+    keys = [content_key(i) for i in range(10)]
+    for i, key in enumerate(keys):
+        cache.put_bytes('ocr_text', key, bytes(100))
+        if i == 0:
+            # Put again: the size is replaced, not added
+            cache.put_bytes('ocr_text', key, bytes(100))
+    assert cache.size() == 1000
+    assert cache.get_bytes('ocr_text', keys[0]) is not None
+
+    cache.put_bytes('ocr_text', content_key(10), bytes(100))
+    # Evicted down to 90% of the size, least recently used first
+    assert cache.size() == 900
+    assert [cache.get_bytes('ocr_text', key) is not None for key in keys] == [True] + [False, False] + [True] * 7
+    assert not any((tmp_path / 'cache' / key[:2] / key).exists() for key in keys[1:3])
+
+
+def test_processes_share_the_total(tmp_path):
+    first, second = open_cache(tmp_path, max_bytes=10000), open_cache(tmp_path, max_bytes=10000)
+    first.put_bytes('page', content_key(1), bytes(300))
+    second.put_bytes('page', content_key(2), bytes(300))
+    assert first.size() == second.size() == 600
+    first.clear()
+    assert second.size() == 0 and second.stats() == {}
+
+
+class CountingEngine:
+    version = 'fake 1.0'
+
+    def __init__(self):
+        self.calls = []
+
+    def image_to_text(self, img, psm, dpi=None):
+        self.calls.append(('text', psm))
+        return 'total number of shares 100'
+
+    def image_to_data(self, img, psm, dpi=None):
+        self.calls.append(('words', psm))
+        return [OcrWord('100', 1, 2, 3, 4, 95.0, 1, 1, 1, 1)]
+
+
+def test_ocr_results_are_reused_for_the_same_pixels_and_settings(tmp_path, monkeypatch):
+    configure({'general': {'Dir': str(tmp_path)}})
+    engine = CountingEngine()
+    monkeypatch.setattr(utils, '_ocr_engine', engine)
+    crop = np.zeros((10, 20), dtype=np.uint8)
+    for _ in range(2):
+        assert utils.recognize_text(crop, 6) == 'total number of shares 100'
+        assert utils.ocr_image_words(crop, 6) == [OcrWord('100', 1, 2, 3, 4, 95.0, 1, 1, 1, 1)]
+    utils.recognize_text(crop, 4)
+    utils.recognize_text(crop + 1, 6)
+    engine.version = 'fake 2.0'
+    utils.recognize_text(crop, 6)
+    assert engine.calls == [('text', 6), ('words', 6), ('text', 4), ('text', 6), ('text', 6)]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import os
+
+import pytest
+import requests
+
+import document_downloader
+from document_downloader import DocumentDownloader, DownloadError, document_sha256, is_download_complete
+
+
+class FakeClient:
+    api_key = 'key'
+
+    def __init__(self, status_code, body, headers=None):
+        self.status_code, self.body, self.headers = status_code, body, headers or {}
+
+    def get(self, url, **kwargs):
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.raw = io.BytesIO(self.body)
+        response.headers.update(self.headers)
+        return response
+
+
+@pytest.mark.parametrize('client', [
+    FakeClient(404, b'not found'),
+    FakeClient(200, b'<html>error</html>'),
+    FakeClient(200, b'%PDF-1.4\n', {'Content-Length': '100'}),
+])
+def test_failed_download_leaves_nothing_behind(tmp_path, client):
+    pdf_path = str(tmp_path / 'document.pdf')
+    with pytest.raises(DownloadError):
+        DocumentDownloader(client).download('DOC1', pdf_path)
+    assert os.listdir(tmp_path) == []
+
+
+def test_download_writes_the_document_and_its_checksum(tmp_path):
+    pdf_path = str(tmp_path / 'document.pdf')
+    DocumentDownloader(FakeClient(200, b'%PDF-1.4\n%%EOF\n')).download('DOC1', pdf_path)
+    assert sorted(os.listdir(tmp_path)) == ['document.pdf', 'document.pdf.sha256']
+
+
+def test_unchanged_download_is_not_hashed_again(tmp_path, monkeypatch):
+    pdf_path = str(tmp_path / 'document.pdf')
+    digest = DocumentDownloader(FakeClient(200, b'%PDF-1.4\n%%EOF\n')).download('DOC1', pdf_path)
+    hashed = []
+    monkeypatch.setattr(document_downloader, 'file_sha256', lambda path: hashed.append(path) or digest)
+    assert is_download_complete(pdf_path)
+    assert hashed == []
+    assert document_sha256(pdf_path) == digest
+
+
+def test_modified_download_is_hashed_again(tmp_path):
+    pdf_path = str(tmp_path / 'document.pdf')
+    DocumentDownloader(FakeClient(200, b'%PDF-1.4\n%%EOF\n')).download('DOC1', pdf_path)
+    with open(pdf_path, 'ab') as f:
+        f.write(b'garbage')
+    assert not is_download_complete(pdf_path)
+
+
+def test_checksum_file_without_stat_is_upgraded(tmp_path, monkeypatch):
+    pdf_path = tmp_path / 'document.pdf'
+    pdf_path.write_bytes(b'%PDF-1.4\n%%EOF\n')
+    digest = hashlib.sha256(pdf_path.read_bytes()).hexdigest()
+    (tmp_path / 'document.pdf.sha256').write_text(f'{digest}  document.pdf\n')
+    assert is_download_complete(str(pdf_path))
+    monkeypatch.setattr(document_downloader, 'file_sha256', lambda path: pytest.fail('hashed again'))
+    assert is_download_complete(str(pdf_path))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import shutil
+from pathlib import Path
+
+import pytest
+
+from document_parser import DocumentProcessorFactory
+
+DATA = Path(__file__).resolve().parent.parent / 'data' / 'SC428761'
+OFFLINE6 = DATA / '2017-10-11_MzE4OTc0NDQwM2FkaXF6a2N4'
+ONLINE = DATA / '2018-11-23_MzI3NjAxMTQ0NWFkaXF6a2N4'
+
+
+def processor(tmp_path, doc_dir, form_type):
+    shutil.copy(doc_dir / 'metadata.json', tmp_path / 'metadata.json')
+    return DocumentProcessorFactory.create_processor(form_type, str(tmp_path) + '/')
+
+
+@pytest.mark.parametrize('doc_dir, form_type, text, expected', [
+    (OFFLINE6, 'offline6', 'ist total aggregate\n123405 £123.405', 123405.0),
+    (ONLINE, 'online', 'total number of shares 217825\n', 217825.0),
+])
+def test_total_shares_is_a_float_on_every_path(tmp_path, doc_dir, form_type, text, expected):
+    doc_processor = processor(tmp_path, doc_dir, form_type)
+    assert doc_processor.recognizer is None
+    doc_processor.extract_share_price_n_allotted = lambda: (1.0, 10.0)
+    doc_processor.extract_total_shares = lambda: doc_processor.parse_total_shares(text)
+    total_shares = doc_processor.parse_document()['total_shares']
+    assert total_shares == expected and type(total_shares) is float
+    assert type(doc_processor.parse_total_shares_field(text)) is float
+
+
+def test_total_shares_that_is_not_a_number_is_missing(tmp_path):
+    doc_processor = processor(tmp_path, OFFLINE6, 'offline6')
+    doc_processor.extract_share_price_n_allotted = lambda: (1.0, 10.0)
+    doc_processor.extract_total_shares = lambda: '12a405'
+    assert doc_processor.parse_document()['total_shares'] is None
+    assert doc_processor.parse_total_shares_field('ist total aggregate\n000000 £0') is None
+
+
+def gated_processor(tmp_path, fallback_values):
+    doc_processor = processor(tmp_path, ONLINE, 'online')
+    runs = []
+
+    def iter_fallback_values(field, parse):
+        runs.append(field)
+        for value in fallback_values.get(field, ()):
+            yield value, 're_ocr'
+
+    doc_processor.iter_fallback_values = iter_fallback_values
+    return doc_processor, runs
+
+
+def test_plausible_values_skip_the_fallback_passes(tmp_path):
+    doc_processor, runs = gated_processor(tmp_path, {})
+    values = {'share_price': 0.001, 'n_allotted': 4324.0, 'total_shares': 217825.0}
+    assert doc_processor.apply_plausibility_gate(values) == (values, [])
+    assert runs == []
+
+
+def test_misread_total_is_replaced_by_the_first_plausible_fallback_value(tmp_path):
+    # 167825 gives a nominal value of £0.0013 against a capital of £217.825
+    doc_processor, runs = gated_processor(tmp_path, {'total_shares': [317825.0, 217825.0, 2178250.0]})
+    values, failed = doc_processor.apply_plausibility_gate(
+        {'share_price': 0.001, 'n_allotted': 4324.0, 'total_shares': 167825.0})
+    assert values == {'share_price': 0.001, 'n_allotted': 4324.0, 'total_shares': 217825.0}
+    assert failed == [] and runs == ['total_shares']
+
+
+def test_implausible_value_is_kept_without_a_better_fallback(tmp_path):
+    doc_processor, runs = gated_processor(tmp_path, {'total_shares': [317825.0]})
+    values, failed = doc_processor.apply_plausibility_gate(
+        {'share_price': 0.001, 'n_allotted': 4324.0, 'total_shares': 167825.0})
+    assert values['total_shares'] == 167825.0
+    assert failed == [('nominal_not_round', ('total_shares',))]
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+import form_layouts
+from form_layouts import FOOTER_REGION, LAYOUTS, LayoutRecognizer, page_pass
+from ocr_engine import OcrWord
+
+
+class FakePages:
+    dpi = 100
+
+    def __init__(self, n_pages=4):
+        self.n_pages = n_pages
+
+    def page(self, n, dpi=None, keep=True):
+        return np.full((1000, 800), 255, dtype=np.uint8) if n < self.n_pages else None
+
+
+def word(text, left, top, line, n):
+    return OcrWord(text, left, top, 40, 10, 95.0, 1, 1, line, n)
+
+
+@pytest.fixture
+def ocr_calls(monkeypatch):
+    calls = []
+
+    def ocr_image_words(crop, psm, dpi):
+        calls.append((crop.shape, psm))
+        # Two lines at the top of the crop, positions relative to the crop
+        return [word('total', 10, 10, 1, 1), word('number', 60, 10, 1, 2), word('100', 10, 300, 2, 1)]
+
+    monkeypatch.setattr(form_layouts, 'ocr_image_words', ocr_image_words)
+    return calls
+
+
+def test_page_pass_covers_the_fields_with_the_same_border_removal():
+    assert page_pass(2, 'online') == ((0, 50, 0, 100), 6, False)
+    assert page_pass(0, 'offline6') is None
+    assert page_pass(0, 'offline6', remove_borders=True) == ((50, 90, 0, 100), 6, True)
+    # Before the form type is known, the first page is read with the footer
+    region, psm, _ = page_pass(0)
+    assert psm == 6 and region == (39, 100, 0, 100)
+    assert page_pass(0, remove_borders=True) == ((50, 90, 0, 100), 6, True)
+    assert page_pass(1) == (FOOTER_REGION, 6, False)
+
+
+def test_region_text_reuses_a_covering_pass(ocr_calls):
+    recognizer = LayoutRecognizer(FakePages())
+    layout = LAYOUTS['online']['total_shares']
+    region, psm, remove_borders = page_pass(2, 'online')
+    assert recognizer.region_text(2, layout.region, psm, remove_borders, region) == 'total number\n100'
+    # A region inside the pass is read from its words, without another OCR call
+    assert recognizer.region_text(2, (0, 3, 0, 100), psm) == 'total number'
+    assert recognizer.n_ocr_calls == 1
+    # A pass without border removal does not serve a field read with border removal
+    recognizer.region_text(2, (0, 3, 0, 100), psm, remove_borders=True)
+    assert recognizer.n_ocr_calls == 2
+    # Nor a pass at another resolution
+    recognizer.region_text(2, (0, 3, 0, 100), psm, dpi=200)
+    assert recognizer.n_ocr_calls == 3
+    assert recognizer.region_text(7, (0, 3, 0, 100), psm) is None
+
+
+def test_re_ocr_of_a_field_crop(ocr_calls):
+    recognizer = LayoutRecognizer(FakePages())
+    recognizer.region_text(2, (0, 50, 0, 100), 6)
+    recognizer.region_text(2, (0, 50, 0, 100), 4, reuse=False)
+    recognizer.region_text(2, (0, 50, 0, 100), 4, reuse=False)
+    assert [psm for _, psm in ocr_calls] == [6, 4]
+    assert ocr_calls[0][0] == (500, 800)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import datetime
+import sqlite3
+
+import pytest
+import requests
+
+from fx_rates import ExchangeRatesApiSource, FxRateError, FxRateProvider
+
+FRIDAY = datetime.date(2020, 1, 3)
+
+
+class FakeSource:
+    name = 'fake'
+
+    def __init__(self, rates):
+        self.rates = rates
+
+    def get_rates(self, start, end, base):
+        return {d: r for d, r in self.rates.items() if start <= d <= end}
+
+
+def test_days_after_the_newest_rate_are_not_stored():
+    source = FakeSource({FRIDAY - datetime.timedelta(days=1): 0.75, FRIDAY: 0.76})
+    provider = FxRateProvider(sqlite3.connect(':memory:'), source)
+    saturday = FRIDAY + datetime.timedelta(days=1)
+    monday = FRIDAY + datetime.timedelta(days=3)
+
+    assert provider.prefetch(FRIDAY, monday, bases=('USD',)) == 1
+    rate = provider.get_rate(monday, 'USD')
+    assert (rate['rate'], rate['rate_date']) == (0.76, FRIDAY.isoformat())
+
+    # Once the rate of the Monday is published, it is used instead of the rate of the Friday
+    source.rates[monday] = 0.8
+    assert provider.get_rate(monday, 'USD')['rate'] == 0.8
+    assert provider.get_rate(saturday, 'USD')['rate'] == 0.76
+
+
+class FakeSession:
+    def __init__(self, status_code=200, body=b'', error=None):
+        self.status_code, self.body, self.error = status_code, body, error
+
+    def get(self, url, **kwargs):
+        if self.error is not None:
+            raise self.error
+        response = requests.Response()
+        response.status_code = self.status_code
+        response._content = self.body
+        response.url = url + '?access_key=secret'
+        return response
+
+
+@pytest.mark.parametrize('session', [
+    FakeSession(error=requests.ConnectionError('connection refused')),
+    FakeSession(error=requests.Timeout('read timed out')),
+    FakeSession(401, b'{"error": "invalid access key"}'),
+    FakeSession(200, b'<html>maintenance</html>'),
+    FakeSession(200, b'{"error": "no rates"}'),
+])
+def test_source_errors_raise_fx_rate_error(session):
+    source = ExchangeRatesApiSource(access_key='secret')
+    source.session = session
+    with pytest.raises(FxRateError) as error:
+        source.get_rates(FRIDAY - datetime.timedelta(days=7), FRIDAY, 'USD')
+    assert 'secret' not in str(error.value)
+
+
+def test_source_returns_the_rates_by_date():
+    source = ExchangeRatesApiSource()
+    source.session = FakeSession(200, b'{"rates": {"2020-01-03": {"GBP": 0.76}}}')
+    assert source.get_rates(FRIDAY - datetime.timedelta(days=7), FRIDAY, 'USD') == {FRIDAY: 0.76}
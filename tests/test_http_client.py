@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import io
+
+import pytest
+import requests
+
+from http_client import CompaniesHouseClient
+
+
+def response(status_code, body):
+    r = requests.Response()
+    r.status_code = status_code
+    r._content = body
+    r.raw = io.BytesIO(body)
+    r.url = 'http://api.example/company/SC000001/filing-history'
+    return r
+
+
+def client_answering(responses, max_retries=2):
+    client = CompaniesHouseClient('key', max_retries=max_retries, backoff_factor=0)
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        return responses[min(len(calls), len(responses)) - 1]
+
+    client.session.get = get
+    return client, calls
+
+
+def test_get_json_raises_when_throttled_after_the_last_retry():
+    client, calls = client_answering([response(429, b'{"error": "too many requests"}')])
+    with pytest.raises(requests.HTTPError):
+        client.get_json('http://api.example/company/SC000001/filing-history')
+    assert len(calls) == 3
+
+
+def test_get_json_retries_non_json_bodies_within_max_retries():
+    client, calls = client_answering([response(200, b'<html>overloaded</html>')])
+    with pytest.raises(ValueError):
+        client.get_json('http://api.example/company/SC000001/filing-history')
+    assert len(calls) == 3
+
+
+def test_get_json_returns_the_body_after_a_retry():
+    client, calls = client_answering([response(503, b''), response(200, b'{"items": []}')])
+    assert client.get_json('http://api.example/company/SC000001/filing-history') == {'items': []}
+    assert len(calls) == 2
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import json
+import socket
+
+import pytest
+
+from metrics import Metrics, event_logger, log_event, setup_metrics
+
+
+def test_prometheus_counters_keep_their_precision():
+    metrics = Metrics()
+    metrics.inc('download_bytes', 123456790)
+    assert 'sh01_download_bytes_total 123456790.0\n' in metrics.to_prometheus()
+
+
+def test_setup_metrics_twice_serves_the_port_once():
+    with socket.socket() as s:
+        s.bind(('', 0))
+        port = s.getsockname()[1]
+    setup_metrics(prometheus_port=port)
+    setup_metrics(prometheus_port=port)
+
+
+def test_prometheus_families_are_typed():
+    metrics = Metrics()
+    metrics.inc('documents', stage='parsed', form_type='online')
+    metrics.inc('documents', stage='downloaded')
+    metrics.inc('api_requests', status=200)
+    metrics.observe('ocr', 0.5, psm=6)
+    metrics.observe('ocr', 0.25, psm=6)
+    metrics.observe('ocr', 1.0, psm=4)
+    assert metrics.to_prometheus() == (
+        '# TYPE sh01_api_requests_total counter\n'
+        'sh01_api_requests_total{status="200"} 1.0\n'
+        '# TYPE sh01_documents_total counter\n'
+        'sh01_documents_total{form_type="online",stage="parsed"} 1.0\n'
+        'sh01_documents_total{stage="downloaded"} 1.0\n'
+        '# TYPE sh01_ocr_seconds summary\n'
+        'sh01_ocr_seconds_count{psm="4"} 1\n'
+        'sh01_ocr_seconds_sum{psm="4"} 1.000000\n'
+        'sh01_ocr_seconds_count{psm="6"} 2\n'
+        'sh01_ocr_seconds_sum{psm="6"} 0.750000\n'
+        '# TYPE sh01_ocr_seconds_max gauge\n'
+        'sh01_ocr_seconds_max{psm="4"} 1.000000\n'
+        'sh01_ocr_seconds_max{psm="6"} 0.500000\n')
+
+
+def test_worker_metrics_are_merged():
+    worker = Metrics()
+    worker.inc('documents', stage='parsed')
+    with pytest.raises(ValueError), worker.timer('parse', form_type='online'):
+        raise ValueError('unreadable')
+    state = worker.drain()
+    assert worker.snapshot() == {'counters': [], 'timers': []}
+
+    main = Metrics()
+    main.inc('documents', 2, stage='parsed')
+    main.observe('parse', 10.0, form_type='online')
+    main.merge(state)
+    snapshot = main.snapshot()
+    assert snapshot['counters'] == [{'name': 'documents', 'labels': {'stage': 'parsed'}, 'value': 3.0}]
+    [timer] = snapshot['timers']
+    assert (timer['name'], timer['labels'], timer['count'], timer['max']) == ('parse', {'form_type': 'online'}, 2,
+                                                                              10.0)
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics(enabled=False)
+    metrics.inc('documents')
+    metrics.observe('parse', 1.0)
+    assert metrics.snapshot() == {'counters': [], 'timers': []}
+
+
+def test_events_are_json_lines(tmp_path):
+    log_path = tmp_path / 'events.jsonl'
+    setup_metrics(log_path=str(log_path))
+    setup_metrics(log_path=str(log_path))
+    log_event('document_parsed', ch_id='SC000001', share_price=1.5)
+    for handler in list(event_logger.handlers):
+        handler.close()
+        event_logger.removeHandler(handler)
+    [line] = log_path.read_text().splitlines()
+    event = json.loads(line)
+    assert (event['event'], event['ch_id'], event['share_price']) == ('document_parsed', 'SC000001', 1.5)
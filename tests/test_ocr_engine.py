@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import sys
+import types
+
+import numpy as np
+
+from ocr_engine import TesserocrEngine, parse_tsv
+
+TSV = ('level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext\n'
+       '1\t1\t0\t0\t0\t0\t0\t0\t100\t50\t-1\t\n'
+       '5\t1\t1\t1\t1\t1\t10\t12\t30\t8\t95.5\t1,000\n'
+       '5\t1\t1\t1\t1\t2\t45\t12\t20\t8\t91\t\n')
+
+
+class FakeApi:
+    def __init__(self, lang):
+        self.calls = []
+
+    def SetPageSegMode(self, psm):
+        assert type(psm) is int
+        self.calls.append(('psm', psm))
+
+    def SetImageBytes(self, data, width, height, bytes_per_pixel, bytes_per_line):
+        self.calls.append(('image', width, height, bytes_per_pixel))
+
+    def SetSourceResolution(self, dpi):
+        self.calls.append(('dpi', dpi))
+
+    def GetUTF8Text(self):
+        return '1,000\n'
+
+    def GetTSVText(self, page):
+        return TSV
+
+
+class PSM:
+    def __init__(self, *args):
+        raise TypeError('PSM is an enum and cannot be instantiated')
+
+
+def fake_engine(monkeypatch):
+    tesserocr = types.ModuleType('tesserocr')
+    tesserocr.PSM = PSM
+    tesserocr.PyTessBaseAPI = FakeApi
+    tesserocr.tesseract_version = lambda: 'tesseract 5.3.0\n leptonica'
+    monkeypatch.setitem(sys.modules, 'tesserocr', tesserocr)
+    return TesserocrEngine()
+
+
+def test_set_image_passes_psm_as_int(monkeypatch):
+    engine = fake_engine(monkeypatch)
+    img = np.zeros((20, 30, 3), dtype=np.uint8)
+    assert engine.image_to_text(img, 7, dpi=300) == '1,000\n'
+    assert engine._api().calls == [('psm', 7), ('image', 30, 20, 1), ('dpi', 300)]
+    assert engine.version == 'tesserocr tesseract 5.3.0'
+
+
+def test_image_to_data_keeps_only_words(monkeypatch):
+    words = fake_engine(monkeypatch).image_to_data(np.zeros((20, 30), dtype=np.uint8), 6)
+    assert words == parse_tsv(TSV)
+    assert [(w.text, w.left, w.conf, w.word) for w in words] == [('1,000', 10, 95.5, 1)]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import types
+
+import cv2
+import numpy as np
+
+from page_provider import PageProvider, RASTERIZED_DPI
+
+NO_CACHE = types.SimpleNamespace(enabled=False)
+
+
+def legacy_document(tmp_path, n_pages=3, shape=(800, 640)):
+    (tmp_path / 'pages').mkdir()
+    for n in range(n_pages):
+        page = np.full(shape, 255, dtype=np.uint8)
+        page[100:200, 100:300] = 30 * n
+        cv2.imwrite(str(tmp_path / 'pages' / f'{n}.jpeg'), page)
+    return str(tmp_path) + '/'
+
+
+def test_legacy_pages_are_decoded_in_grayscale_at_the_requested_resolution(tmp_path):
+    pages = PageProvider(legacy_document(tmp_path), content_cache=NO_CACHE)
+    assert pages.page_count() == 3
+    assert pages.source_dpi(0) == RASTERIZED_DPI
+    full = pages.page(1)
+    assert full.shape == (800, 640) and full.ndim == 2
+    assert pages.page(1, dpi=RASTERIZED_DPI // 4).shape == (200, 160)
+    assert pages.page(1, dpi=200).shape == (320, 256)
+    assert pages.page(3) is None
+
+
+def test_cached_pages_stay_within_the_byte_budget(tmp_path):
+    page_bytes = 800 * 640
+    pages = PageProvider(legacy_document(tmp_path), max_cache_bytes=2 * page_bytes, content_cache=NO_CACHE)
+    first = pages.page(0)
+    assert pages.page(0) is first
+    pages.page(1)
+    pages.page(0)
+    pages.page(2)
+    # Page 1 is the least recently used one
+    assert list(pages._cache) == [(0, RASTERIZED_DPI), (2, RASTERIZED_DPI)]
+    assert pages._cache_bytes == 2 * page_bytes
+
+
+def test_region_of_a_page_not_kept_is_a_copy(tmp_path):
+    pages = PageProvider(legacy_document(tmp_path), content_cache=NO_CACHE)
+    region = pages.region(2, x0=10, x1=30, y0=10, y1=50, keep=False)
+    assert region.shape == (160, 256) and region.base is None
+    assert int(region[20, 50]) < 128
+    assert pages._cache_bytes == 0
+    kept = pages.region(2, x0=10, x1=30, y0=10, y1=50)
+    assert kept.base is not None and pages._cache_bytes == 800 * 640
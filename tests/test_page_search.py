@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+from page_search import PageHitStats, search_pages
+
+
+def stats_at(tmp_path):
+    return PageHitStats(str(tmp_path / 'page_hits.sqlite'))
+
+
+def test_counts_of_several_processes_add_up(tmp_path):
+    first, second = stats_at(tmp_path), stats_at(tmp_path)
+    for _ in range(3):
+        first.record('online_total_shares', 4)
+    second.record('online_total_shares', 4)
+    second.record('online_total_shares', 2)
+    first.flush()
+    second.flush()
+    assert second.counts == {('online_total_shares', 4): 4, ('online_total_shares', 2): 1}
+    assert stats_at(tmp_path).order('online_total_shares', [2, 3, 4]) == [4, 2, 3]
+
+
+def test_order_only_changes_when_flushed(tmp_path):
+    stats = stats_at(tmp_path)
+    # Pages with the same count keep their original order
+    assert stats.order('offline6_total_shares', [3, 1, 2]) == [3, 1, 2]
+    stats.record('offline6_total_shares', 2)
+    assert stats.order('offline6_total_shares', [3, 1, 2]) == [3, 1, 2]
+    stats.flush()
+    assert stats.order('offline6_total_shares', [3, 1, 2]) == [2, 3, 1]
+
+
+@pytest.mark.parametrize('max_workers', [1, 3])
+def test_several_matching_pages_give_the_same_page(tmp_path, max_workers):
+    stats = stats_at(tmp_path)
+    texts = {2: 'cover', 3: 'total number of shares 100', 4: 'notes', 5: 'total number of shares 200'}
+    extracted = []
+    lock = threading.Lock()
+
+    def extract(page):
+        with lock:
+            extracted.append(page)
+        return texts[page]
+
+    for _ in range(3):
+        found = search_pages([2, 3, 4, 5], extract, lambda text: 'total number' in text, key='online',
+                             max_workers=max_workers, stats=stats)
+        assert found == (3, texts[3])
+    if max_workers == 1:
+        assert 5 not in extracted
+    stats.flush()
+    # Once page 3 is the most likely, it is searched first and still wins
+    assert stats.order('online', [2, 3, 4, 5]) == [3, 2, 4, 5]
+    assert search_pages([2, 3, 4, 5], extract, lambda text: 'total number' in text, key='online',
+                        max_workers=max_workers, stats=stats) == (3, texts[3])
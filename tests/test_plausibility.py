@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import json
+from pathlib import Path
+
+import pytest
+
+from plausibility import check_values, is_round_nominal, nominal_value
+
+DATA = Path(__file__).resolve().parent.parent / 'data'
+GROUND_TRUTH = sorted(DATA.glob('*/*/result.json'))
+
+
+@pytest.mark.parametrize('result_path', GROUND_TRUTH, ids=lambda path: path.parent.name)
+def test_ground_truth_is_plausible(result_path):
+    with open(result_path, 'r') as f:
+        result = json.load(f)
+    capital = result['capital']
+    assert check_values(result['share_price'], result['n_allotted'], result['total_shares'], capital,
+                        price_in_capital_currency=capital['currency'] == 'GBP') == []
+
+
+def test_ground_truth_is_found():
+    assert len(GROUND_TRUTH) >= 6
+
+
+@pytest.mark.parametrize('nominal, expected', [(1, True), (0.001, True), (0.25, True), (2.5e-5, True),
+                                               (0.0013, False), (0, False), (None, False)])
+def test_is_round_nominal(nominal, expected):
+    assert is_round_nominal(nominal) == expected
+
+
+def test_misread_total_fails_the_nominal_check():
+    capital = {'figure': 157.137, 'currency': 'GBP'}
+    assert nominal_value(capital, 157137) == pytest.approx(0.001)
+    # A misread digit gives a nominal value of £0.00094, which is not round
+    assert check_values(635.91, 29408, 167137, capital) == [('nominal_not_round', ('total_shares',))]
+
+
+def test_missing_and_inconsistent_values():
+    assert check_values(None, 10, 5) == [('missing', ('share_price',)),
+                                         ('total_below_allotted', ('total_shares', 'n_allotted'))]
+    assert check_values(0.0005, 10, '1000', {'figure': 1.0, 'currency': 'GBP'}, price_in_capital_currency=True) \
+        == [('price_below_nominal', ('share_price',))]
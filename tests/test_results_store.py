@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import shutil
+from pathlib import Path
+
+from results_store import RESULT_COLUMNS, ResultsStore, export_results
+
+DATA = Path(__file__).resolve().parent.parent / 'data'
+
+
+def record(transaction_id, date, **values):
+    return dict({'transaction_id': transaction_id, 'date': date, 'form_type': 'online', 'share_price': 1.0,
+                 'n_allotted': 10.0, 'total_shares': 100.0}, **values)
+
+
+def test_append_replaces_a_transaction_and_query_filters(tmp_path):
+    store = ResultsStore(str(tmp_path / 'results.sqlite'))
+    store.append('SC000002', record('TX3', '2019-01-01'))
+    store.append_many([('SC000001', record('TX2', '2020-01-01', form_type='offline6', total_shares='123405')),
+                       ('SC000001', record('TX1', '2018-01-01', capital={'figure': 0.1, 'currency': 'GBP'},
+                                           fx_rate={'rate': 0.76, 'source': 'csv:rates.csv'})),
+                       ('SC000001', {'date': '2018-01-01'})])
+    store.append('SC000001', record('TX2', '2020-01-01', form_type='offline6', total_shares='not a number'))
+
+    assert [row['transaction_id'] for row in store.query()] == ['TX1', 'TX2', 'TX3']
+    rows = list(store.query(ch_id='SC000001', since='2018-06-01'))
+    assert [(row['transaction_id'], row['total_shares']) for row in rows] == [('TX2', None)]
+    assert [row['transaction_id'] for row in store.query(form_type='online', until='2018-12-31')] == ['TX1']
+    first = next(store.query(ch_id='SC000001'))
+    assert (first['capital_figure'], first['capital_currency'], first['fx_rate'], first['fx_source']) == \
+        (0.1, 'GBP', 0.76, 'csv:rates.csv')
+
+
+def test_backfill_and_export(tmp_path):
+    shutil.copytree(DATA / 'SC428761', tmp_path / 'SC428761', ignore=shutil.ignore_patterns('*.pdf', 'pages'))
+    store = ResultsStore(str(tmp_path / 'results.sqlite'))
+    assert store.backfill(tmp_path, batch_size=4) == 6
+
+    output = io.StringIO()
+    assert store.export_csv(output, since='2019-01-01') == 3
+    rows = list(csv.DictReader(io.StringIO(output.getvalue())))
+    assert list(rows[0]) == RESULT_COLUMNS
+    assert {row['ch_id'] for row in rows} == {'SC428761'}
+
+    assert export_results(store, str(tmp_path / 'results.csv'), form_type='offline6') == 2
+    with open(tmp_path / 'results.csv', newline='') as f:
+        assert [row['total_shares'] for row in csv.DictReader(f)] == ['123405.0', '157337.0']
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import json
+import warnings
+
+from api_handler import CompaniesHouseHandler
+from job_manifest import JobManifest
+
+CH_ID = 'SC000001'
+DOC_ITEM = {
+    'transaction_id': 'TX1',
+    'action_date': '2020-01-01',
+    'date': '2020-01-02',
+    'type': 'SH01',
+    'description_values': {},
+    'links': {'document_metadata': 'https://document-api.example/document/DOC1'},
+}
+RESULT = {'transaction_id': 'TX1', 'form_type': 'online', 'share_price': 1.0, 'n_allotted': 10.0,
+          'total_shares': 100.0}
+
+
+def test_complete_only_moves_forward(tmp_path):
+    manifest = JobManifest(str(tmp_path / 'manifest.sqlite'))
+    manifest.register(CH_ID, 'TX1')
+    manifest.complete(CH_ID, 'TX1', 'parsed', form_type='online', result=RESULT)
+    manifest.complete(CH_ID, 'TX1', 'downloaded')
+    assert manifest.is_done(CH_ID, 'TX1', 'parsed')
+    assert manifest.parsed_result(CH_ID, 'TX1') == RESULT
+
+
+def test_resume_writes_parsed_result_without_parsing_again(tmp_path):
+    handler = CompaniesHouseHandler({'general': {'Dir': str(tmp_path)}, 'metrics': {'Enabled': 'False'}})
+    doc_path = handler.get_doc_path(DOC_ITEM, CH_ID)
+    (tmp_path / CH_ID / f'{DOC_ITEM["action_date"]}_TX1').mkdir(parents=True)
+    with open(doc_path + 'document.pdf', 'wb') as f:
+        f.write(b'%PDF-1.4\n%%EOF\n')
+    with open(doc_path + 'metadata.json', 'w') as f:
+        json.dump(DOC_ITEM, f)
+
+    n_parsed = []
+    handler.parse_document = lambda doc_item, ch_id: n_parsed.append(1) or dict(RESULT)
+    append = handler.results.append
+
+    def failing_append(ch_id, res):
+        raise OSError('disk full')
+
+    handler.results.append = failing_append
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        handler.download_document(DOC_ITEM, CH_ID)
+        assert handler.parse_and_write(DOC_ITEM, CH_ID) is None
+        assert handler.manifest.summary()['stages']['parsed'] == 1
+
+        # The next run finds the document on disk and writes the results kept in the manifest
+        handler.results.append = append
+        handler.download_document(DOC_ITEM, CH_ID)
+        assert handler.parse_and_write(DOC_ITEM, CH_ID) == RESULT
+    assert len(n_parsed) == 1
+    assert handler.manifest.summary()['stages']['written'] == 1
+    assert [row['transaction_id'] for row in handler.results.query(ch_id=CH_ID)] == ['TX1']
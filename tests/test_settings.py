@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from api_handler import CompaniesHouseHandler
+from settings import configure
+from utils import get_companies_house_client, get_content_cache
+
+
+def test_handler_settings_replace_process_singletons(tmp_path):
+    first = CompaniesHouseHandler({'general': {'Dir': str(tmp_path / 'A'), 'CompanyHouseKey': 'key-a'},
+                                   'metrics': {'Enabled': 'False'}})
+    first_client = get_companies_house_client()
+    second = CompaniesHouseHandler({'general': {'Dir': str(tmp_path / 'B'), 'CompanyHouseKey': 'key-b'},
+                                    'metrics': {'Enabled': 'False'}})
+    second.results.append('SC000001', {'transaction_id': 'TX1', 'date': '2020-01-01'})
+    assert [row['transaction_id'] for row in second.results.query()] == ['TX1']
+    assert list(first.results.query()) == []
+    assert get_companies_house_client() is not first_client
+    assert second.downloader.client.api_key == 'key-b'
+
+
+def test_empty_cache_path_is_under_the_work_directory(tmp_path):
+    configure({'general': {'Dir': str(tmp_path)}, 'cache': {'Path': ''}})
+    assert get_content_cache().root == tmp_path / 'cache'
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import warnings
+
+import api_handler
+from api_handler import CompaniesHouseHandler, sync_filing_history
+from sh01_index import SH01Index
+
+CH_ID = 'SC000001'
+UNLINKED = {'transaction_id': 'TX2', 'type': 'SH01', 'date': '2020-02-01', 'action_date': '2020-01-30'}
+LINKED = dict(UNLINKED, links={'document_metadata': 'https://document-api.example/document/DOC2'})
+OLDER = {'transaction_id': 'TX1', 'type': 'SH01', 'date': '2020-01-02', 'action_date': '2020-01-01',
+         'links': {'document_metadata': 'https://document-api.example/document/DOC1'}}
+
+
+def test_pending_item_is_replaced_once_its_document_is_linked(tmp_path):
+    index = SH01Index(str(tmp_path / 'index.sqlite'))
+    index.record_history(CH_ID, [UNLINKED, OLDER])
+    # Paging goes back past the item without a link, so that it is fetched again
+    assert index.known_transaction_ids(CH_ID) == {'TX1'}
+
+    index.record_history(CH_ID, [LINKED])
+    assert index.pending_sh01_items(CH_ID) == [LINKED, OLDER]
+    assert index.known_transaction_ids(CH_ID) == {'TX1', 'TX2'}
+
+
+def test_unlinked_item_below_a_newer_filing_is_fetched_again(tmp_path, monkeypatch):
+    index = SH01Index(str(tmp_path / 'index.sqlite'))
+    history = [{'transaction_id': 'A', 'type': 'CS01', 'date': '2020-03-01'}, UNLINKED, OLDER]
+    monkeypatch.setattr(api_handler, 'send_request_to_companies_house_api', lambda url: {'items': list(history)})
+    sync_filing_history(CH_ID, index)
+    assert [item['transaction_id'] for item in index.pending_sh01_items(CH_ID)] == ['TX2', 'TX1']
+
+    history.insert(0, {'transaction_id': 'N', 'type': 'CS01', 'date': '2020-04-01'})
+    history[2] = LINKED
+    assert sync_filing_history(CH_ID, index) == [LINKED, OLDER]
+    # Once the link is there, paging stops at the newest filing again
+    assert index.known_transaction_ids(CH_ID) == {'N', 'TX1', 'TX2'}
+
+
+def test_processed_item_is_not_replaced(tmp_path):
+    index = SH01Index(str(tmp_path / 'index.sqlite'))
+    index.record_history(CH_ID, [OLDER])
+    index.mark_processed(CH_ID, 'TX1')
+    index.record_history(CH_ID, [dict(OLDER, links={})])
+    assert index.pending_sh01_items(CH_ID) == []
+    assert index.known_transaction_ids(CH_ID) == {'TX1'}
+
+
+def test_item_without_document_is_skipped(tmp_path):
+    handler = CompaniesHouseHandler({'general': {'Dir': str(tmp_path)}, 'metrics': {'Enabled': 'False'}})
+    handler.parse_document = lambda doc_item, ch_id: {}
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert list(handler.iter_ch_id(CH_ID, [UNLINKED])) == []
+    assert handler.manifest.failures() == []
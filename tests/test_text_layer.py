@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import subprocess
+from types import SimpleNamespace
+
+import text_layer
+from text_layer import MIN_PAGE_CHARACTERS, extract_text_layer, load_text_layer
+
+
+def fake_pdftotext(monkeypatch, output):
+    calls = []
+
+    def run(args, **kwargs):
+        calls.append(args)
+        if output is None:
+            raise FileNotFoundError('pdftotext')
+        return SimpleNamespace(stdout=output.encode('utf-8'))
+
+    monkeypatch.setattr(text_layer.subprocess, 'run', run)
+    return calls
+
+
+def write_pdf(tmp_path):
+    (tmp_path / 'document.pdf').write_bytes(b'%PDF-1.4\n%%EOF\n')
+    return str(tmp_path) + '/'
+
+
+def test_pages_are_split_on_form_feeds(tmp_path, monkeypatch):
+    page = 'Total number of shares 217825\n' * 2
+    calls = fake_pdftotext(monkeypatch, f'{page}\f{page}\f')
+    assert extract_text_layer(write_pdf(tmp_path) + 'document.pdf', last_page=3) == [page, page]
+    assert calls[0][:-2] == ['pdftotext', '-layout', '-enc', 'UTF-8', '-f', '1', '-l', '3']
+
+
+def test_scanned_document_has_no_text_layer(tmp_path, monkeypatch):
+    fake_pdftotext(monkeypatch, ' x \n' * (MIN_PAGE_CHARACTERS - 1) + '\f\f')
+    assert extract_text_layer(write_pdf(tmp_path) + 'document.pdf') == []
+
+
+def test_missing_pdftotext_or_document(tmp_path, monkeypatch):
+    fake_pdftotext(monkeypatch, None)
+    assert extract_text_layer(write_pdf(tmp_path) + 'document.pdf') is None
+    assert extract_text_layer(str(tmp_path / 'missing.pdf')) is None
+
+    def fail(args, **kwargs):
+        raise subprocess.CalledProcessError(1, args)
+
+    monkeypatch.setattr(text_layer.subprocess, 'run', fail)
+    assert extract_text_layer(write_pdf(tmp_path) + 'document.pdf') is None
+
+
+def test_text_layer_is_cached_next_to_the_pages(tmp_path, monkeypatch):
+    doc_path = write_pdf(tmp_path)
+    page = 'Total number of shares 217825\n' * 2
+    calls = fake_pdftotext(monkeypatch, f'{page}\f')
+    assert load_text_layer(doc_path) == [page]
+    assert (tmp_path / 'pages' / 'text_layer.txt').read_text(encoding='utf-8') == page
+    assert load_text_layer(doc_path) == [page]
+    assert len(calls) == 1
+
+
+def test_empty_text_layer_is_cached_and_unavailable_one_is_not(tmp_path, monkeypatch):
+    doc_path = write_pdf(tmp_path)
+    calls = fake_pdftotext(monkeypatch, None)
+    assert load_text_layer(doc_path) == []
+    assert not (tmp_path / 'pages' / 'text_layer.txt').exists()
+    calls = fake_pdftotext(monkeypatch, '\f')
+    assert load_text_layer(doc_path) == []
+    assert load_text_layer(doc_path) == []
+    assert len(calls) == 1
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from contextlib import closing
+
+import pytest
+
+from api_handler import CompaniesHouseHandler
+from work_queue import WorkQueue
+
+CH_IDS = [f'SC{i:06d}' for i in range(5)]
+
+
+def open_queue(tmp_path, **kwargs):
+    return WorkQueue(str(tmp_path / 'work_queue.sqlite'), **kwargs)
+
+
+def test_load_fills_once_per_run(tmp_path):
+    work_queue = open_queue(tmp_path)
+    assert work_queue.load(CH_IDS, batch_size=2) == 3
+    # Another worker of the same run does not fill the queue again
+    assert work_queue.load(CH_IDS, batch_size=2) == 0
+    assert [batch for batch in work_queue.iter_batches('w1')] == [CH_IDS[:2], CH_IDS[2:4], CH_IDS[4:]]
+    assert work_queue.summary() == {'done': 3}
+
+    # The next run processes the list again
+    assert work_queue.load(CH_IDS[:1], batch_size=2) == 1
+    assert work_queue.summary() == {'pending': 1}
+    assert work_queue.reset() == 1
+    assert work_queue.summary() == {}
+
+
+def test_expired_lease_is_claimed_by_another_worker(tmp_path):
+    work_queue = open_queue(tmp_path, lease_seconds=-1)
+    work_queue.load(CH_IDS, batch_size=5)
+    batch_id, ch_ids = work_queue.claim('w1')
+    assert ch_ids == CH_IDS
+    assert work_queue.summary() == {'expired': 1}
+    # A run whose batch may still be claimed is in progress
+    assert work_queue.load(CH_IDS, batch_size=5) == 0
+
+    assert work_queue.claim('w2') == (batch_id, CH_IDS)
+    assert not work_queue.heartbeat(batch_id, 'w1')
+    assert not work_queue.complete(batch_id, 'w1')
+    assert work_queue.complete(batch_id, 'w2')
+
+
+def test_batch_is_released_when_processing_raises(tmp_path):
+    work_queue = open_queue(tmp_path, max_attempts=2)
+    work_queue.load(CH_IDS, batch_size=5)
+    for _ in range(2):
+        with pytest.raises(RuntimeError), closing(work_queue.iter_batches('w1')) as batches:
+            for _ in batches:
+                assert work_queue.summary() == {'leased': 1}
+                raise RuntimeError('parse failed')
+    # The batch failed max_attempts times, it is left aside and a new run can be loaded
+    assert work_queue.summary() == {'failed': 1}
+    assert work_queue.claim('w1') is None
+    assert work_queue.load(CH_IDS, batch_size=5) == 1
+
+
+def test_empty_queue_path_is_under_the_work_directory(tmp_path):
+    handler = CompaniesHouseHandler({'general': {'Dir': str(tmp_path)}, 'pipeline': {'WorkQueuePath': ''},
+                                     'metrics': {'Enabled': 'False'}})
+    assert handler.QUEUE_PATH == str(tmp_path) + '/work_queue.sqlite'
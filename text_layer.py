@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import subprocess
+from pathlib import Path
+
+from workspace import write_text_atomic
+
+MIN_PAGE_CHARACTERS = 50
+
+
+def extract_text_layer(pdf_path, last_page=10):
+    """
+    This function extracts the embedded text layer of a PDF with pdftotext (poppler, which pdf2image
+    already requires). Electronically filed documents carry a text layer, scanned paper filings do not.
+    :param pdf_path: path of the PDF file
+    :param last_page: last page to extract
+    :return: list with the text of every page, empty if the document has no usable text layer,
+     None if pdftotext is not available
+    """
+    if not Path(pdf_path).is_file():
+        return None
+    try:
+        output = subprocess.run(['pdftotext', '-layout', '-enc', 'UTF-8', '-f', '1', '-l', str(last_page),
+                                 pdf_path, '-'], capture_output=True, timeout=60, check=True).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    pages = output.decode('utf-8', errors='ignore').split('\f')
+    if pages and not pages[-1].strip():
+        pages = pages[:-1]
+    if sum(len(''.join(p.split())) for p in pages) < MIN_PAGE_CHARACTERS:
+        return []
+    return pages
+
+
+def load_text_layer(doc_path, last_page=10):
+    """
+    This function returns the text layer of the document in doc_path, caching it next to the pages.
+    :param doc_path: document folder
+    :param last_page: last page to extract
+    :return: list with the text of every page
+    """
+    cache_path = Path(doc_path + 'pages/text_layer.txt')
+    if cache_path.is_file():
+        text = cache_path.read_text(encoding='utf-8')
+        return text.split('\f') if text else []
+    pages = extract_text_layer(doc_path + 'document.pdf', last_page)
+    if pages is None:
+        return []
+    write_text_atomic(cache_path, '\f'.join(pages))
+    return pages
@@ -1,60 +1,244 @@
-import requests
-import json
-import time
-import configparser
-import cv2
+import threading
 import datetime
-import subprocess
 import re
+import sqlite3
 from pathlib import Path
 
-config = configparser.ConfigParser()
+from content_cache import ContentCache, content_key
+from metrics import get_metrics
+from ocr_engine import create_ocr_engine, OcrWord
+from settings import get_settings, on_configure
 
-config.read('config.txt')
-COMPANY_HOUSE_KEY = config['general']['CompanyHouseKey']
-WORK_DIRECTORY = config['general']['Dir']
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_companies_house_client():
+    """
+    This function returns the process-wide Companies House client, so that all threads share one connection
+    pool and one rate limit budget. With SharedBudgetPath configured, the budget is also shared with the
+    processes of other hosts.
+    :return:
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            from http_client import CompaniesHouseClient, SharedTokenBucket
+            config = get_settings()
+            requests_per_window = config.getint('api', 'RequestsPerWindow', fallback=600)
+            window_seconds = config.getfloat('api', 'WindowSeconds', fallback=300)
+            budget_path = config.get('api', 'SharedBudgetPath', fallback='')
+            bucket = SharedTokenBucket(open_sqlite(budget_path), requests_per_window, window_seconds) \
+                if budget_path else None
+            _client = CompaniesHouseClient(
+                config.company_house_key,
+                requests_per_window=requests_per_window,
+                window_seconds=window_seconds,
+                max_retries=config.getint('api', 'MaxRetries', fallback=5),
+                backoff_factor=config.getfloat('api', 'BackoffFactor', fallback=2),
+                bucket=bucket,
+            )
+        return _client
+
+
+@on_configure
+def _reset_client():
+    global _client
+    with _client_lock:
+        _client = None
+
+
+_ocr_engine = None
+_ocr_engine_lock = threading.Lock()
+
+
+def get_ocr_engine():
+    """
+    This function returns the OCR engine of the process. The tesserocr engine keeps one tesseract handle
+    per thread, the command line engine is used if tesserocr is not installed or if configured.
+    :return: OcrEngine
+    """
+    global _ocr_engine
+    with _ocr_engine_lock:
+        if _ocr_engine is None:
+            _ocr_engine = create_ocr_engine(get_settings().get('ocr', 'Engine', fallback='auto'))
+        return _ocr_engine
+
+
+@on_configure
+def _reset_ocr_engine():
+    global _ocr_engine
+    with _ocr_engine_lock:
+        _ocr_engine = None
+
+
+_content_cache = None
+_content_cache_lock = threading.Lock()
+
+
+def get_content_cache():
+    """
+    This function returns the cache of rasterized pages and OCR results of the process, configured in the
+    [cache] section of the config. Processes with the same cache folder share its entries.
+    :return: ContentCache
+    """
+    global _content_cache
+    with _content_cache_lock:
+        if _content_cache is None:
+            config = get_settings()
+            root = config.get('cache', 'Path', fallback='') or config.work_directory + '/cache'
+            _content_cache = ContentCache(open_sqlite(root + '/index.sqlite'), root,
+                                          max_bytes=config.getint('cache', 'MaxSizeMB', fallback=2048) << 20,
+                                          enabled=config.getboolean('cache', 'Enabled', fallback=True))
+        return _content_cache
+
+
+@on_configure
+def _reset_content_cache():
+    global _content_cache
+    with _content_cache_lock:
+        _content_cache = None
+
+
+def open_sqlite(db_path, wal=None):
+    """
+    This function opens a SQLite database that can be shared between threads and processes.
+    :param db_path: path to the database file, parent folders are created if needed
+    :param wal: use write-ahead logging, which needs the processes to be on the same host. Disable it when
+     the databases are on a network file system shared by several hosts. SqliteWal of the config by default.
+    :return: connection
+    """
+    if wal is None:
+        wal = get_settings().sqlite_wal
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False, isolation_level=None)
+    conn.execute(f'PRAGMA journal_mode={"WAL" if wal else "DELETE"}')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
 
 
 def send_request_to_companies_house_api(ref):
     """
-    This function sends a request to the Companies House API and in case of a JSONDecodeError,
-     it waits for 20 seconds and retries. This is done to avoid overloading the API.
+    This function sends a request to the Companies House API. Throttling, non-JSON responses and connection
+    errors are retried with backoff a bounded number of times by the shared client.
     :param ref:
     :return:
     """
-    try:
-        res = requests.get(ref, headers={'Authorization': COMPANY_HOUSE_KEY}).json()
-        return res
-    except json.decoder.JSONDecodeError:
-        print('...Zzz....', end=' ')
-        time.sleep(20)
-        return send_request_to_companies_house_api(ref)
+    return get_companies_house_client().get_json(ref)
+
+
+_fx_rate_provider = None
+_fx_rate_provider_lock = threading.Lock()
+
+
+def get_fx_rate_provider():
+    """
+    This function returns the exchange rate provider of the process, configured in the [fx] section of
+    the config. Rates are stored in fx_rates.sqlite of the work directory unless another path is configured.
+    :return: FxRateProvider
+    """
+    global _fx_rate_provider
+    with _fx_rate_provider_lock:
+        if _fx_rate_provider is None:
+            from fx_rates import FxRateProvider, ExchangeRatesApiSource, CsvRateSource, EXCHANGE_RATES_API_URL
+            config = get_settings()
+            if config.get('fx', 'Source', fallback='api') == 'csv':
+                source = CsvRateSource(config.get('fx', 'CsvPath'))
+            else:
+                source = ExchangeRatesApiSource(config.get('fx', 'ApiUrl', fallback=EXCHANGE_RATES_API_URL),
+                                                config.get('fx', 'AccessKey', fallback=None))
+            conn = open_sqlite(config.get('fx', 'StorePath', fallback=config.work_directory + '/fx_rates.sqlite'))
+            _fx_rate_provider = FxRateProvider(conn, source)
+        return _fx_rate_provider
+
+
+@on_configure
+def _reset_fx_rate_provider():
+    global _fx_rate_provider
+    with _fx_rate_provider_lock:
+        _fx_rate_provider = None
+
+
+def parse_filing_date(date):
+    """
+    This function parses the date of a filing history item, e.g. '2019-05-03'.
+    :param date: ISO date
+    :return: datetime
+    """
+    return datetime.datetime.fromisoformat(date[:10])
 
 
-def process_currencies_share_price(price_share, date):
+def process_currencies_share_price(price_share, date, fx_record=None):
+    """
+    This function converts a share price read from a document to GBP.
+    :param price_share: share price text with its currency
+    :param date: date of the filing, used for the exchange rate
+    :param fx_record: if given, this dictionary is updated with the exchange rate used and its source
+    :return: share price in GBP
+    """
     if price_share == 'nil':
         return None
     if '$' in price_share:
         price_share = float(price_share.replace('$', '').replace('us', ''))
-        rate = requests.get(
-            'https://api.exchangeratesapi.io/{:%Y-%m-%d}?base=USD'.format(date)).json()
-        price_share *= rate['rates']['GBP']
-
+        base = 'USD'
     elif '€' in price_share or 'eur' in price_share:
         price_share = float(price_share.replace('€', '').replace('eur', ''))
-        rate = requests.get(
-            'https://api.exchangeratesapi.io/{:%Y-%m-%d}?base=EUR'.format(date)).json()
-        price_share *= rate['rates']['GBP']
-
+        base = 'EUR'
     else:
-        price_share = float(price_share.replace('£', '').replace('gbp', ''))
+        return float(price_share.replace('£', '').replace('gbp', ''))
+
+    with get_metrics().timer('fx_rate', base=base):
+        rate = get_fx_rate_provider().get_rate(date, base)
+    if fx_record is not None:
+        fx_record.update(rate)
+    return price_share * rate['rate']
+
+
+def remove_table_borders(image, dpi=500, work_dpi=250):
+    """
+    This function removes the horizontal and vertical lines of tables from an image. The line masks are
+    built on a copy downscaled to work_dpi, with kernels scaled to the resolution, and are applied to the
+    full resolution image in one array operation. The mask is widened by one pixel per 500 DPI at full
+    resolution, enough to erase the anti-aliased edges of the lines without cutting the text touching them.
+    :param image: BGR or grayscale image
+    :param dpi: resolution of the image
+    :param work_dpi: resolution at which the lines are detected
+    :return: image without table borders
+    """
+    import cv2
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    scale = min(1.0, work_dpi / dpi)
+    small = gray if scale == 1.0 else cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    thresh = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+
+    # The kernels are 40 px long at 500 DPI
+    length = max(int(round(40 * dpi * scale / 500)), 3)
+    horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (length, 1))
+    vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, length))
+    lines = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, horizontal_kernel, iterations=2)
+    lines |= cv2.morphologyEx(thresh, cv2.MORPH_OPEN, vertical_kernel, iterations=2)
 
-    return price_share
+    if scale != 1.0:
+        lines = cv2.resize(lines, (gray.shape[1], gray.shape[0]), interpolation=cv2.INTER_NEAREST)
+    margin = max(int(round(dpi / 500)), 1)
+    lines = cv2.dilate(lines, cv2.getStructuringElement(cv2.MORPH_RECT, (2 * margin + 1, 2 * margin + 1)))
+    if image.ndim == 3:
+        lines = cv2.merge([lines] * image.shape[2])
+    return cv2.max(image, lines)
 
 
-def remove_table_borders(image):
+def remove_table_borders_contours(image):
+    """
+    This function is the previous implementation of remove_table_borders, which redraws every line contour
+    at full resolution. It is kept as the reference for compare_table_border_removal, checked by the
+    benchmark.
+    :param image: BGR or grayscale image
+    :return: image without table borders
+    """
+    import cv2
     result = image.copy()
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
 
     # Remove horizontal lines
@@ -75,7 +259,45 @@ def remove_table_borders(image):
     return result
 
 
-def crop_image(img, cropped_img_path, x0=0, x1=100, y0=0, y1=100, remove_borders=False):
+def compare_table_border_removal(image, dpi=500):
+    """
+    This function compares remove_table_borders with the previous implementation on an image, to check that
+    the text left for the OCR does not change.
+    :param image: BGR or grayscale image at the given resolution
+    :param dpi: resolution of the image
+    :return: dictionary with the share of identical pixels, the intersection over union of the ink and the
+     shares of the ink away from the table lines that is removed or added
+    """
+    import cv2
+    import numpy as np
+    def ink(img):
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return gray < 128
+
+    original = ink(image)
+    reference = ink(remove_table_borders_contours(image))
+    fast = ink(remove_table_borders(image, dpi))
+    # Ink removed by the previous implementation, with a margin: the line residues it left behind
+    reference_lines = cv2.dilate((original & ~reference).astype('uint8'), np.ones((15, 15), 'uint8')) > 0
+    union = (reference | fast).sum()
+    return {
+        'pixel_agreement': float((reference == fast).mean()),
+        'ink_iou': float((reference & fast).sum() / union) if union else 1.0,
+        'text_loss': float((reference & ~fast & ~reference_lines).sum() / max(reference.sum(), 1)),
+        'text_added': float((fast & ~reference & ~reference_lines).sum() / max(reference.sum(), 1)),
+    }
+
+
+def crop_image(img, cropped_img_path=None, x0=0, x1=100, y0=0, y1=100, remove_borders=False, dpi=500):
+    """
+    This function crops an image to a region given in percentages of its height (x) and width (y).
+    :param img: image
+    :param cropped_img_path: if given, the crop is also written to this path
+    :param remove_borders: remove the table borders from the crop
+    :param dpi: resolution of the image
+    :return: cropped image
+    """
+    import cv2
     crop_img = img[
                x0 * img.shape[0] // 100:
                x1 * img.shape[0] // 100,
@@ -83,9 +305,11 @@ def crop_image(img, cropped_img_path, x0=0, x1=100, y0=0, y1=100, remove_borders
                y1 * img.shape[1] // 100
                ]
     if remove_borders:
-        crop_img = remove_table_borders(crop_img)
-    cv2.imwrite(cropped_img_path, crop_img)
-    return None
+        with get_metrics().timer('border_removal'):
+            crop_img = remove_table_borders(crop_img, dpi)
+    if cropped_img_path is not None:
+        cv2.imwrite(cropped_img_path, crop_img)
+    return crop_img
 
 
 def get_text_from_image(doc_path, img_name, psm):
@@ -95,20 +319,79 @@ def get_text_from_image(doc_path, img_name, psm):
     :param psm: tesseract page segmentation mode
     :return:
     """
-    tesseract_command = 'tesseract {} {} --psm {} --dpi 92'.format(doc_path + 'pages/{}.jpg'.format(img_name),
-                                                          doc_path + 'pages/' + img_name, psm)
+    import cv2
+    img = cv2.imread(doc_path + 'pages/{}.jpg'.format(img_name))
+    return ocr_image(img, psm)
 
-    subprocess.call(tesseract_command, shell=True)
 
-    with open(doc_path + 'pages/{}.txt'.format(img_name), 'r') as f:
-        detected_text = f.read().replace(',', '').replace('-', '').replace('—', '').replace(
-            '_', '').replace('!', '').replace('|', '').replace(')', '').lower()
-        detected_text = re.sub(r' +', ' ', detected_text)
-        detected_text = re.sub(r'(\d) \. (\d)', r'\1.\2', detected_text)
-        detected_text = re.sub('pound sterling', '£', detected_text)
-        detected_text = re.sub('usd', '\$', detected_text)
-        detected_text = re.sub(r'(€|\$|£|eur|gbp) ', r'\1', detected_text)
-        detected_text = re.sub(r'\n+', r'\n', detected_text)
+def ocr_image(img, psm, dpi=92):
+    """
+    This function extracts text from an image array using the OCR engine and post-processes it with regex.
+    :param img: image
+    :param psm: tesseract page segmentation mode
+    :param dpi: resolution hint passed to tesseract
+    :return:
+    """
+    return clean_detected_text(recognize_text(img, psm, dpi))
+
+
+def recognize_text(img, psm, dpi=None):
+    """
+    This function recognizes the text of an image array using the OCR engine, or returns the text recognized
+    before from the same pixels with the same settings and engine version.
+    :param img: image
+    :param psm: tesseract page segmentation mode
+    :param dpi: resolution hint passed to tesseract
+    :return: text as returned by the engine
+    """
+    engine = get_ocr_engine()
+    cache = get_content_cache()
+    key = content_key('text', img, psm, dpi, engine.version) if cache.enabled else None
+    detected_text = cache.get_json('ocr_text', key) if key else None
+    if detected_text is None:
+        with get_metrics().timer('ocr', psm=psm):
+            detected_text = engine.image_to_text(img, psm, dpi)
+        if key:
+            cache.put_json('ocr_text', key, detected_text)
+    return detected_text
+
+
+def ocr_image_words(img, psm, dpi=92):
+    """
+    This function recognizes the words of an image array with their bounding boxes using the OCR engine.
+    :param img: image
+    :param psm: tesseract page segmentation mode
+    :param dpi: resolution hint passed to tesseract
+    :return: list of OcrWord
+    """
+    engine = get_ocr_engine()
+    cache = get_content_cache()
+    key = content_key('words', img, psm, dpi, engine.version) if cache.enabled else None
+    words = cache.get_json('ocr_words', key) if key else None
+    if words is not None:
+        return [OcrWord(*word) for word in words]
+    with get_metrics().timer('ocr', psm=psm, mode='words'):
+        words = engine.image_to_data(img, psm, dpi)
+    if key:
+        cache.put_json('ocr_words', key, words)
+    return words
+
+
+def clean_detected_text(detected_text):
+    """
+    This function post-processes text read from a document, either by tesseract or from the PDF text layer,
+    with regex.
+    :param detected_text:
+    :return:
+    """
+    detected_text = detected_text.replace(',', '').replace('-', '').replace('—', '').replace(
+        '_', '').replace('!', '').replace('|', '').replace(')', '').lower()
+    detected_text = re.sub(r' +', ' ', detected_text)
+    detected_text = re.sub(r'(\d) \. (\d)', r'\1.\2', detected_text)
+    detected_text = re.sub('pound sterling', '£', detected_text)
+    detected_text = re.sub('usd', '\$', detected_text)
+    detected_text = re.sub(r'(€|\$|£|eur|gbp) ', r'\1', detected_text)
+    detected_text = re.sub(r'\n+', r'\n', detected_text)
     return detected_text
 
 
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import socket
+import threading
+import time
+import warnings
+import zlib
+from itertools import islice
+
+from utils import open_sqlite
+
+
+def iter_ch_ids(ch_list_path):
+    """
+    This function reads a list of company house ids one line at a time, so that lists of millions of
+    companies are not loaded in memory.
+    :param ch_list_path: file with one company house id per line
+    :return: generator of company house ids
+    """
+    with open(ch_list_path, 'r') as f:
+        for line in f:
+            ch_id = line.strip()
+            if ch_id:
+                yield ch_id
+
+
+def parse_shard(shard):
+    """
+    This function parses a shard given as 'i/N', with 0 <= i < N.
+    :param shard: text
+    :return: (i, N)
+    """
+    try:
+        index, n_shards = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError(f'Invalid shard {shard}, expected i/N')
+    if n_shards < 1 or not 0 <= index < n_shards:
+        raise ValueError(f'Invalid shard {shard}, expected 0 <= i < N')
+    return index, n_shards
+
+
+def shard_of(ch_id, n_shards):
+    """
+    This function assigns a company to a shard with a hash that is the same on every host and run, unlike
+    the built-in hash of strings.
+    :param ch_id: company house id
+    :param n_shards: number of shards
+    :return: shard index
+    """
+    return zlib.crc32(ch_id.upper().encode('utf-8')) % n_shards
+
+
+def iter_shard(ch_ids, index, n_shards):
+    """
+    This function keeps the companies of one shard.
+    :param ch_ids: iterable of company house ids
+    :param index: index of the shard
+    :param n_shards: number of shards
+    :return: generator of company house ids
+    """
+    return (ch_id for ch_id in ch_ids if shard_of(ch_id, n_shards) == index)
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class WorkQueue:
+    """
+    This class splits a list of companies into batches that workers on several hosts claim from a SQLite
+    database on a shared file system. A claimed batch is leased for lease_seconds and the lease is renewed by
+    a heartbeat while the batch is processed. The batch of a worker that stops is claimed again by another
+    one once its lease expires, which is safe because documents already processed are skipped. A batch
+    failing max_attempts times is left aside as failed.
+    """
+
+    def __init__(self, db_path, lease_seconds=600, heartbeat_seconds=60, max_attempts=3):
+        self.conn = open_sqlite(db_path)
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS batches (
+                    batch_id INTEGER PRIMARY KEY,
+                    ch_ids TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS batches_status ON batches (status, lease_expires)')
+
+    def _transaction(self, statements):
+        # BEGIN IMMEDIATE takes the write lock upfront, so that two workers cannot claim the same batch
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements()
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return result
+
+    def load(self, ch_ids, batch_size=200):
+        """
+        This function fills the queue with the companies of a list, unless a run is in progress, e.g. filled
+        by the first worker started. Once no batch is left to process, the batches of the previous run are
+        replaced, so that the next run, e.g. the nightly refresh, processes the list again.
+        :param ch_ids: iterable of company house ids
+        :param batch_size: number of companies per batch
+        :return: number of batches added
+        """
+        def fill():
+            now = time.time()
+            if self.conn.execute(
+                    "SELECT 1 FROM batches WHERE (status = 'pending' AND attempts < ?) OR "
+                    "(status = 'leased' AND (lease_expires >= ? OR attempts < ?)) LIMIT 1",
+                    (self.max_attempts, now, self.max_attempts)).fetchone() is not None:
+                return 0
+            self.conn.execute('DELETE FROM batches')
+            ch_ids_iter = iter(ch_ids)
+            n_batches = 0
+            while True:
+                batch = list(islice(ch_ids_iter, batch_size))
+                if not batch:
+                    return n_batches
+                self.conn.execute('INSERT INTO batches (ch_ids, updated_at) VALUES (?, ?)',
+                                  (json.dumps(batch), now))
+                n_batches += 1
+
+        return self._transaction(fill)
+
+    def reset(self):
+        """
+        This function removes all the batches, e.g. to stop a run and load another list. Workers still
+        processing a batch lose its lease.
+        :return: number of batches removed
+        """
+        return self._transaction(lambda: self.conn.execute('DELETE FROM batches').rowcount)
+
+    def claim(self, worker_id):
+        """
+        This function leases the first batch that is pending or whose lease expired.
+        :param worker_id: id of the worker
+        :return: (batch id, list of company house ids) or None if no batch is left
+        """
+        def claim_batch():
+            now = time.time()
+            row = self.conn.execute(
+                "SELECT batch_id, ch_ids FROM batches WHERE attempts < ? AND (status = 'pending' OR "
+                "(status = 'leased' AND lease_expires < ?)) ORDER BY batch_id LIMIT 1",
+                (self.max_attempts, now)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE batches SET status = 'leased', worker = ?, lease_expires = ?, "
+                              "attempts = attempts + 1, updated_at = ? WHERE batch_id = ?",
+                              (worker_id, now + self.lease_seconds, now, row[0]))
+            return row[0], json.loads(row[1])
+
+        return self._transaction(claim_batch)
+
+    def _update_lease(self, batch_id, worker_id, statement, params):
+        with self.lock:
+            cursor = self.conn.execute(statement + " WHERE batch_id = ? AND worker = ? AND status = 'leased'",
+                                       params + (batch_id, worker_id))
+        return cursor.rowcount == 1
+
+    def heartbeat(self, batch_id, worker_id):
+        """
+        This function renews the lease of a batch.
+        :return: False if the lease was lost, e.g. because it expired and another worker claimed the batch
+        """
+        now = time.time()
+        return self._update_lease(batch_id, worker_id, 'UPDATE batches SET lease_expires = ?, updated_at = ?',
+                                  (now + self.lease_seconds, now))
+
+    def complete(self, batch_id, worker_id):
+        """
+        This function marks a leased batch as done.
+        :return: False if the lease was lost
+        """
+        return self._update_lease(batch_id, worker_id, "UPDATE batches SET status = 'done', updated_at = ?",
+                                  (time.time(),))
+
+    def release(self, batch_id, worker_id):
+        """
+        This function gives a leased batch back to the queue, e.g. when its processing failed.
+        :return: False if the lease was lost
+        """
+        return self._update_lease(
+            batch_id, worker_id, "UPDATE batches SET status = 'pending', lease_expires = NULL, updated_at = ?",
+            (time.time(),))
+
+    def _keep_alive(self, batch_id, worker_id, stop):
+        while not stop.wait(self.heartbeat_seconds):
+            if not self.heartbeat(batch_id, worker_id):
+                warnings.warn(f'Lease of batch {batch_id} lost by worker {worker_id}.')
+                return
+
+    def iter_batches(self, worker_id=None):
+        """
+        This function claims batches one after the other until the queue is empty. The lease of a batch is
+        renewed in the background until the caller asks for the next batch, which marks it as done. A batch
+        whose processing raises is given back to the queue once the generator is closed, so the caller should
+        close it explicitly, e.g. with contextlib.closing.
+        :param worker_id: id of the worker, host name and process id by default
+        :return: generator of lists of company house ids
+        """
+        worker_id = worker_id or default_worker_id()
+        while True:
+            claimed = self.claim(worker_id)
+            if claimed is None:
+                return
+            batch_id, ch_ids = claimed
+            stop = threading.Event()
+            threading.Thread(target=self._keep_alive, args=(batch_id, worker_id, stop), daemon=True).start()
+            try:
+                yield ch_ids
+            except BaseException:
+                self.release(batch_id, worker_id)
+                raise
+            finally:
+                stop.set()
+            self.complete(batch_id, worker_id)
+
+    def summary(self):
+        """
+        This function counts the batches by status. Leased batches whose lease expired are counted as expired
+        and batches that failed max_attempts times as failed.
+        :return: dictionary {status: number of batches}
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT CASE WHEN status != 'done' AND attempts >= ? AND "
+                "(status = 'pending' OR lease_expires < ?) THEN 'failed' "
+                "WHEN status = 'leased' AND lease_expires < ? THEN 'expired' ELSE status END, COUNT(*) "
+                "FROM batches GROUP BY 1", (self.max_attempts, time.time(), time.time())).fetchall()
+        return dict(rows)
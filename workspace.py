@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+from pathlib import Path
+
+
+SHM_DIR = '/dev/shm'
+
+
+def scratch_dir():
+    """
+    This function returns the folder for temporary files, in memory (tmpfs) when available.
+    :return:
+    """
+    if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK):
+        return SHM_DIR
+    return tempfile.gettempdir()
+
+
+def write_text_atomic(path, text):
+    """
+    This function writes a text file through a uniquely named temporary file, so that concurrent writers and
+    readers never see a partially written file.
+    :param path: path of the file
+    :param text: content
+    :return:
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + '.', suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class ScratchWorkspace:
+    """
+    This class handles the intermediate crops of a document. Crops stay in memory as arrays and are passed
+    directly to the OCR engine, so that several crops of the same document can be processed concurrently
+    without racing on shared file names. In debug mode the crops and the recognized text are also written to
+    the pages folder of the document, as the pipeline used to do.
+    """
+
+    def __init__(self, doc_path, debug=False):
+        self.doc_path = doc_path
+        self.debug = debug
+
+    def put(self, name, img):
+        """
+        This function keeps a crop on disk in debug mode.
+        :param name: name of the crop, e.g. '0cropped'
+        :param img: image
+        :return:
+        """
+        if self.debug:
+            import cv2
+            Path(self.doc_path + 'pages/').mkdir(parents=True, exist_ok=True)
+            cv2.imwrite(self.doc_path + 'pages/{}.jpg'.format(name), img)
+
+    def put_text(self, name, detected_text):
+        """
+        This function keeps the text recognized from a crop on disk in debug mode.
+        :param name: name of the crop
+        :param detected_text: text
+        :return:
+        """
+        if self.debug:
+            write_text_atomic(self.doc_path + 'pages/{}.txt'.format(name), detected_text)